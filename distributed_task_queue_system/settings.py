@@ -142,6 +142,115 @@ RABBITMQ_HOST = rabbitmq_url.hostname or "localhost"
 RABBITMQ_PORT = rabbitmq_url.port or 5672
 RABBITMQ_VIRTUAL_HOST = rabbitmq_url.path[1:] or "/"
 
+# Publishing mode of QueueManager: "confirm" pipelines publishes with asynchronous publisher confirms,
+# "transactional" commits every publish with a synchronous channel transaction
+RABBITMQ_PUBLISH_MODE = os.getenv("RABBITMQ_PUBLISH_MODE", "confirm")
+# Maximum number of unconfirmed messages in flight per publisher
+RABBITMQ_CONFIRM_WINDOW = int(os.getenv("RABBITMQ_CONFIRM_WINDOW", "1000"))
+# Seconds to wait for the broker to confirm a batch of messages, and for a slot in the confirm window
+RABBITMQ_CONFIRM_TIMEOUT = int(os.getenv("RABBITMQ_CONFIRM_TIMEOUT", "30"))
+
+# Delayed messages pass through one TTL queue per power of two seconds, 18 levels allow delays of up to ~3 days
+RABBITMQ_DELAY_LEVELS = int(os.getenv("RABBITMQ_DELAY_LEVELS", "18"))
+
+# Encoding of task messages: json (all task fields), slim (task id only), msgpack (needs the msgpack
+# package) or struct (packed id and priority). Workers decode every codec by its content type.
+TASK_MESSAGE_CODEC = os.getenv("TASK_MESSAGE_CODEC", "slim")
+
+# Process-wide pool of broker connections shared by the API, producers and health checks
+RABBITMQ_POOL_MAX_SIZE = int(os.getenv("RABBITMQ_POOL_MAX_SIZE", "10"))
+# Seconds an idle pooled connection is kept before it is closed
+RABBITMQ_POOL_IDLE_TIMEOUT = int(os.getenv("RABBITMQ_POOL_IDLE_TIMEOUT", "30"))
+# Seconds to wait for a free pooled connection when the pool is exhausted
+RABBITMQ_POOL_ACQUIRE_TIMEOUT = int(os.getenv("RABBITMQ_POOL_ACQUIRE_TIMEOUT", "10"))
+
+# Worker execution pool (solo, thread, process or asyncio) and number of tasks it runs at once
+WORKER_POOL = os.getenv("WORKER_POOL", "thread")
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", "1"))
+# Deliveries buffered per execution slot, the tasks of buffered deliveries are loaded with one query
+WORKER_PREFETCH_MULTIPLIER = int(os.getenv("WORKER_PREFETCH_MULTIPLIER", "4"))
+# Seconds task rows and dependency statuses stay in the worker's read cache
+WORKER_TASK_CACHE_TTL = float(os.getenv("WORKER_TASK_CACHE_TTL", "5"))
+# Coalesce task completions of the thread pool into bulk updates, waiting at most this many seconds
+WORKER_WRITE_BEHIND = os.getenv("WORKER_WRITE_BEHIND", "FALSE") == "TRUE"
+WORKER_WRITE_BEHIND_MAX_DELAY = float(os.getenv("WORKER_WRITE_BEHIND_MAX_DELAY", "0.02"))
+# Seconds between two heartbeats of a worker, after which a silent worker is dead, and after which
+# the heartbeats of stopped and dead workers are deleted
+WORKER_HEARTBEAT_INTERVAL = float(os.getenv("WORKER_HEARTBEAT_INTERVAL", "10"))
+WORKER_HEARTBEAT_TIMEOUT = float(os.getenv("WORKER_HEARTBEAT_TIMEOUT", "60"))
+WORKER_HEARTBEAT_RETENTION = float(os.getenv("WORKER_HEARTBEAT_RETENTION", "86400"))
+# Default and largest page size of the task list
+TASK_LIST_PAGE_SIZE = int(os.getenv("TASK_LIST_PAGE_SIZE", "100"))
+TASK_LIST_MAX_PAGE_SIZE = int(os.getenv("TASK_LIST_MAX_PAGE_SIZE", "1000"))
+# Seconds task counter deltas are buffered per process, 0 applies them right after every commit
+TASK_COUNTERS_FLUSH_INTERVAL = float(os.getenv("TASK_COUNTERS_FLUSH_INTERVAL", "1"))
+# Seconds between reconciliations of the task counters with the task table by the scheduler
+TASK_COUNTERS_RECONCILE_INTERVAL = float(
+    os.getenv("TASK_COUNTERS_RECONCILE_INTERVAL", "300")
+)
+# Modules registering task handlers, imported once by every worker
+TASK_HANDLER_MODULES = [
+    module for module in os.getenv("TASK_HANDLER_MODULES", "").split(",") if module
+]
+# Queue of tasks without a queue or route of their own
+TASK_DEFAULT_QUEUE = os.getenv("TASK_DEFAULT_QUEUE", "task_queue")
+# Queues of task types, as "report=reports,webhook=fast"
+TASK_ROUTES = dict(
+    route.split("=", 1) for route in os.getenv("TASK_ROUTES", "").split(",") if route
+)
+# Queues a worker consumes with their weights, as "fast:3,reports:1"
+WORKER_QUEUES = os.getenv("WORKER_QUEUES", TASK_DEFAULT_QUEUE)
+# Seconds a queued task waits for its priority to rise by one level, 0 serves levels strictly by priority
+TASK_PRIORITY_AGING_INTERVAL = float(os.getenv("TASK_PRIORITY_AGING_INTERVAL", "30"))
+# Default soft and hard time limits of tasks in seconds, unset means no limit
+TASK_SOFT_TIME_LIMIT = os.getenv("TASK_SOFT_TIME_LIMIT")
+TASK_SOFT_TIME_LIMIT = float(TASK_SOFT_TIME_LIMIT) if TASK_SOFT_TIME_LIMIT else None
+TASK_TIME_LIMIT = os.getenv("TASK_TIME_LIMIT")
+TASK_TIME_LIMIT = float(TASK_TIME_LIMIT) if TASK_TIME_LIMIT else None
+# Seconds a pool process gets to stop a task after its hard time limit or cancellation before it is killed
+TASK_TIME_LIMIT_GRACE = float(os.getenv("TASK_TIME_LIMIT_GRACE", "5"))
+# Seconds before a task whose handler has no free concurrency slot is delivered again
+TASK_CONCURRENCY_DEFER_DELAY = float(os.getenv("TASK_CONCURRENCY_DEFER_DELAY", "1"))
+# Handler threads a worker tolerates running past their hard time limit before it stops
+TASK_MAX_ABANDONED_THREADS = int(os.getenv("TASK_MAX_ABANDONED_THREADS", "16"))
+# Duration of the simulated work done by the built-in task processor
+WORKER_SIMULATED_TASK_SECONDS = float(os.getenv("WORKER_SIMULATED_TASK_SECONDS", "5"))
+
+# Seconds between two scheduler queries for due tasks, tasks already loaded are published on time in between
+SCHEDULER_POLL_INTERVAL = float(os.getenv("SCHEDULER_POLL_INTERVAL", "5"))
+# Maximum number of due tasks loaded by one scheduler query
+SCHEDULER_BATCH_SIZE = int(os.getenv("SCHEDULER_BATCH_SIZE", "1000"))
+
+# Maximum number of tasks accepted by a single bulk create request
+TASK_BULK_CREATE_MAX_SIZE = int(os.getenv("TASK_BULK_CREATE_MAX_SIZE", "5000"))
+
+# Cache shared by the API processes, falls back to a per-process memory cache without REDIS_URL
+# The Redis backend needs the `redis` package
+REDIS_URL = os.getenv("REDIS_URL")
+if REDIS_URL:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": REDIS_URL,
+        }
+    }
+else:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+            "LOCATION": "task_manager",
+        }
+    }
+
+# Seconds a computed execution order is cached, the cache key changes with the dependency graph anyway
+TASK_EXECUTION_ORDER_CACHE_TIMEOUT = int(
+    os.getenv("TASK_EXECUTION_ORDER_CACHE_TIMEOUT", "300")
+)
+# Largest page of the paginated execution order
+TASK_EXECUTION_ORDER_MAX_PAGE_SIZE = int(
+    os.getenv("TASK_EXECUTION_ORDER_MAX_PAGE_SIZE", "1000")
+)
+
 # REST Framework settings
 REST_FRAMEWORK = {
     "DEFAULT_AUTHENTICATION_CLASSES": (
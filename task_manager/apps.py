@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class TaskManagerConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'task_manager'
+
+    def ready(self):
+        # Register signal handlers that maintain the dependency closure table
+        from . import signals  # noqa: F401
@@ -0,0 +1,266 @@
+import asyncio
+import functools
+import logging
+import signal
+import aio_pika
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.utils import timezone
+from .models import Task
+from .queue_manager import QueueManager
+from .worker import ACK, REQUEUE
+from . import (
+    cancellation,
+    dispatcher,
+    handlers,
+    heartbeats,
+    message_codecs,
+    routing,
+    worker,
+)
+
+logger = logging.getLogger("task_manager")
+
+
+@handlers.handler(handlers.DEFAULT_TASK_TYPE)
+async def aprocess_task(task):
+    # Coroutine counterpart of worker.process_task, simulating I/O-bound work
+    print(f"Processing task: {task.title}")
+    await asyncio.sleep(settings.WORKER_SIMULATED_TASK_SECONDS)
+    return "Task completed successfully"
+
+
+class AsyncWorker:
+    # Consumes tasks with an asyncio AMQP client and runs up to `concurrency` of them at once in a
+    # single thread. Task status updates go through Django's async ORM.
+    # Free slots take the buffered deliveries of the `queues` by weighted round robin and aging
+    # priority, like Worker. `prefetch_multiplier` deliveries are buffered per slot.
+    def __init__(self, queues=None, concurrency=100, prefetch_multiplier=1):
+        self.queues = list(queues or [(settings.TASK_DEFAULT_QUEUE, 1)])
+        self.concurrency = concurrency
+        self.prefetch_count = concurrency * max(prefetch_multiplier, 1)
+        self.connection = None
+        self.channel = None
+        self._pending = routing.WeightedQueues(
+            self.queues, settings.TASK_PRIORITY_AGING_INTERVAL
+        )
+        self.heartbeat = heartbeats.Heartbeat(
+            self.queues, worker.POOL_ASYNCIO, concurrency
+        )
+        self._free = concurrency
+        self._running = set()
+        self._stopping = None
+
+    async def run(self):
+        # Created first, stop() may be called while the worker is still starting
+        self._stopping = asyncio.Event()
+        await sync_to_async(handlers.warm_up)()
+        cancellation.start_listener()
+        await sync_to_async(self.heartbeat.start)()
+        try:
+            self.connection = await aio_pika.connect_robust(
+                host=settings.RABBITMQ_HOST,
+                port=settings.RABBITMQ_PORT,
+                login=settings.RABBITMQ_USERNAME,
+                password=settings.RABBITMQ_PASSWORD,
+                virtualhost=settings.RABBITMQ_VIRTUAL_HOST,
+            )
+            async with self.connection:
+                consumers = []
+                try:
+                    await self._consume_queues(consumers)
+                    await self._stopping.wait()
+                finally:
+                    await self._shut_down(consumers)
+        finally:
+            await sync_to_async(self.heartbeat.stop)()
+
+    async def _consume_queues(self, consumers):
+        # Publisher confirms are enabled, publishing waits for the broker to take the message
+        self.channel = await self.connection.channel(publisher_confirms=True)
+        # Every queue is consumed once per priority level, the limit applies to the channel. The
+        # deliveries buffered beyond the free slots are picked by priority.
+        await self.channel.set_qos(prefetch_count=self.prefetch_count, global_=True)
+        exchange = await self.channel.declare_exchange(
+            routing.TASK_EXCHANGE, aio_pika.ExchangeType.DIRECT, durable=True
+        )
+        for name, _ in self.queues:
+            on_message = functools.partial(self.on_message, name)
+            for level_name in routing.priority_queues(name):
+                queue = await self.channel.declare_queue(level_name, durable=True)
+                await queue.bind(exchange, routing_key=level_name)
+                consumers.append((queue, await queue.consume(on_message)))
+            # Tasks published before they were split by priority level
+            queue = await self.channel.declare_queue(
+                name, durable=True, arguments=routing.QUEUE_ARGUMENTS
+            )
+            consumers.append((queue, await queue.consume(on_message)))
+
+        queues = ", ".join(f"{name}:{weight}" for name, weight in self.queues)
+        print(
+            f"Async worker is waiting for tasks on {queues} "
+            f"(concurrency {self.concurrency}). To exit press CTRL+C"
+        )
+
+    # Runs however run() ends: stop taking deliveries, then let running tasks finish and
+    # acknowledge their deliveries while the channel is still open
+    async def _shut_down(self, consumers):
+        self._stopping.set()
+        for queue, consumer_tag in consumers:
+            try:
+                await queue.cancel(consumer_tag)
+            except Exception as e:
+                logger.warning(f"Failed to cancel the consumer of {queue.name}: {e}")
+        if self._running:
+            await asyncio.gather(*self._running, return_exceptions=True)
+
+    def stop(self):
+        if self._stopping is not None:
+            self._stopping.set()
+
+    async def on_message(self, queue, message):
+        level, ready_at = routing.message_priority(message.priority, message.headers)
+        self._pending.push(queue, message, level, ready_at)
+        self._dispatch()
+
+    def _dispatch(self):
+        # Deliveries still buffered at shutdown are redelivered once the connection closes
+        if self._stopping.is_set():
+            return
+        while self._pending and self._free > 0:
+            self._free -= 1
+            task = asyncio.create_task(self._consume(self._pending.pop()))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def _consume(self, message):
+        self.heartbeat.started(
+            message.delivery_tag, worker.peek_task_id(message.body, message)
+        )
+        try:
+            outcome = await self.handle_message(
+                message.body, message.content_type, message.headers
+            )
+        except Exception as e:
+            logger.error(f"Delivery {message.delivery_tag} failed: {e}")
+            outcome = REQUEUE
+        finally:
+            self._free += 1
+            self._dispatch()
+        self.heartbeat.finished(message.delivery_tag, outcome != ACK)
+
+        if outcome == ACK:
+            await message.ack()
+        else:
+            await message.nack(requeue=True)
+
+    # Async counterpart of worker.handle_message
+    async def handle_message(self, body, content_type=None, headers=None):
+        try:
+            task_data = message_codecs.decode(body, content_type, headers)
+            logger.info(f"Received task: {task_data['id']}")
+        except (ValueError, KeyError, TypeError) as e:
+            logger.error(f"Dead-lettering malformed message: {e}")
+            await sync_to_async(dead_letter)(body, f"Malformed message: {e}")
+            return ACK
+
+        try:
+            task = await Task.objects.aget(id=task_data["id"])
+        except Task.DoesNotExist:
+            logger.error(f"Task with id {task_data['id']} not found in the database")
+            return ACK
+
+        if not await task.atransition(
+            Task.STATUS_IN_PROGRESS,
+            from_status=Task.STATUS_QUEUED,
+            worker=heartbeats.worker_id(),
+        ):
+            logger.warning(
+                f"Task {task.id} is {task.status}, skipping duplicate delivery"
+            )
+            return ACK
+
+        if not task.is_ready_to_run():
+            logger.info(f"Task {task.id} is not ready to run")
+            await sync_to_async(dispatcher.schedule)(task)
+            return ACK
+
+        if await sync_to_async(dispatcher.hold_for_dependencies)(task):
+            logger.info(f"Task {task.id} is waiting for dependencies to complete")
+            return ACK
+
+        try:
+            result = await handlers.arun(task)
+            if not await task.atransition(
+                Task.STATUS_COMPLETED, result=result, last_run_at=timezone.now()
+            ):
+                logger.warning(f"Task {task.id} changed state while it was running")
+                return ACK
+
+            logger.info(
+                "Task processed",
+                extra={
+                    "task_id": task.id,
+                    "status": task.status,
+                    "result": task.result,
+                },
+            )
+
+            await sync_to_async(release_dependents)(task)
+            await sync_to_async(worker.schedule_next_run)(task)
+            return ACK
+        except handlers.UnknownTaskType as e:
+            logger.error(f"Task {task.id} failed: {str(e)}")
+            return await sync_to_async(retry_or_dead_letter)(task, e, retry=False)
+        except cancellation.TaskCancelled:
+            logger.info(f"Task {task.id} was cancelled while it was running")
+            return ACK
+        except handlers.HandlerBusy as e:
+            return await sync_to_async(defer)(task, e)
+        except handlers.WorkerExhausted as e:
+            logger.error(f"Task {task.id} was refused: {e}")
+            await task.atransition(
+                Task.STATUS_QUEUED, from_status=Task.STATUS_IN_PROGRESS
+            )
+            return REQUEUE
+        except Exception as e:
+            logger.error(f"Task {task.id} failed: {str(e)}")
+            return await sync_to_async(retry_or_dead_letter)(task, e)
+
+
+# Follow-up publishes go through the blocking producer path, they run in a thread via sync_to_async
+def release_dependents(task):
+    with QueueManager() as queue_manager:
+        worker.release_dependents(queue_manager, task)
+
+
+def retry_or_dead_letter(task, error, retry=True):
+    with QueueManager() as queue_manager:
+        return worker.retry_or_dead_letter(queue_manager, task, error, retry)
+
+
+def defer(task, reason):
+    with QueueManager() as queue_manager:
+        return worker.defer(queue_manager, task, reason)
+
+
+def dead_letter(body, reason):
+    with QueueManager() as queue_manager:
+        queue_manager.dead_letter(body, reason).result(
+            timeout=settings.RABBITMQ_CONFIRM_TIMEOUT
+        )
+
+
+def start_async_worker(queues=None, concurrency=100, prefetch_multiplier=1):
+    async_worker = AsyncWorker(
+        queues=queues, concurrency=concurrency, prefetch_multiplier=prefetch_multiplier
+    )
+
+    # SIGINT and SIGTERM stop the worker gracefully instead of cancelling the running tasks
+    async def main():
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, async_worker.stop)
+        await async_worker.run()
+
+    asyncio.run(main())
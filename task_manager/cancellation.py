@@ -0,0 +1,343 @@
+import contextvars
+import ctypes
+import heapq
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+import time
+from contextlib import contextmanager
+import pika
+from django.conf import settings
+from .connection_pool import get_connection_parameters
+
+logger = logging.getLogger("task_manager")
+
+# Time limits and cancellation of the tasks running in a worker process.
+# Every running task is registered as an execution and a watchdog thread per process tracks their
+# deadlines. At the soft time limit SoftTimeLimitExceeded is raised inside the task, which can catch it
+# to clean up. At the hard time limit TimeLimitExceeded is raised and the execution slot stops waiting
+# for the task. Cancellations are broadcast to every worker process through a fanout exchange and raise
+# TaskCancelled inside the task. A pool process whose task is still running TASK_TIME_LIMIT_GRACE
+# seconds after a hard limit or a cancellation is killed, and the worker replaces its pool.
+# On the main thread the exception is raised from a signal handler, which also interrupts blocking
+# calls. Other threads get it at their next Python instruction, tasks blocked in a long call can poll
+# checkpoint() or wait on the `cancelled` event of current() instead.
+
+CONTROL_EXCHANGE = "task_control"
+INTERRUPT_SIGNAL = signal.SIGUSR1
+
+
+class SoftTimeLimitExceeded(Exception):
+    pass
+
+
+class TimeLimitExceeded(Exception):
+    pass
+
+
+class TaskCancelled(Exception):
+    pass
+
+
+class Execution:
+    def __init__(self, task_id, thread=None, on_interrupt=None):
+        self.task_id = task_id
+        # Thread the exception is raised in, None when `on_interrupt` delivers it
+        self.thread = thread
+        # Called with the exception and whether the slot should stop waiting for the task
+        self.on_interrupt = on_interrupt
+        self.cancelled = threading.Event()
+        self.error = None
+        self.finished = False
+
+
+_current = contextvars.ContextVar("task_execution", default=None)
+# Running executions of the process by task id
+_executions = {}
+_lock = threading.Lock()
+# (deadline, sequence, action, execution, argument) entries of the watchdog
+_deadlines = []
+_condition = threading.Condition()
+_sequence = itertools.count()
+_compact_at = 1024
+_watchdog_started = False
+_signal_installed = False
+_listener_started = False
+
+
+def _reset_after_fork():
+    global _lock, _condition, _watchdog_started, _signal_installed, _listener_started
+    # A forked pool process starts without the threads of its parent
+    _lock = threading.Lock()
+    _condition = threading.Condition()
+    _executions.clear()
+    _deadlines.clear()
+    _watchdog_started = False
+    _signal_installed = False
+    _listener_started = False
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+# Execution of the task running in the current thread or coroutine, None outside of tasks
+def current():
+    return _current.get()
+
+
+# Raise the pending interruption of the current task, for tasks that check for it in their own loops
+def checkpoint():
+    execution = current()
+    if execution is not None and execution.error is not None:
+        raise execution.error
+
+
+# Register the task running in the block and enforce its time limits
+# `raise_in_thread=False` leaves the delivery of interruptions to `on_interrupt`, for coroutines
+@contextmanager
+def running(
+    task_id,
+    soft_time_limit=None,
+    time_limit=None,
+    on_interrupt=None,
+    raise_in_thread=True,
+):
+    thread = threading.current_thread() if raise_in_thread else None
+    if thread is threading.main_thread():
+        _install_signal_handler()
+    execution = Execution(str(task_id), thread, on_interrupt)
+    token = _current.set(execution)
+    with _lock:
+        _executions[execution.task_id] = execution
+    if soft_time_limit:
+        _schedule(soft_time_limit, _soft_limit, execution, soft_time_limit)
+    if time_limit:
+        _schedule(time_limit, _hard_limit, execution, time_limit)
+    try:
+        yield execution
+    except Exception as e:
+        # Exceptions raised in another thread arrive as bare classes, the instance carries the message
+        if execution.error is not None and type(e) is type(execution.error):
+            raise execution.error from None
+        raise
+    finally:
+        _finish(execution)
+        _current.reset(token)
+
+
+# Unregister a finished execution. `finished` is set under the lock interrupt() holds, so no
+# interruption is sent once it is set, and one sent just before is raised here at the latest.
+def _finish(execution):
+    thread = execution.thread
+    on_main_thread = thread is threading.main_thread()
+    if on_main_thread:
+        # A signal sent meanwhile is delivered once unblocked, the handler then ignores it
+        signal.pthread_sigmask(signal.SIG_BLOCK, {INTERRUPT_SIGNAL})
+    try:
+        try:
+            _unregister(execution)
+        except BaseException:
+            # Raised by an interruption sent before the lock was taken, the exception propagates
+            # once the execution is unregistered
+            _unregister(execution)
+            raise
+    finally:
+        if on_main_thread:
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, {INTERRUPT_SIGNAL})
+        elif thread is not None:
+            # Drop an exception scheduled for the thread that has not been raised yet
+            ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_ulong(thread.ident), None)
+
+
+def _unregister(execution):
+    with _lock:
+        execution.finished = True
+        if _executions.get(execution.task_id) is execution:
+            del _executions[execution.task_id]
+
+
+# Cancel the task if it is running in this process
+def cancel(task_id):
+    with _lock:
+        execution = _executions.get(str(task_id))
+    if execution is None:
+        return False
+    if not interrupt(
+        execution, TaskCancelled(f"Task {task_id} was cancelled"), stop_waiting=True
+    ):
+        return False
+    logger.info(f"Cancelled running task {task_id}")
+    _schedule_kill(execution)
+    return True
+
+
+# Raise `error` inside the task of `execution`, returns False when the task already finished
+def interrupt(execution, error, stop_waiting=False):
+    with _lock:
+        if execution.finished:
+            return False
+        execution.error = error
+        execution.cancelled.set()
+        if execution.thread is threading.main_thread():
+            signal.pthread_kill(execution.thread.ident, INTERRUPT_SIGNAL)
+        elif execution.thread is not None:
+            ctypes.pythonapi.PyThreadState_SetAsyncExc(
+                ctypes.c_ulong(execution.thread.ident), ctypes.py_object(type(error))
+            )
+        if execution.on_interrupt is not None:
+            execution.on_interrupt(error, stop_waiting)
+    return True
+
+
+def _install_signal_handler():
+    global _signal_installed
+    if not _signal_installed:
+        signal.signal(INTERRUPT_SIGNAL, _on_interrupt_signal)
+        _signal_installed = True
+
+
+def _on_interrupt_signal(signum, frame):
+    execution = current()
+    if execution is not None and not execution.finished and execution.error is not None:
+        raise execution.error
+
+
+def _soft_limit(execution, limit):
+    interrupt(
+        execution,
+        SoftTimeLimitExceeded(
+            f"Task {execution.task_id} exceeded the soft time limit of {limit}s"
+        ),
+    )
+
+
+def _hard_limit(execution, limit):
+    error = TimeLimitExceeded(
+        f"Task {execution.task_id} exceeded the time limit of {limit}s"
+    )
+    if interrupt(execution, error, stop_waiting=True):
+        logger.warning(str(error))
+        _schedule_kill(execution)
+
+
+# Only pool processes are killed, the worker replaces them. The process of a solo or thread worker
+# holds every other delivery of the worker as well.
+def _schedule_kill(execution):
+    if execution.thread is not None and multiprocessing.parent_process() is not None:
+        _schedule(settings.TASK_TIME_LIMIT_GRACE, _kill, execution, None)
+
+
+def _kill(execution, argument):
+    if execution.finished:
+        return
+    logger.critical(
+        f"Task {execution.task_id} did not stop within {settings.TASK_TIME_LIMIT_GRACE}s, "
+        f"killing pool process {os.getpid()}"
+    )
+    os.kill(os.getpid(), signal.SIGKILL)
+
+
+def _schedule(delay, action, execution, argument):
+    global _watchdog_started
+    with _condition:
+        if not _watchdog_started:
+            threading.Thread(target=_watch, name="task-watchdog", daemon=True).start()
+            _watchdog_started = True
+        heapq.heappush(
+            _deadlines,
+            (time.monotonic() + delay, next(_sequence), action, execution, argument),
+        )
+        if len(_deadlines) >= _compact_at:
+            _compact()
+        _condition.notify()
+
+
+# Drop the deadlines of finished tasks, tasks usually finish long before their limits
+def _compact():
+    global _compact_at
+    _deadlines[:] = [entry for entry in _deadlines if not entry[3].finished]
+    heapq.heapify(_deadlines)
+    _compact_at = max(1024, 2 * len(_deadlines))
+
+
+def _watch():
+    while True:
+        with _condition:
+            while not _deadlines or _deadlines[0][0] > time.monotonic():
+                timeout = _deadlines[0][0] - time.monotonic() if _deadlines else None
+                _condition.wait(timeout)
+            _, _, action, execution, argument = heapq.heappop(_deadlines)
+        if execution.finished:
+            continue
+        try:
+            action(execution, argument)
+        except Exception as e:
+            logger.error(f"Failed to interrupt task {execution.task_id}: {e}")
+
+
+# Declarations of the control exchange, as (channel method, kwargs) pairs
+def topology():
+    return [
+        (
+            "exchange_declare",
+            {
+                "exchange": CONTROL_EXCHANGE,
+                "exchange_type": "fanout",
+                "durable": True,
+            },
+        )
+    ]
+
+
+# Consume the control messages in a thread with a connection of its own, once per process
+# Every process gets its own exclusive queue, so a broadcast reaches all of them
+def start_listener():
+    global _listener_started
+    with _lock:
+        if _listener_started:
+            return
+        _listener_started = True
+    threading.Thread(target=_listen, name="task-control", daemon=True).start()
+
+
+# Cancellations broadcast while the connection is down are missed. The task still finishes as
+# cancelled, its completion no longer applies once the status has changed.
+def _listen():
+    while True:
+        try:
+            connection = pika.BlockingConnection(get_connection_parameters())
+            channel = connection.channel()
+            for method, kwargs in topology():
+                getattr(channel, method)(**kwargs)
+            queue = channel.queue_declare(queue="", exclusive=True).method.queue
+            channel.queue_bind(queue=queue, exchange=CONTROL_EXCHANGE)
+            channel.basic_consume(
+                queue=queue, on_message_callback=_on_control_message, auto_ack=True
+            )
+            channel.start_consuming()
+        except Exception as e:
+            logger.error(f"Task control listener disconnected: {e!r}")
+        time.sleep(5)
+
+
+# Messages are acknowledged on delivery, one that cannot be applied is logged and dropped. Raising here
+# would drop the listener's connection along with every broadcast sent until it reconnects.
+def _on_control_message(ch, method, properties, body):
+    try:
+        message = json.loads(body)
+    except ValueError as e:
+        logger.error(f"Ignoring malformed control message: {e}")
+        return
+    if not isinstance(message, dict):
+        logger.error(f"Ignoring malformed control message: {message!r}")
+        return
+    if message.get("action") == "cancel":
+        task_id = message.get("task_id")
+        if not task_id:
+            logger.error(f"Ignoring cancel message without a task id: {message!r}")
+            return
+        cancel(task_id)
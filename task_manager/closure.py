@@ -0,0 +1,202 @@
+import logging
+from collections import defaultdict
+from django.db import connection, transaction
+from .models import Task, TaskDependencyClosure
+
+logger = logging.getLogger("task_manager")
+
+BATCH_SIZE = 1000
+# Key of the PostgreSQL advisory lock held while the dependency graph grows
+GRAPH_LOCK_KEY = 7021
+
+
+# Compute the transitive closure of a dependency graph given as (task_id, dependency_id) edges
+# Returns a dict mapping every task id to the set of ids it directly or indirectly depends on
+def compute_closure(edges):
+    graph = defaultdict(list)
+    for task_id, dependency_id in edges:
+        graph[task_id].append(dependency_id)
+
+    closure = {}
+    for root in list(graph):
+        if root in closure:
+            continue
+        # Iterative post-order walk, a node's closure is the union of its dependencies' closures
+        stack = [(root, iter(graph[root]))]
+        on_stack = {root}
+        while stack:
+            node, children = stack[-1]
+            for child in children:
+                if child not in closure and child not in on_stack:
+                    stack.append((child, iter(graph.get(child, ()))))
+                    on_stack.add(child)
+                    break
+            else:
+                stack.pop()
+                on_stack.discard(node)
+                dependencies = set()
+                for child in graph.get(node, ()):
+                    dependencies.add(child)
+                    dependencies |= closure.get(child, set())
+                closure[node] = dependencies
+    return closure
+
+
+def _ancestors(task_ids):
+    ancestors = defaultdict(set)
+    for task_id, dependency_id in TaskDependencyClosure.objects.filter(
+        task_id__in=task_ids
+    ).values_list("task_id", "dependency_id"):
+        ancestors[task_id].add(dependency_id)
+    return ancestors
+
+
+# Looked up in chunks, a batch delete can pass any number of tasks
+def _dependents(task_ids):
+    task_ids = list(task_ids)
+    dependents = defaultdict(set)
+    for start in range(0, len(task_ids), BATCH_SIZE):
+        for task_id, dependency_id in TaskDependencyClosure.objects.filter(
+            dependency_id__in=task_ids[start : start + BATCH_SIZE]
+        ).values_list("task_id", "dependency_id"):
+            dependents[dependency_id].add(task_id)
+    return dependents
+
+
+# Serialize the additions to the dependency graph until the transaction ends
+# Two edges added concurrently can close a cycle through paths that neither of them touches, so the
+# cycle checks need one lock for the whole graph. PostgreSQL takes an advisory lock, other backends lock
+# the rows of the tasks involved; SQLite serializes writers on its own.
+def _lock_graph(edges):
+    if connection.vendor == "postgresql":
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_advisory_xact_lock(%s)", [GRAPH_LOCK_KEY])
+        return
+    task_ids = {task_id for edge in edges for task_id in edge}
+    list(
+        Task.objects.select_for_update()
+        .filter(id__in=task_ids)
+        .order_by("id")
+        .values_list("id", flat=True)
+    )
+
+
+# Record new task -> dependency edges
+# The task and everything depending on it now also depend on the dependency and everything it depends on.
+# The edges are checked for cycles under the graph lock, an edge that would close one raises ValueError,
+# which rolls back the edges added in the same transaction.
+def add_edges(edges):
+    edges = list(edges)
+    if not edges:
+        return
+    with transaction.atomic():
+        _lock_graph(edges)
+        _add_edges(edges)
+
+
+def _add_edges(edges):
+    sources = {task_id for task_id, _ in edges}
+    targets = {dependency_id for _, dependency_id in edges}
+    ancestors = _ancestors(targets)
+    for task_id, dependency_id in edges:
+        if task_id == dependency_id or task_id in ancestors[dependency_id]:
+            raise ValueError(
+                "Adding this dependency would cause a circular dependency."
+            )
+
+    # Edges can only be resolved against the same snapshot when none of them extends the ancestors of
+    # another one, e.g. new tasks that depend on existing tasks. Otherwise apply them one at a time.
+    reachable = set(targets).union(*ancestors.values())
+    if len(edges) > 1 and sources & reachable:
+        for edge in edges:
+            _add_edges([edge])
+        return
+
+    dependents = _dependents(sources)
+    rows = set()
+    for task_id, dependency_id in edges:
+        for dependent_id in dependents[task_id] | {task_id}:
+            for ancestor_id in ancestors[dependency_id] | {dependency_id}:
+                rows.add((dependent_id, ancestor_id))
+
+    TaskDependencyClosure.objects.bulk_create(
+        [
+            TaskDependencyClosure(task_id=task_id, dependency_id=dependency_id)
+            for task_id, dependency_id in rows
+        ],
+        batch_size=BATCH_SIZE,
+        ignore_conflicts=True,
+    )
+
+
+# Recompute the closure rows of tasks whose dependency paths may have changed
+# Call it after the dependency edges have been removed, with the tasks that used to depend on them
+def refresh(task_ids):
+    task_ids = set(task_ids)
+    if not task_ids:
+        return
+
+    current = _ancestors(task_ids)
+    stale = []
+    missing = []
+    for task_id in task_ids:
+        expected = Task.get_dependency_ids([task_id])
+        stale.extend(
+            (task_id, dependency_id)
+            for dependency_id in current[task_id] - expected
+        )
+        missing.extend(
+            TaskDependencyClosure(task_id=task_id, dependency_id=dependency_id)
+            for dependency_id in expected - current[task_id]
+        )
+
+    with transaction.atomic():
+        for task_id in {task_id for task_id, _ in stale}:
+            TaskDependencyClosure.objects.filter(
+                task_id=task_id,
+                dependency_id__in=[d for t, d in stale if t == task_id],
+            ).delete()
+        TaskDependencyClosure.objects.bulk_create(
+            missing, batch_size=BATCH_SIZE, ignore_conflicts=True
+        )
+
+
+# Tasks whose closure is affected when the given tasks lose a dependency: the tasks and their dependents
+def affected_by(task_ids):
+    task_ids = set(task_ids)
+    return task_ids.union(*_dependents(task_ids).values())
+
+
+def _expected_rows():
+    edges = Task.dependencies.through.objects.values_list("from_task_id", "to_task_id")
+    closure = compute_closure(edges)
+    return {
+        (task_id, dependency_id)
+        for task_id, dependencies in closure.items()
+        for dependency_id in dependencies
+    }
+
+
+# Rebuild the whole closure table from the dependency edges
+def rebuild():
+    rows = _expected_rows()
+    with transaction.atomic():
+        TaskDependencyClosure.objects.all().delete()
+        TaskDependencyClosure.objects.bulk_create(
+            [
+                TaskDependencyClosure(task_id=task_id, dependency_id=dependency_id)
+                for task_id, dependency_id in rows
+            ],
+            batch_size=BATCH_SIZE,
+        )
+    return len(rows)
+
+
+# Compare the closure table with the closure of the dependency edges
+# Returns the (task_id, dependency_id) rows that are missing from the table and the ones that are stale
+def find_inconsistencies():
+    expected = _expected_rows()
+    actual = set(
+        TaskDependencyClosure.objects.values_list("task_id", "dependency_id")
+    )
+    return expected - actual, actual - expected
@@ -0,0 +1,223 @@
+import os
+import time
+import threading
+import logging
+from collections import deque
+from contextlib import contextmanager
+import pika
+from pika.exceptions import AMQPConnectionError
+from django.conf import settings
+
+logger = logging.getLogger("task_manager")
+
+
+def get_connection_parameters(
+    host=None, port=None, virtual_host=None, username=None, password=None
+):
+    credentials = pika.PlainCredentials(
+        username or settings.RABBITMQ_USERNAME, password or settings.RABBITMQ_PASSWORD
+    )
+    return pika.ConnectionParameters(
+        host=host or settings.RABBITMQ_HOST,
+        port=port or settings.RABBITMQ_PORT,
+        virtual_host=virtual_host or settings.RABBITMQ_VIRTUAL_HOST,
+        credentials=credentials,
+    )
+
+
+class PooledChannel:
+    # A broker connection with one open channel, leased to a single caller at a time
+    def __init__(self, connection, channel, transactional):
+        self.connection = connection
+        self.channel = channel
+        self.transactional = transactional
+        self.declared = set()
+        self.last_used = time.monotonic()
+        self.pid = os.getpid()
+
+    @property
+    def is_open(self):
+        return self.connection.is_open and self.channel.is_open
+
+    def declare_queue(self, queue, arguments=None):
+        self.declare(
+            queue,
+            [("queue_declare", {"queue": queue, "durable": True, "arguments": arguments})],
+        )
+
+    # Run a sequence of (channel method, kwargs) declarations, cached under `key` for the lifetime
+    # of the channel
+    def declare(self, key, operations):
+        if key not in self.declared:
+            for method, kwargs in operations:
+                getattr(self.channel, method)(**kwargs)
+            self.declared.add(key)
+
+    def close(self):
+        try:
+            if self.connection.is_open:
+                self.connection.close()
+        except Exception as e:
+            logger.warning(f"Failed to close pooled connection: {e}")
+
+
+class ChannelPool:
+    # Bounded pool of blocking connections and channels shared by every thread of the process.
+    # Idle channels are reused most recently used first, so the rest age out after `idle_timeout`
+    # seconds. Every channel is checked for liveness before it is handed out.
+    def __init__(self, parameters, max_size=10, idle_timeout=30, acquire_timeout=10):
+        self.parameters = parameters
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.acquire_timeout = acquire_timeout
+        self._idle = deque()
+        self._size = 0
+        self._condition = threading.Condition()
+        self._pid = os.getpid()
+
+    @property
+    def size(self):
+        return self._size
+
+    def acquire(self, transactional=False):
+        deadline = time.monotonic() + self.acquire_timeout
+        with self._condition:
+            self._reset_after_fork()
+            self._evict_idle()
+            while True:
+                item = self._take_idle(transactional)
+                if item is not None:
+                    return item
+                if self._size < self.max_size:
+                    # Reserve the slot, the connection is opened outside the lock
+                    self._size += 1
+                    break
+                if self._idle:
+                    # Pool is full but idle channels are in the other mode, replace one of them
+                    self._discard(self._idle.popleft())
+                    continue
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise AMQPConnectionError(
+                        f"Timed out waiting for a pooled channel (max_size={self.max_size})"
+                    )
+                self._condition.wait(remaining)
+
+        try:
+            return self._create(transactional)
+        except Exception:
+            with self._condition:
+                self._size -= 1
+                self._condition.notify()
+            raise
+
+    def release(self, item, discard=False):
+        with self._condition:
+            # Channels leased before a fork belong to the parent process
+            if item.pid != self._pid:
+                return
+            if discard or not item.is_open:
+                self._discard(item)
+            else:
+                item.last_used = time.monotonic()
+                self._idle.append(item)
+            self._condition.notify()
+
+    @contextmanager
+    def channel(self, transactional=False):
+        item = self.acquire(transactional)
+        try:
+            yield item
+        except Exception:
+            self.release(item, discard=not item.is_open)
+            raise
+        else:
+            self.release(item)
+
+    def close(self):
+        with self._condition:
+            while self._idle:
+                self._discard(self._idle.pop())
+
+    def _create(self, transactional):
+        connection = pika.BlockingConnection(self.parameters)
+        channel = connection.channel()
+        if transactional:
+            channel.tx_select()
+        return PooledChannel(connection, channel, transactional)
+
+    def _take_idle(self, transactional):
+        while True:
+            item = next(
+                (i for i in reversed(self._idle) if i.transactional == transactional),
+                None,
+            )
+            if item is None:
+                return None
+            self._idle.remove(item)
+            if self._is_alive(item):
+                return item
+            self._discard(item)
+
+    def _is_alive(self, item):
+        if not item.is_open:
+            return False
+        try:
+            # Handle pending frames (heartbeats, broker initiated close) without blocking
+            item.connection.process_data_events(time_limit=0)
+        except Exception:
+            return False
+        return item.is_open
+
+    def _evict_idle(self):
+        now = time.monotonic()
+        while self._idle and now - self._idle[0].last_used > self.idle_timeout:
+            self._discard(self._idle.popleft())
+
+    def _discard(self, item):
+        self._size -= 1
+        item.close()
+
+    def _reset_after_fork(self):
+        # A forked child (e.g. a gunicorn worker) shares the parent's sockets. They are dropped
+        # without closing, sending a close frame would tear down the parent's connections.
+        if self._pid != os.getpid():
+            self._idle.clear()
+            self._size = 0
+            self._pid = os.getpid()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def _reset_pools_after_fork():
+    global _pools_lock
+    # Locks may have been held by another thread of the parent at fork time
+    _pools_lock = threading.Lock()
+    _pools.clear()
+
+
+os.register_at_fork(after_in_child=_reset_pools_after_fork)
+
+
+# Get the process-wide channel pool for the given connection parameters
+def get_pool(parameters=None):
+    parameters = parameters or get_connection_parameters()
+    key = (
+        parameters.host,
+        parameters.port,
+        parameters.virtual_host,
+        parameters.credentials.username,
+    )
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = ChannelPool(
+                parameters,
+                max_size=settings.RABBITMQ_POOL_MAX_SIZE,
+                idle_timeout=settings.RABBITMQ_POOL_IDLE_TIMEOUT,
+                acquire_timeout=settings.RABBITMQ_POOL_ACQUIRE_TIMEOUT,
+            )
+            _pools[key] = pool
+        return pool
@@ -0,0 +1,203 @@
+import atexit
+import logging
+import os
+import threading
+import time
+from collections import Counter
+from django import db
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, F
+from django.utils import timezone
+from .models import Task, TaskCounter, TaskCounterReconciliation
+
+logger = logging.getLogger("task_manager")
+
+# Task counts by status, priority and recurrence type, read by the stats endpoint without touching
+# the task table. Every write that creates, deletes or moves tasks between those keys records its
+# deltas here once its transaction commits. Deltas are buffered per process and added to the counter
+# rows every TASK_COUNTERS_FLUSH_INTERVAL seconds, so concurrent workers do not all queue up on the
+# same few rows. Counts lag by up to one flush interval. Deltas lost to a crash, or writes that bypass
+# this module, are corrected by reconcile(), which the scheduler runs periodically. A recount already
+# includes the deltas other processes still buffer, so every delta carries the time it was recorded
+# and a flush drops the ones recorded before the last recount.
+
+KEY_FIELDS = ("status", "priority", "recurrence_type")
+
+# (time recorded, deltas) of the deltas waiting for the next flush
+_pending = []
+_lock = threading.Lock()
+_flusher_pid = None
+
+
+def key(task, status=None):
+    return (status or task.status, task.priority, task.recurrence_type)
+
+
+# Deltas of tasks moving from the `keys` they had to `status`
+def moved(keys, status):
+    deltas = Counter()
+    for old in keys:
+        if old[0] != status:
+            deltas[old] -= 1
+            deltas[(status, *old[1:])] += 1
+    return deltas
+
+
+def created(tasks):
+    record(Counter(key(task) for task in tasks))
+
+
+def deleted(tasks):
+    deltas = Counter()
+    deltas.subtract(key(task) for task in tasks)
+    record(deltas)
+
+
+# Add deltas once the current transaction commits, they are dropped when it rolls back
+def record(deltas):
+    if deltas:
+        transaction.on_commit(lambda: add(deltas))
+
+
+# Move the tasks of `queryset` to `status` and record it, the rows are locked while their keys are read
+def update(queryset, status, **values):
+    with transaction.atomic():
+        keys = list(queryset.select_for_update().values_list(*KEY_FIELDS))
+        count = queryset.update(status=status, **values)
+        record(moved(keys, status))
+    return count
+
+
+# Buffer committed deltas until the next flush
+def add(deltas):
+    global _pending, _flusher_pid
+    with _lock:
+        if _flusher_pid != os.getpid():
+            # A forked child starts with a copy of its parent's buffer, the parent flushes those
+            _pending = []
+            _flusher_pid = os.getpid()
+            start = settings.TASK_COUNTERS_FLUSH_INTERVAL > 0
+        else:
+            start = False
+        _pending.append((time.time(), Counter(deltas)))
+    if settings.TASK_COUNTERS_FLUSH_INTERVAL <= 0:
+        flush()
+    elif start:
+        threading.Thread(
+            target=_flush_periodically, name="task-counters", daemon=True
+        ).start()
+        atexit.register(flush)
+
+
+def _flush_periodically():
+    while True:
+        time.sleep(settings.TASK_COUNTERS_FLUSH_INTERVAL)
+        db.close_old_connections()
+        try:
+            flush()
+        except Exception as e:
+            logger.error(f"Failed to flush task counters: {e}")
+
+
+# Add the buffered deltas to the counter rows, one UPDATE per changed key
+# The reconciliation row is locked first, so a recount cannot commit between reading its time and
+# applying the deltas
+def flush():
+    global _pending
+    with _lock:
+        entries, _pending = _pending, []
+    if not entries:
+        return
+    try:
+        with transaction.atomic():
+            reconciled_at = (
+                TaskCounterReconciliation.objects.select_for_update()
+                .filter(pk=1)
+                .values_list("reconciled_at", flat=True)
+                .first()
+            )
+            since = reconciled_at.timestamp() if reconciled_at else 0
+            deltas = Counter()
+            for recorded_at, entry in entries:
+                if recorded_at >= since:
+                    deltas.update(entry)
+            for (status, priority, recurrence_type), delta in sorted(deltas.items()):
+                if not delta:
+                    continue
+                lookup = {
+                    "status": status,
+                    "priority": priority,
+                    "recurrence_type": recurrence_type,
+                }
+                if not TaskCounter.objects.filter(**lookup).update(
+                    count=F("count") + delta
+                ):
+                    TaskCounter.objects.bulk_create(
+                        [TaskCounter(**lookup)], ignore_conflicts=True
+                    )
+                    TaskCounter.objects.filter(**lookup).update(
+                        count=F("count") + delta
+                    )
+    except Exception:
+        # Keep the deltas for the next flush
+        with _lock:
+            _pending[:0] = entries
+        raise
+
+
+# Recompute the counters from the task table and return how many of them were wrong
+# The recount includes the deltas other processes still buffer, its start time tells their flushes to
+# drop them. Only changes committed within moments of the recount can still be counted twice.
+def reconcile():
+    with transaction.atomic():
+        # Waits for running flushes, later ones drop what the recount includes
+        TaskCounterReconciliation.objects.update_or_create(
+            pk=1, defaults={"reconciled_at": timezone.now()}
+        )
+        counters = {
+            (counter.status, counter.priority, counter.recurrence_type): counter
+            for counter in TaskCounter.objects.select_for_update()
+        }
+        actual = {
+            tuple(row[:-1]): row[-1]
+            for row in Task.objects.values(*KEY_FIELDS)
+            .annotate(count=Count("id"))
+            .values_list(*KEY_FIELDS, "count")
+        }
+        wrong = []
+        for counter_key in set(counters) | set(actual):
+            counter = counters.get(counter_key)
+            count = actual.get(counter_key, 0)
+            if counter is None:
+                counter = TaskCounter(
+                    **dict(zip(KEY_FIELDS, counter_key)), count=count
+                )
+                wrong.append(counter)
+            elif counter.count != count:
+                counter.count = count
+                wrong.append(counter)
+        TaskCounter.objects.bulk_create([c for c in wrong if c.pk is None])
+        TaskCounter.objects.bulk_update([c for c in wrong if c.pk], ["count"])
+    if wrong:
+        logger.warning(f"Reconciled {len(wrong)} task counters")
+    return len(wrong)
+
+
+# Totals of the stats endpoint, read from a few dozen counter rows
+def totals():
+    by_status = Counter()
+    by_priority = Counter()
+    by_recurrence_type = Counter()
+    for status, priority, recurrence_type, count in TaskCounter.objects.filter(
+        count__gt=0
+    ).values_list(*KEY_FIELDS, "count"):
+        by_status[status] += count
+        by_priority[priority] += count
+        by_recurrence_type[recurrence_type] += count
+    return {
+        "total": sum(by_status.values()),
+        "by_status": dict(by_status),
+        "by_priority": dict(by_priority),
+        "by_recurrence_type": dict(by_recurrence_type),
+    }
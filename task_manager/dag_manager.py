@@ -1,74 +1,138 @@
 from collections import deque
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F, Q, QuerySet
+from .models import DependencyGraphVersion, Task, TaskDependencyClosure
 
 
 class CyclicDependencyException(Exception):
     def __init__(self, cycle):
         self.cycle = cycle
-        cycle_str = " -> ".join(task_id for task_id in cycle)
+        cycle_str = " -> ".join(str(task_id) for task_id in cycle)
         super().__init__(f"Cyclic dependency detected: {cycle_str}")
 
 
 class DAGManager:
+    # Load the direct (task_id, dependency_id) edges between the given tasks in a single query
+    # Edges to tasks outside of `tasks` are left out
     @staticmethod
-    def get_execution_order(tasks):
-        # Create a dictionary mapping task IDs to tasks
-        task_dict = {str(task.id): task for task in tasks}
-        # Graph represents dependencies: key is the task ID, value is a list of task IDs it depends on
-        graph = {
-            str(task.id): [
-                str(dependency.id) for dependency in task.get_all_dependencies()
-            ]
-            for task in tasks
-        }
+    def load_edges(tasks):
+        TaskDependency = Task.dependencies.through
+        edges = TaskDependency.objects.values_list("from_task_id", "to_task_id")
+        if isinstance(tasks, QuerySet):
+            # Let the database resolve the task set instead of sending every id back to it
+            task_ids = tasks.values("pk")
+            edges = edges.filter(from_task_id__in=task_ids, to_task_id__in=task_ids)
+            return list(edges.iterator(chunk_size=10000))
+        task_ids = {task.id for task in tasks}
+        return [
+            (task_id, dependency_id)
+            for task_id, dependency_id in edges.filter(from_task_id__in=task_ids)
+            if dependency_id in task_ids
+        ]
 
-        # Reverse graph represents dependents: key is the task ID, value is a list of task IDs that depend on it
-        reverse_graph = {task_id: [] for task_id in graph}
-        for task_id in graph:
-            for dependent_id in graph[task_id]:
-                reverse_graph[dependent_id].append(task_id)
+    # Order the nodes so that every node comes after the nodes it depends on, in O(V + E)
+    # `edges` are (node, dependency) pairs. Nodes that are ready at the same time keep their input order.
+    @staticmethod
+    def topological_sort(nodes, edges):
+        nodes = list(nodes)
+        # dependents maps a node to the nodes that depend on it, in_degree counts unfinished dependencies
+        dependents = {node: [] for node in nodes}
+        in_degree = dict.fromkeys(nodes, 0)
+        for node, dependency in edges:
+            dependents[dependency].append(node)
+            in_degree[node] += 1
+
+        # Kahn's algorithm: repeatedly take a node whose dependencies have all been ordered
+        queue = deque(node for node in nodes if in_degree[node] == 0)
+        order = []
+        while queue:
+            node = queue.popleft()
+            order.append(node)
+            for dependent in dependents[node]:
+                in_degree[dependent] -= 1
+                if in_degree[dependent] == 0:
+                    queue.append(dependent)
 
-        # Find a cycle in the graph
-        def find_cycle(node, path):
-            if node in path:
-                return path[path.index(node) :]
+        if len(order) != len(nodes):
+            raise CyclicDependencyException(DAGManager._find_cycle(in_degree, edges))
+        return order
+
+    # Extract one cycle from the nodes Kahn's algorithm could not order
+    @staticmethod
+    def _find_cycle(in_degree, edges):
+        # Every unordered node still has an unordered dependency, so following any of them
+        # from any unordered node must run into a node that was already visited
+        next_dependency = {}
+        for node, dependency in edges:
+            if in_degree[node] > 0 and in_degree[dependency] > 0:
+                next_dependency.setdefault(node, dependency)
+
+        node = next(iter(next_dependency))
+        position = {}
+        path = []
+        while node not in position:
+            position[node] = len(path)
             path.append(node)
-            for neighbor in graph.get(node, []):
-                cycle = find_cycle(neighbor, path.copy())
-                if cycle:
-                    return cycle
-            return None
+            node = next_dependency[node]
+        return path[position[node] :]
 
-        for task_id in graph:
-            cycle = find_cycle(task_id, [])
-            if cycle:
-                raise CyclicDependencyException(cycle)
+    @staticmethod
+    def get_execution_order(tasks):
+        # Create a dictionary mapping task IDs to tasks
+        task_dict = {task.id: task for task in tasks}
+        edges = DAGManager.load_edges(tasks)
+        return [
+            task_dict[task_id]
+            for task_id in DAGManager.topological_sort(task_dict, edges)
+        ]
 
-        # degree is a dictionary where the key is the task and the value is the number of dependencies it has
-        # It represents the number of tasks that need to be completed before this task can be executed
-        in_degree = {
-            task_id: len(dependencies) for task_id, dependencies in graph.items()
-        }
+    # Ids of the tasks in execution order, without loading the tasks themselves
+    @staticmethod
+    def get_execution_order_ids(tasks):
+        task_ids = list(tasks.values_list("pk", flat=True))
+        return DAGManager.topological_sort(task_ids, DAGManager.load_edges(tasks))
 
-        # Initialize a queue with tasks that have no dependencies
-        # Tasks with no dependencies are the ones that can be executed first
-        queue = deque([task_id for task_id in graph if in_degree[task_id] == 0])
-        execution_order = []
+    # Version of the dependency graph, it changes whenever a task or a dependency edge is added or removed
+    # Kept in the database so every process agrees on it, whatever cache backend is configured. Reading
+    # it is a primary key lookup, task_manager.signals bumps it.
+    @staticmethod
+    def get_version():
+        version = (
+            DependencyGraphVersion.objects.filter(pk=1)
+            .values_list("version", flat=True)
+            .first()
+        )
+        return str(version or 0)
 
-        # Perform a topological sort on the graph
-        while queue:
-            # Get the task with no dependencies
-            task_id = queue.popleft()
-            # Add the task to the execution order
-            execution_order.append(task_dict[task_id])
+    # Bump the version once the current transaction commits, the row is only locked by the UPDATE itself
+    @staticmethod
+    def bump_version():
+        transaction.on_commit(DAGManager._increment_version)
 
-            # Reduce the in-degree of tasks that depend on the current task
-            for dependent_id in reverse_graph[task_id]:
-                if dependent_id in in_degree:
-                    in_degree[dependent_id] -= 1
-                    if in_degree[dependent_id] == 0:
-                        queue.append(dependent_id)
+    @staticmethod
+    def _increment_version():
+        updated = DependencyGraphVersion.objects.filter(pk=1).update(
+            version=F("version") + 1
+        )
+        if not updated:
+            DependencyGraphVersion.objects.get_or_create(pk=1, defaults={"version": 1})
 
-        # If there is a cycle, the length of execution_order will be less than the length of tasks
-        if len(execution_order) != len(tasks):
-            raise CyclicDependencyException([])
-        return execution_order
+    # Execution order of every task, or of `root_id` and everything it depends on
+    # Returns the graph version and the ordered task ids, which are cached per graph version
+    @staticmethod
+    def get_cached_execution_order(root_id=None):
+        version = DAGManager.get_version()
+        key = f"task_execution_order:{version}:{root_id or 'all'}"
+        order = cache.get(key)
+        if order is None:
+            tasks = Task.objects.order_by("created_at", "id")
+            if root_id:
+                dependency_ids = TaskDependencyClosure.objects.filter(
+                    task_id=root_id
+                ).values("dependency_id")
+                tasks = tasks.filter(Q(pk=root_id) | Q(pk__in=dependency_ids))
+            order = DAGManager.get_execution_order_ids(tasks)
+            cache.set(key, order, settings.TASK_EXECUTION_ORDER_CACHE_TIMEOUT)
+        return version, order
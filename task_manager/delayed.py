@@ -0,0 +1,98 @@
+import math
+from django.conf import settings
+
+# Delayed delivery through a cascade of TTL queues, one per power of two seconds.
+# A delay of n seconds is written in binary in the routing key, followed by the destination queue:
+# "0.0.1.0.1.task_queue" waits 4s and then 1s. The message enters at the exchange of the highest level
+# and every level either parks it in its queue, when its bit is set, or passes it straight down to the
+# next level. A parked message is dead-lettered to the next level once the queue TTL expires.
+# Every queue has a single fixed TTL, so messages expire in the order they were parked and a long delay
+# never holds back a shorter one. Delays are rounded up to whole seconds.
+
+LEVEL_NAME = "task_delay.level.{}"
+DELIVERY_EXCHANGE = "task_delay.deliver"
+
+
+def levels():
+    return settings.RABBITMQ_DELAY_LEVELS
+
+
+def max_delay():
+    # Longest delay in milliseconds
+    return ((1 << levels()) - 1) * 1000
+
+
+def entry_exchange():
+    return LEVEL_NAME.format(levels() - 1)
+
+
+# Routing key that delays a message by `delay` milliseconds before delivering it to `queue`
+def routing_key(queue, delay):
+    if delay > max_delay():
+        raise ValueError(
+            f"Delay of {delay}ms exceeds the longest supported delay of {max_delay()}ms"
+        )
+    seconds = math.ceil(delay / 1000)
+    bits = format(seconds, f"0{levels()}b")
+    return ".".join(bits) + "." + queue
+
+
+# Declarations of the level exchanges and queues, as (channel method, kwargs) pairs
+def topology():
+    count = levels()
+    operations = [
+        (
+            "exchange_declare",
+            {"exchange": DELIVERY_EXCHANGE, "exchange_type": "topic", "durable": True},
+        )
+    ]
+    for level in range(count):
+        name = LEVEL_NAME.format(level)
+        operations.append(
+            (
+                "exchange_declare",
+                {"exchange": name, "exchange_type": "topic", "durable": True},
+            )
+        )
+
+    for level in range(count):
+        name = LEVEL_NAME.format(level)
+        below = LEVEL_NAME.format(level - 1) if level > 0 else DELIVERY_EXCHANGE
+        # Bit of this level in the routing key, the most significant bit comes first
+        prefix = "*." * (count - 1 - level)
+        operations += [
+            (
+                "queue_declare",
+                {
+                    "queue": name,
+                    "durable": True,
+                    "arguments": {
+                        "x-message-ttl": (1 << level) * 1000,
+                        "x-dead-letter-exchange": below,
+                    },
+                },
+            ),
+            (
+                "queue_bind",
+                {"queue": name, "exchange": name, "routing_key": f"{prefix}1.#"},
+            ),
+            (
+                "exchange_bind",
+                {"destination": below, "source": name, "routing_key": f"{prefix}0.#"},
+            ),
+        ]
+    return operations
+
+
+# Binding that delivers messages whose delay has elapsed to `queue`
+def destination(queue):
+    return [
+        (
+            "queue_bind",
+            {
+                "queue": queue,
+                "exchange": DELIVERY_EXCHANGE,
+                "routing_key": "*." * levels() + queue,
+            },
+        )
+    ]
@@ -0,0 +1,203 @@
+import logging
+from collections import Counter
+from django.db import transaction
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from .models import Task, TaskDependencyClosure
+from . import counters
+
+logger = logging.getLogger("task_manager")
+
+# Event-driven dependency release and scheduling
+# A task whose direct dependencies have not all completed is parked as waiting instead of being published.
+# Its pending_dependencies counter is recomputed whenever one of those dependencies completes and the
+# task is published as soon as the counter reaches zero. Counters are always recomputed from the
+# dependency statuses under a row lock on the waiting task, so submitters and completing dependencies
+# racing each other cannot lose an update or release a task twice.
+# A task whose scheduled time lies ahead is parked as scheduled and published by the scheduler once due.
+# A task that is cancelled or fails for good can never complete, the tasks waiting for it directly or
+# indirectly end with the same status, see settle_dependents.
+
+
+def _pending_dependencies():
+    # Number of direct dependencies of the outer task that have not completed yet
+    TaskDependency = Task.dependencies.through
+    pending = (
+        TaskDependency.objects.filter(from_task_id=OuterRef("pk"))
+        .exclude(to_task__status=Task.STATUS_COMPLETED)
+        .values("from_task_id")
+        .annotate(count=Count("pk"))
+        .values("count")
+    )
+    return Coalesce(Subquery(pending), 0)
+
+
+# Recompute the counters of locked tasks, park the ones still waiting for dependencies or for their
+# scheduled time and claim the rest as queued
+# Must run inside a transaction holding the row locks of `task_ids`
+def _hold_or_claim(task_ids):
+    if not task_ids:
+        return []
+    now = timezone.now()
+    Task.objects.filter(id__in=task_ids).update(
+        pending_dependencies=_pending_dependencies()
+    )
+    targets = {
+        Task.STATUS_WAITING: [],
+        Task.STATUS_SCHEDULED: [],
+        Task.STATUS_QUEUED: [],
+    }
+    deltas = Counter()
+    for task_id, pending, scheduled_at, *key in Task.objects.filter(
+        id__in=task_ids
+    ).values_list("id", "pending_dependencies", "scheduled_at", *counters.KEY_FIELDS):
+        if pending > 0:
+            status = Task.STATUS_WAITING
+        elif scheduled_at is not None and scheduled_at > now:
+            status = Task.STATUS_SCHEDULED
+        else:
+            status = Task.STATUS_QUEUED
+        targets[status].append(task_id)
+        deltas.update(counters.moved([tuple(key)], status))
+    for status, ids in targets.items():
+        if ids:
+            Task.objects.filter(id__in=ids).update(status=status, updated_at=now)
+    counters.record(deltas)
+    return list(Task.objects.filter(id__in=targets[Task.STATUS_QUEUED]))
+
+
+# Claim submitted tasks and return the ones that can be published now
+# Pending dependencies of the tasks are submitted along with them. Tasks that are no longer pending were
+# already claimed by another submitter and are skipped.
+def claim_for_submission(tasks):
+    task_ids = {task.id for task in tasks}
+    task_ids |= set(
+        Task.objects.filter(
+            dependent_closure__task_id__in=task_ids, status=Task.STATUS_PENDING
+        ).values_list("id", flat=True)
+    )
+    with transaction.atomic():
+        locked_ids = list(
+            Task.objects.select_for_update()
+            .filter(id__in=task_ids, status=Task.STATUS_PENDING)
+            .values_list("id", flat=True)
+        )
+        return _hold_or_claim(locked_ids)
+
+
+# Give claimed tasks back when publishing them failed, so they can be submitted again
+def revert_submission(tasks):
+    counters.update(
+        Task.objects.filter(
+            id__in=[task.id for task in tasks], status=Task.STATUS_QUEUED
+        ),
+        Task.STATUS_PENDING,
+        updated_at=timezone.now(),
+    )
+
+
+# Park a delivered task whose dependencies have not all completed
+# Returns False when every dependency has completed and the task can run
+def hold_for_dependencies(task):
+    with transaction.atomic():
+        list(Task.objects.select_for_update().filter(id=task.id).values_list("id"))
+        Task.objects.filter(id=task.id).update(
+            pending_dependencies=_pending_dependencies()
+        )
+        held = Task.objects.filter(id=task.id, pending_dependencies__gt=0).update(
+            status=Task.STATUS_WAITING, updated_at=timezone.now()
+        )
+        if held:
+            counters.record(
+                counters.moved([counters.key(task)], Task.STATUS_WAITING)
+            )
+    if held:
+        task.status = Task.STATUS_WAITING
+    return bool(held)
+
+
+# Publish the waiting dependents of a completed task whose dependencies have now all completed
+def release_dependents(task, queue_manager):
+    with transaction.atomic():
+        waiting_ids = set(
+            Task.objects.select_for_update(of=("self",))
+            .filter(dependencies__id=task.id, status=Task.STATUS_WAITING)
+            .values_list("id", flat=True)
+        )
+        released = _hold_or_claim(waiting_ids)
+    return _publish_released(released, queue_manager)
+
+
+# Give the waiting tasks that depend on a cancelled or failed task, directly or indirectly, its status
+# Their dependency can never complete, without this they would wait forever. Returns their number.
+def settle_dependents(task):
+    count = counters.update(
+        Task.objects.filter(
+            id__in=TaskDependencyClosure.objects.filter(
+                dependency_id=task.id
+            ).values("task_id"),
+            status=Task.STATUS_WAITING,
+        ),
+        task.status,
+        updated_at=timezone.now(),
+    )
+    if count:
+        logger.warning(
+            f"{count} tasks waiting for task {task.id} are {task.status} with it"
+        )
+    return count
+
+
+# Safety net: recompute the counters of every waiting task and publish the ones that are ready
+def release_waiting_tasks(queue_manager):
+    with transaction.atomic():
+        waiting_ids = list(
+            Task.objects.select_for_update()
+            .filter(status=Task.STATUS_WAITING)
+            .values_list("id", flat=True)
+        )
+        released = _hold_or_claim(waiting_ids)
+    return _publish_released(released, queue_manager)
+
+
+# Publish the given scheduled tasks that are due
+# The status moves from scheduled to queued under a row lock, so every due time is published once even
+# with several schedulers running. Rows locked by another scheduler are skipped.
+def release_scheduled(task_ids, queue_manager):
+    with transaction.atomic():
+        due_ids = list(
+            Task.objects.select_for_update(skip_locked=True)
+            .filter(
+                id__in=task_ids,
+                status=Task.STATUS_SCHEDULED,
+                scheduled_at__lte=timezone.now(),
+            )
+            .values_list("id", flat=True)
+        )
+        released = _hold_or_claim(due_ids)
+    return _publish_released(released, queue_manager, Task.STATUS_SCHEDULED)
+
+
+# Park a delivered task whose scheduled time has not come yet, the scheduler publishes it when it is due
+def schedule(task):
+    return task.transition(Task.STATUS_SCHEDULED)
+
+
+def _publish_released(released, queue_manager, revert_status=Task.STATUS_WAITING):
+    if not released:
+        return []
+    try:
+        queue_manager.publish_tasks(released)
+    except Exception:
+        # Park them again, they are picked up again once the broker is reachable
+        counters.update(
+            Task.objects.filter(
+                id__in=[task.id for task in released], status=Task.STATUS_QUEUED
+            ),
+            revert_status,
+            updated_at=timezone.now(),
+        )
+        raise
+    logger.info(f"Released {len(released)} tasks")
+    return released
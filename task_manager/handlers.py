@@ -0,0 +1,324 @@
+import asyncio
+import importlib
+import inspect
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+from concurrent.futures import Future, InvalidStateError
+from asgiref.sync import async_to_sync, sync_to_async
+from django import db
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from . import cancellation
+
+logger = logging.getLogger("task_manager")
+
+# Task handlers, keyed by the task_type of the tasks they run.
+# Handlers are registered with the @handler decorator in the modules listed in TASK_HANDLER_MODULES.
+# Workers import those modules and run their warm-up functions once at startup, so running a task
+# costs a dict lookup and the call of its handler. A task type can have a plain and a coroutine
+# implementation, each engine calls the one it runs natively and falls back to the other.
+# `concurrency` limits how many tasks of a type run at once across all slots of a worker, a task that
+# finds every slot of its handler taken raises HandlerBusy instead of holding its execution slot.
+# `soft_time_limit` and `time_limit` are the default time limits of its tasks, see cancellation.py.
+
+DEFAULT_TASK_TYPE = "default"
+
+
+class UnknownTaskType(LookupError):
+    pass
+
+
+# Every concurrency slot of the task's handler is taken, the worker defers the task
+class HandlerBusy(RuntimeError):
+    pass
+
+
+# The worker holds too many abandoned task threads to take more tasks
+class WorkerExhausted(RuntimeError):
+    pass
+
+
+class Handler:
+    def __init__(
+        self,
+        name,
+        concurrency=None,
+        soft_time_limit=None,
+        time_limit=None,
+        warm_up=None,
+    ):
+        self.name = name
+        self.func = None
+        self.async_func = None
+        self.concurrency = concurrency
+        self.soft_time_limit = soft_time_limit
+        self.time_limit = time_limit
+        self.warm_up = warm_up
+        # Created before the process pool forks, so its children share the limit
+        self.slots = None
+        if concurrency:
+            self.slots = multiprocessing.get_context("fork").BoundedSemaphore(
+                concurrency
+            )
+        self._async_slots = None
+
+    def call(self, task):
+        if self.func is not None:
+            return self.func(task)
+        return async_to_sync(self.async_func)(task)
+
+    async def acall(self, task):
+        if self.async_func is not None:
+            return await self.async_func(task)
+        return await sync_to_async(self.func, thread_sensitive=False)(task)
+
+    # Never waits, a worker thread blocked on a busy handler could run a task of another type
+    def acquire(self):
+        if self.slots is not None and not self.slots.acquire(block=False):
+            raise HandlerBusy(
+                f"All {self.concurrency} slots of task handler {self.name} are taken"
+            )
+
+    def release(self):
+        if self.slots is not None:
+            self.slots.release()
+
+    def async_slots(self):
+        # The asyncio worker is a single process, a semaphore of its loop limits coroutine handlers
+        # without blocking the loop
+        if self._async_slots is None:
+            self._async_slots = asyncio.Semaphore(self.concurrency)
+        return self._async_slots
+
+
+_registry = {}
+_loaded = False
+_lock = threading.Lock()
+# Handler threads still running after their execution slot stopped waiting for them
+_abandoned = set()
+_abandoned_lock = threading.Lock()
+_exhausted = False
+
+
+# Register the decorated function as the handler of `name`
+# A second registration of the same name is only allowed for the other kind of function
+def handler(
+    name=DEFAULT_TASK_TYPE,
+    concurrency=None,
+    soft_time_limit=None,
+    time_limit=None,
+    warm_up=None,
+):
+    def register(func):
+        registered = _registry.get(name)
+        if registered is None:
+            registered = _registry[name] = Handler(
+                name,
+                concurrency=concurrency,
+                soft_time_limit=soft_time_limit,
+                time_limit=time_limit,
+                warm_up=warm_up,
+            )
+        elif concurrency or soft_time_limit or time_limit or warm_up:
+            raise ImproperlyConfigured(
+                f"Options of task handler {name} must be given at its first registration"
+            )
+        attribute = "async_func" if inspect.iscoroutinefunction(func) else "func"
+        if getattr(registered, attribute) is not None:
+            raise ImproperlyConfigured(f"Task handler {name} is already registered")
+        setattr(registered, attribute, func)
+        return func
+
+    return register
+
+
+# Import the handler modules once and return the registry
+def load():
+    global _loaded
+    with _lock:
+        if not _loaded:
+            for module in settings.TASK_HANDLER_MODULES:
+                importlib.import_module(module)
+            _loaded = True
+            logger.info(f"Loaded task handlers: {', '.join(sorted(_registry))}")
+    return _registry
+
+
+# Run the warm-up functions of every handler, once per process that executes tasks
+def warm_up():
+    for registered in load().values():
+        if registered.warm_up is not None:
+            registered.warm_up()
+
+
+def get(task_type):
+    try:
+        return load()[task_type]
+    except KeyError:
+        raise UnknownTaskType(f"No handler is registered for task type {task_type}")
+
+
+# Soft and hard time limit of a task: its own, else its handler's, else the defaults of the settings
+def limits(registered, task):
+    soft_time_limit = task.soft_time_limit
+    if soft_time_limit is None:
+        soft_time_limit = registered.soft_time_limit
+    if soft_time_limit is None:
+        soft_time_limit = settings.TASK_SOFT_TIME_LIMIT
+    time_limit = task.time_limit
+    if time_limit is None:
+        time_limit = registered.time_limit
+    if time_limit is None:
+        time_limit = settings.TASK_TIME_LIMIT
+    return soft_time_limit, time_limit
+
+
+# Run a task with its handler, within the handler's concurrency limit and the task's time limits
+def run(task):
+    registered = get(task.task_type)
+    soft_time_limit, time_limit = limits(registered, task)
+    if time_limit and threading.current_thread() is not threading.main_thread():
+        return _run_in_thread(registered, task, soft_time_limit, time_limit)
+    registered.acquire()
+    try:
+        # On the main thread of a solo worker or a pool process the hard limit is raised by a signal
+        with cancellation.running(task.id, soft_time_limit, time_limit):
+            return registered.call(task)
+    finally:
+        registered.release()
+
+
+async def arun(task):
+    registered = get(task.task_type)
+    if registered.async_func is None:
+        # Plain handlers run in a thread, with the limits of run()
+        return await sync_to_async(run, thread_sensitive=False)(task)
+    if registered.concurrency:
+        slots = registered.async_slots()
+        if slots.locked():
+            raise HandlerBusy(
+                f"All {registered.concurrency} slots of task handler "
+                f"{registered.name} are taken"
+            )
+        async with slots:
+            return await _arun(registered, task)
+    return await _arun(registered, task)
+
+
+# Interruptions cancel the coroutine, which can catch CancelledError to clean up. The hard limit and
+# cancellations also stop waiting for it.
+async def _arun(registered, task):
+    soft_time_limit, time_limit = limits(registered, task)
+    loop = asyncio.get_running_loop()
+    outcome = loop.create_future()
+
+    def interrupt(error, stop_waiting):
+        handler_task.cancel()
+        if stop_waiting and not outcome.done():
+            outcome.set_exception(error)
+
+    def finished(future):
+        if outcome.done():
+            return
+        if future.cancelled():
+            outcome.set_exception(execution.error or asyncio.CancelledError())
+        elif future.exception() is not None:
+            outcome.set_exception(future.exception())
+        else:
+            outcome.set_result(future.result())
+
+    with cancellation.running(
+        task.id,
+        soft_time_limit,
+        time_limit,
+        on_interrupt=lambda error, stop_waiting: loop.call_soon_threadsafe(
+            interrupt, error, stop_waiting
+        ),
+        raise_in_thread=False,
+    ) as execution:
+        handler_task = loop.create_task(registered.acall(task))
+        handler_task.add_done_callback(finished)
+        try:
+            return await outcome
+        except asyncio.CancelledError:
+            handler_task.cancel()
+            raise
+
+
+# Other threads cannot be interrupted by a signal: the handler runs in a thread of its own and the
+# execution slot stops waiting for it at the hard limit or when the task is cancelled. The abandoned
+# handler keeps its concurrency slot until it returns. Once TASK_MAX_ABANDONED_THREADS of them are
+# still running the worker refuses new tasks and stops, so that its supervisor restarts it.
+def _run_in_thread(registered, task, soft_time_limit, time_limit):
+    _check_abandoned()
+    outcome = Future()
+    returned = []
+
+    def stop(error, stop_waiting):
+        if stop_waiting:
+            _settle(outcome, error=error)
+
+    def target():
+        try:
+            with cancellation.running(
+                task.id, soft_time_limit, time_limit, on_interrupt=stop
+            ):
+                result = registered.call(task)
+            _settle(outcome, result=result)
+        except BaseException as e:
+            _settle(outcome, error=e)
+        finally:
+            registered.release()
+            db.connection.close()
+            with _abandoned_lock:
+                returned.append(True)
+                _abandoned.discard(threading.current_thread())
+
+    registered.acquire()
+    thread = threading.Thread(target=target, name=f"task-{task.id}", daemon=True)
+    try:
+        thread.start()
+    except Exception:
+        registered.release()
+        raise
+    try:
+        return outcome.result()
+    finally:
+        with _abandoned_lock:
+            if not returned:
+                _abandoned.add(thread)
+                logger.warning(
+                    f"Task {task.id} is still running after its execution slot gave up "
+                    f"on it, {len(_abandoned)} abandoned task threads"
+                )
+
+
+def _check_abandoned():
+    global _exhausted
+    with _abandoned_lock:
+        count = len(_abandoned)
+        if count < settings.TASK_MAX_ABANDONED_THREADS:
+            return
+        stop = not _exhausted
+        _exhausted = True
+    if stop:
+        logger.critical(
+            f"{count} abandoned task threads are still running, stopping the worker"
+        )
+        # Stops the worker like CTRL+C, its deliveries are redelivered to other workers
+        os.kill(os.getpid(), signal.SIGINT)
+    raise WorkerExhausted(f"{count} abandoned task threads are still running")
+
+
+# Resolve a future unless an interruption already did
+def _settle(future, result=None, error=None):
+    try:
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+    except InvalidStateError:
+        pass
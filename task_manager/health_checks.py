@@ -1,22 +1,12 @@
-import pika
-from django.conf import settings
 from .models import Task
+from .connection_pool import get_pool
 
 
+# Borrow a pooled connection, the pool checks its liveness before handing it out
 def check_rabbitmq_connection():
     try:
-        connection = pika.BlockingConnection(
-            pika.ConnectionParameters(
-                host=settings.RABBITMQ_HOST,
-                port=settings.RABBITMQ_PORT,
-                virtual_host=settings.RABBITMQ_VIRTUAL_HOST,
-                credentials=pika.PlainCredentials(
-                    settings.RABBITMQ_USERNAME, settings.RABBITMQ_PASSWORD
-                ),
-            )
-        )
-        connection.close()
-        return True
+        with get_pool().channel() as pooled:
+            return pooled.is_open
     except:
         return False
 
@@ -0,0 +1,225 @@
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import timedelta
+from django import db
+from django.conf import settings
+from django.db.models import Count
+from django.utils import timezone
+from .models import Task, WorkerHeartbeat
+
+logger = logging.getLogger("task_manager")
+
+# Worker heartbeats and the recovery of the tasks of dead workers.
+# Every worker process writes its WorkerHeartbeat row every WORKER_HEARTBEAT_INTERVAL seconds from a
+# thread of its own: its configuration, the deliveries it is running and its throughput. A worker that
+# claims a task records its id on the task. When a worker dies the broker redelivers its unacknowledged
+# messages, but their tasks are still in progress and the redeliveries are dropped as duplicates. A
+# worker without a heartbeat for WORKER_HEARTBEAT_TIMEOUT seconds is therefore marked dead by the
+# scheduler, which retries the tasks it left in progress, see recover_dead_workers().
+
+_worker_id = None
+
+
+# Id of the worker of this process, the pool processes a worker forks share the id of their parent
+def worker_id():
+    global _worker_id
+    if _worker_id is None:
+        _worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+    return _worker_id
+
+
+class Heartbeat:
+    # Deliveries of a worker and its periodic heartbeat.
+    # The consumer reports every delivery with started() and finished(), the heartbeat thread reads
+    # them under a lock and writes the row.
+    def __init__(self, queues, pool, concurrency, interval=None):
+        self.worker_id = worker_id()
+        self.queues = ",".join(f"{queue}:{weight}" for queue, weight in queues)
+        self.pool = pool
+        self.concurrency = concurrency
+        self.interval = interval or settings.WORKER_HEARTBEAT_INTERVAL
+        self.started_at = timezone.now()
+        # Task id of every running delivery, None when it could not be decoded
+        self._running = {}
+        self._processed = 0
+        self._requeued = 0
+        self._lock = threading.Lock()
+        # Monotonic time and processed count of the previous heartbeat
+        self._previous = (time.monotonic(), 0)
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def started(self, key, task_id):
+        with self._lock:
+            self._running[key] = task_id
+
+    def finished(self, key, requeued=False):
+        with self._lock:
+            self._running.pop(key, None)
+            self._processed += 1
+            if requeued:
+                self._requeued += 1
+
+    # Write the first heartbeat right away, so the worker shows up before it takes any task
+    def start(self):
+        self.beat()
+        self._thread = threading.Thread(
+            target=self._run, name="worker-heartbeat", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.beat(WorkerHeartbeat.STATUS_STOPPED)
+
+    def _run(self):
+        while not self._stopping.wait(self.interval):
+            db.close_old_connections()
+            self.beat()
+        db.connection.close()
+
+    # Failures are logged, a worker that cannot write its heartbeat keeps running its tasks
+    def beat(self, status=WorkerHeartbeat.STATUS_ALIVE):
+        with self._lock:
+            running = len(self._running)
+            running_tasks = [
+                str(task_id)
+                for task_id in self._running.values()
+                if task_id is not None
+            ]
+            processed = self._processed
+            requeued = self._requeued
+        now = time.monotonic()
+        previous_at, previous_processed = self._previous
+        self._previous = (now, processed)
+        throughput = 0.0
+        if now > previous_at:
+            throughput = (processed - previous_processed) / (now - previous_at)
+        try:
+            WorkerHeartbeat.objects.update_or_create(
+                id=self.worker_id,
+                defaults={
+                    "hostname": socket.gethostname(),
+                    "pid": os.getpid(),
+                    "pool": self.pool,
+                    "queues": self.queues,
+                    "concurrency": self.concurrency,
+                    "running": running,
+                    "running_tasks": running_tasks,
+                    "processed": processed,
+                    "requeued": requeued,
+                    "throughput": throughput,
+                    "status": status,
+                    "started_at": self.started_at,
+                    "last_seen": timezone.now(),
+                },
+            )
+        except Exception as e:
+            logger.error(
+                f"Failed to write the heartbeat of worker {self.worker_id}: {e}"
+            )
+
+
+# Workers by their last heartbeat, each with the number of tasks it has in progress
+# A worker whose heartbeats stopped is reported dead before the scheduler marks it so
+def fleet():
+    cutoff = timezone.now() - timedelta(seconds=settings.WORKER_HEARTBEAT_TIMEOUT)
+    in_progress = dict(
+        Task.objects.filter(status=Task.STATUS_IN_PROGRESS)
+        .exclude(worker="")
+        .values_list("worker")
+        .annotate(count=Count("id"))
+    )
+    workers = list(WorkerHeartbeat.objects.order_by("hostname", "started_at"))
+    for heartbeat in workers:
+        if (
+            heartbeat.status == WorkerHeartbeat.STATUS_ALIVE
+            and heartbeat.last_seen < cutoff
+        ):
+            heartbeat.status = WorkerHeartbeat.STATUS_DEAD
+        heartbeat.in_progress = in_progress.get(heartbeat.id, 0)
+    return workers
+
+
+# Totals of the live workers, and the tasks the dead ones left in progress
+def totals(workers):
+    by_status = Counter(heartbeat.status for heartbeat in workers)
+    alive = [
+        heartbeat
+        for heartbeat in workers
+        if heartbeat.status == WorkerHeartbeat.STATUS_ALIVE
+    ]
+    concurrency = sum(heartbeat.concurrency for heartbeat in alive)
+    running = sum(heartbeat.running for heartbeat in alive)
+    return {
+        "by_status": dict(by_status),
+        "concurrency": concurrency,
+        "running": running,
+        "utilization": running / concurrency if concurrency else 0.0,
+        "throughput": sum(heartbeat.throughput for heartbeat in alive),
+        "stuck_tasks": sum(
+            heartbeat.in_progress
+            for heartbeat in workers
+            if heartbeat.status == WorkerHeartbeat.STATUS_DEAD
+        ),
+    }
+
+
+# Mark the workers without a heartbeat for WORKER_HEARTBEAT_TIMEOUT seconds dead and retry the tasks
+# the dead workers left in progress. A task in progress on a dead worker counts as a failed attempt,
+# so a task that keeps killing its workers ends up dead-lettered. Returns the number of retried tasks.
+def recover_dead_workers():
+    # Imported here, the worker module imports this one
+    from .queue_manager import QueueManager
+    from .worker import REQUEUE, retry_or_dead_letter
+
+    now = timezone.now()
+    dead = WorkerHeartbeat.objects.filter(
+        status=WorkerHeartbeat.STATUS_ALIVE,
+        last_seen__lt=now - timedelta(seconds=settings.WORKER_HEARTBEAT_TIMEOUT),
+    ).update(status=WorkerHeartbeat.STATUS_DEAD)
+    if dead:
+        logger.warning(f"{dead} workers stopped sending heartbeats")
+
+    # Workers marked dead by an earlier pass are included, in case their recovery failed halfway
+    stuck = list(
+        Task.objects.filter(
+            status=Task.STATUS_IN_PROGRESS,
+            worker__in=WorkerHeartbeat.objects.filter(
+                status=WorkerHeartbeat.STATUS_DEAD
+            ).values("id"),
+        )
+    )
+    recovered = 0
+    if stuck:
+        with QueueManager() as queue_manager:
+            for task in stuck:
+                error = f"Worker {task.worker} stopped sending heartbeats"
+                dead_worker = task.worker
+                if retry_or_dead_letter(queue_manager, task, error) == REQUEUE:
+                    # The retry was not published and no message is left to redeliver, the task goes
+                    # back to in progress for the next pass. Only while the row still names the dead
+                    # worker: a live worker that claimed a redelivery meanwhile has put its own id there.
+                    task.transition(
+                        Task.STATUS_IN_PROGRESS,
+                        from_status=Task.STATUS_QUEUED,
+                        where={"worker": dead_worker},
+                        retry_count=task.retry_count - 1,
+                    )
+                    continue
+                recovered += 1
+        logger.warning(f"Recovered {recovered} tasks of dead workers")
+
+    WorkerHeartbeat.objects.filter(
+        status__in=[WorkerHeartbeat.STATUS_STOPPED, WorkerHeartbeat.STATUS_DEAD],
+        last_seen__lt=now - timedelta(seconds=settings.WORKER_HEARTBEAT_RETENTION),
+    ).delete()
+    return recovered
@@ -0,0 +1,54 @@
+import time
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand
+from task_manager import message_codecs
+from task_manager.models import Task
+
+
+class Command(BaseCommand):
+    help = "Compare message size and encode/decode cost of the task message codecs"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--count", type=int, default=20000, help="Messages per codec")
+        parser.add_argument(
+            "--description-size",
+            type=int,
+            default=2000,
+            help="Characters in every task description",
+        )
+
+    def handle(self, *args, **options):
+        count = options["count"]
+        # Unsaved tasks, the codecs only read their fields
+        tasks = [
+            Task(
+                title=f"Codec benchmark task {i}",
+                description="x" * options["description_size"],
+                priority=(i % 3) + 1,
+            )
+            for i in range(count)
+        ]
+
+        for name in message_codecs.CODECS:
+            try:
+                codec = message_codecs.get_codec(name)
+            except ImproperlyConfigured as e:
+                self.stdout.write(f"{name}: skipped ({e})")
+                continue
+            headers = {message_codecs.SCHEMA_HEADER: codec.version}
+
+            start = time.perf_counter()
+            bodies = [codec.encode(task) for task in tasks]
+            encode_elapsed = time.perf_counter() - start
+
+            start = time.perf_counter()
+            for body in bodies:
+                message_codecs.decode(body, codec.content_type, headers)
+            decode_elapsed = time.perf_counter() - start
+
+            size = sum(len(body) for body in bodies) / count
+            self.stdout.write(
+                f"{name}: {size:.0f} bytes/message, "
+                f"encode {encode_elapsed / count * 1e6:.2f}us, "
+                f"decode {decode_elapsed / count * 1e6:.2f}us"
+            )
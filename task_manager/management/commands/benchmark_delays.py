@@ -0,0 +1,92 @@
+import json
+import random
+import time
+from django.core.management.base import BaseCommand, CommandError
+from task_manager.connection_pool import get_pool
+from task_manager.queue_manager import QueueManager
+from task_manager.routing import QUEUE_ARGUMENTS
+
+
+class Command(BaseCommand):
+    help = "Measure the throughput and precision of delayed message delivery"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--count", type=int, default=2000, help="Messages to delay")
+        parser.add_argument(
+            "--min-delay", type=float, default=1, help="Shortest delay in seconds"
+        )
+        parser.add_argument(
+            "--max-delay", type=float, default=30, help="Longest delay in seconds"
+        )
+        parser.add_argument(
+            "--queue",
+            type=str,
+            default="benchmark_delay_queue",
+            help="Queue the delayed messages are delivered to",
+        )
+        parser.add_argument("--seed", type=int, default=42)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options["seed"])
+        count = options["count"]
+        queue_name = options["queue"]
+        delays = [
+            rng.uniform(options["min_delay"], options["max_delay"]) for _ in range(count)
+        ]
+
+        with get_pool().channel() as pooled:
+            pooled.declare_queue(queue_name, QUEUE_ARGUMENTS)
+            pooled.channel.queue_purge(queue_name)
+
+        # Every message carries the time it is due, delays are mixed so long ones are published first too
+        start = time.perf_counter()
+        with QueueManager(queue_name=queue_name) as queue_manager:
+            futures = []
+            for i, delay in enumerate(delays):
+                due = time.time() + delay
+                futures.append(
+                    queue_manager.publish_message(
+                        {"id": i, "due": due}, queue_name, delay=int(delay * 1000)
+                    )
+                )
+            QueueManager.wait_for_confirms(futures)
+        publish_elapsed = time.perf_counter() - start
+
+        lateness = self.consume(queue_name, count, options["max_delay"] + 30)
+        lateness.sort()
+
+        def percentile(p):
+            return lateness[min(len(lateness) - 1, int(len(lateness) * p))]
+
+        self.stdout.write(
+            f"published {count} delayed messages in {publish_elapsed:.2f}s "
+            f"({count / publish_elapsed:.0f} msgs/s)"
+        )
+        self.stdout.write(
+            f"lateness: min {lateness[0]:.3f}s, p50 {percentile(0.5):.3f}s, "
+            f"p95 {percentile(0.95):.3f}s, p99 {percentile(0.99):.3f}s, max {lateness[-1]:.3f}s"
+        )
+        early = sum(1 for value in lateness if value < 0)
+        if early:
+            raise CommandError(f"{early} messages were delivered before they were due")
+        self.stdout.write(self.style.SUCCESS("No message was delivered early"))
+
+    # Consume the delivered messages and return how late each one arrived, in seconds
+    def consume(self, queue_name, count, timeout):
+        lateness = []
+        deadline = time.monotonic() + timeout
+        with get_pool().channel() as pooled:
+            for method, properties, body in pooled.channel.consume(
+                queue_name, inactivity_timeout=1
+            ):
+                if method is not None:
+                    lateness.append(time.time() - json.loads(body)["due"])
+                    pooled.channel.basic_ack(method.delivery_tag)
+                if len(lateness) == count or time.monotonic() > deadline:
+                    break
+            pooled.channel.cancel()
+        if len(lateness) < count:
+            raise CommandError(
+                f"Only {len(lateness)} of {count} delayed messages were delivered"
+            )
+        return lateness
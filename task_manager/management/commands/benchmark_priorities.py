@@ -0,0 +1,125 @@
+import heapq
+import random
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from task_manager.routing import PRIORITY_LEVELS, AgingQueue
+
+# Share of the submitted tasks per priority level, high priority traffic dominates
+DEFAULT_MIX = "1:10,2:20,3:40,4:20,5:10"
+
+
+class Command(BaseCommand):
+    help = "Simulate an overloaded worker fleet and report the queueing time per priority level with strict and aging priorities"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--duration", type=float, default=3600, help="Simulated seconds of traffic"
+        )
+        parser.add_argument(
+            "--concurrency", type=int, default=16, help="Execution slots of the fleet"
+        )
+        parser.add_argument(
+            "--task-seconds", type=float, default=1, help="Mean run time of a task"
+        )
+        parser.add_argument(
+            "--load",
+            type=float,
+            default=1.05,
+            help="Offered load as a multiple of the fleet's capacity",
+        )
+        parser.add_argument(
+            "--mix",
+            type=str,
+            default=DEFAULT_MIX,
+            help="Share of the tasks per priority level, as level:share pairs",
+        )
+        parser.add_argument(
+            "--aging-interval",
+            type=float,
+            default=settings.TASK_PRIORITY_AGING_INTERVAL,
+            help="Seconds of waiting per priority level of the aging run",
+        )
+        parser.add_argument("--seed", type=int, default=42)
+
+    def handle(self, *args, **options):
+        mix = self.parse_mix(options["mix"])
+        if not options["aging_interval"]:
+            raise CommandError("The aging interval must be positive")
+        rate = options["load"] * options["concurrency"] / options["task_seconds"]
+        self.stdout.write(
+            f"{options['duration']:.0f}s of {rate:.1f} tasks/s on "
+            f"{options['concurrency']} slots of {options['task_seconds']}s tasks "
+            f"(load {options['load']})"
+        )
+        for label, aging_interval in (
+            ("strict", None),
+            (f"aging every {options['aging_interval']}s", options["aging_interval"]),
+        ):
+            waits, backlog = self.simulate(
+                random.Random(options["seed"]), mix, rate, aging_interval, options
+            )
+            self.report(label, waits, backlog, options["duration"])
+
+    def parse_mix(self, spec):
+        mix = {}
+        try:
+            for part in spec.split(","):
+                level, _, share = part.partition(":")
+                mix[int(level)] = float(share)
+        except ValueError:
+            raise CommandError(f"Invalid priority mix: {spec}")
+        unknown = set(mix) - set(PRIORITY_LEVELS)
+        if unknown:
+            raise CommandError(f"Unknown priority levels: {sorted(unknown)}")
+        return mix
+
+    # Run one simulation with Poisson arrivals and exponential run times, both drawn from `rng` in
+    # the same order for every policy. Returns the waits of the tasks that started, per level, and
+    # the ready times of the tasks still queued at the end.
+    def simulate(self, rng, mix, rate, aging_interval, options):
+        levels = list(mix)
+        shares = list(mix.values())
+        queue = AgingQueue(aging_interval)
+        waits = {level: [] for level in levels}
+        # Completion times of the running tasks
+        running = []
+        now = 0.0
+        next_arrival = rng.expovariate(rate)
+        while next_arrival < options["duration"]:
+            if running and running[0] <= next_arrival:
+                now = heapq.heappop(running)
+            else:
+                now = next_arrival
+                level = rng.choices(levels, shares)[0]
+                seconds = rng.expovariate(1 / options["task_seconds"])
+                queue.push((level, now, seconds), level, now)
+                next_arrival = now + rng.expovariate(rate)
+            while queue and len(running) < options["concurrency"]:
+                level, ready_at, seconds = queue.pop(now)
+                waits[level].append(now - ready_at)
+                heapq.heappush(running, now + seconds)
+        backlog = {level: [] for level in levels}
+        for level, ready_at, _ in queue.items():
+            backlog[level].append(ready_at)
+        return waits, backlog
+
+    def report(self, label, waits, backlog, duration):
+        self.stdout.write(self.style.SUCCESS(label))
+        for level in sorted(waits, reverse=True):
+            started = sorted(waits[level])
+            line = f"  priority {level}: {len(started)} started"
+            if started:
+
+                def percentile(p):
+                    return started[min(len(started) - 1, int(len(started) * p))]
+
+                line += (
+                    f", wait p50 {percentile(0.5):.1f}s, p95 {percentile(0.95):.1f}s, "
+                    f"p99 {percentile(0.99):.1f}s, max {started[-1]:.1f}s"
+                )
+            if backlog[level]:
+                line += (
+                    f"; {len(backlog[level])} still queued, "
+                    f"oldest for {duration - min(backlog[level]):.1f}s"
+                )
+            self.stdout.write(line)
@@ -0,0 +1,107 @@
+import time
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from task_manager import routing
+from task_manager.models import Task
+from task_manager.queue_manager import QueueManager
+from task_manager.serializers import TaskSerializer
+
+
+class Command(BaseCommand):
+    help = "Compare task submission throughput of the per-task and bulk paths"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--count", type=int, default=1000, help="Tasks per run")
+        parser.add_argument(
+            "--batch-size", type=int, default=500, help="Tasks per bulk request"
+        )
+        parser.add_argument(
+            "--queue",
+            type=str,
+            default="benchmark_task_queue",
+            help="Queue to publish to, kept separate so workers do not pick the tasks up",
+        )
+        parser.add_argument(
+            "--publish-mode",
+            type=str,
+            choices=[
+                QueueManager.PUBLISH_MODE_CONFIRM,
+                QueueManager.PUBLISH_MODE_TRANSACTIONAL,
+            ],
+            help="Publishing mode of the queue manager, defaults to RABBITMQ_PUBLISH_MODE",
+        )
+        parser.add_argument(
+            "--keep", action="store_true", help="Keep the created tasks and messages"
+        )
+
+    def handle(self, *args, **options):
+        count = options["count"]
+        batch_size = options["batch_size"]
+        queue_name = options["queue"]
+        publish_mode = options["publish_mode"]
+        payloads = [
+            {
+                "title": f"Benchmark task {i}",
+                "description": "Submission benchmark",
+                "priority": (i % 3) + 1,
+                "dependencies": [],
+            }
+            for i in range(count)
+        ]
+
+        created_ids = []
+
+        # Mirrors TaskViewSet.create: one transaction, one connection and one commit per task
+        start = time.perf_counter()
+        for payload in payloads:
+            serializer = TaskSerializer(data=payload)
+            serializer.is_valid(raise_exception=True)
+            with transaction.atomic():
+                task = serializer.save(status=Task.STATUS_PENDING)
+            queue_manager = QueueManager(
+                queue_name=queue_name, publish_mode=publish_mode
+            )
+            queue_manager.submit_task(task)
+            queue_manager.close()
+            created_ids.append(task.id)
+        per_task_elapsed = time.perf_counter() - start
+
+        # Mirrors TaskViewSet.bulk_create: one transaction, one connection and one commit per batch
+        start = time.perf_counter()
+        for offset in range(0, count, batch_size):
+            serializer = TaskSerializer(
+                data=payloads[offset : offset + batch_size], many=True
+            )
+            serializer.is_valid(raise_exception=True)
+            with transaction.atomic():
+                tasks = serializer.save(status=Task.STATUS_PENDING)
+            queue_manager = QueueManager(
+                queue_name=queue_name, publish_mode=publish_mode
+            )
+            queue_manager.submit_tasks(tasks)
+            queue_manager.close()
+            created_ids.extend(task.id for task in tasks)
+        bulk_elapsed = time.perf_counter() - start
+
+        self.stdout.write(
+            f"per-task: {count} tasks in {per_task_elapsed:.2f}s "
+            f"({count / per_task_elapsed:.0f} tasks/s)"
+        )
+        self.stdout.write(
+            f"bulk (batch={batch_size}): {count} tasks in {bulk_elapsed:.2f}s "
+            f"({count / bulk_elapsed:.0f} tasks/s)"
+        )
+        self.stdout.write(
+            self.style.SUCCESS(f"speedup: {per_task_elapsed / bulk_elapsed:.1f}x")
+        )
+
+        if not options["keep"]:
+            Task.objects.filter(id__in=created_ids).delete()
+            queue_manager = QueueManager(
+                queue_name=queue_name,
+                publish_mode=QueueManager.PUBLISH_MODE_TRANSACTIONAL,
+            )
+            queue_manager.connect()
+            for name in routing.priority_queues(queue_name):
+                queue_manager.channel.queue_purge(name)
+            queue_manager.close()
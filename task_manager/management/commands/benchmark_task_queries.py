@@ -0,0 +1,152 @@
+import random
+import time
+from django.db import connection, transaction
+from django.db.models import Q
+from django.core.management.base import BaseCommand
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+from task_manager import closure, counters
+from task_manager.dag_manager import DAGManager
+from task_manager.models import Task, TaskCounter, TaskDependencyClosure
+from task_manager.pagination import TaskCursorPagination
+from task_manager.views import TaskViewSet
+
+# Status mix of a long-running deployment, most tasks have finished
+STATUS_WEIGHTS = {
+    Task.STATUS_COMPLETED: 70,
+    Task.STATUS_FAILED: 5,
+    Task.STATUS_PENDING: 5,
+    Task.STATUS_WAITING: 5,
+    Task.STATUS_SCHEDULED: 3,
+    Task.STATUS_QUEUED: 10,
+    Task.STATUS_IN_PROGRESS: 2,
+}
+
+# Query strings of the task list requests that are measured
+LIST_QUERIES = [
+    "ordering=created_at",
+    "ordering=-created_at",
+    "status=queued&ordering=created_at",
+    "status=failed&ordering=-created_at",
+    "status=queued&priority=3&ordering=created_at",
+    "priority=1&ordering=-created_at",
+]
+
+
+class Command(BaseCommand):
+    help = "Seed tasks and report the query plans and timings of the task list, stats and scheduler queries"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--count",
+            type=int,
+            default=1000000,
+            help="Tasks to seed, 0 measures the existing rows",
+        )
+        parser.add_argument(
+            "--page-size", type=int, default=100, help="Rows fetched per list query"
+        )
+        parser.add_argument("--repeat", type=int, default=5, help="Runs per query")
+        parser.add_argument(
+            "--keep", action="store_true", help="Keep the seeded tasks afterwards"
+        )
+        parser.add_argument("--seed", type=int, default=42)
+
+    def handle(self, *args, **options):
+        if options["count"]:
+            self.seed(random.Random(options["seed"]), options["count"])
+        try:
+            # Fresh planner statistics, the seeded rows would otherwise be invisible to the planner
+            with connection.cursor() as cursor:
+                cursor.execute(f"ANALYZE {Task._meta.db_table}")
+            for query in LIST_QUERIES:
+                self.measure(
+                    f"GET /api/tasks/?{query}",
+                    self.list_queryset(query)[: options["page_size"]],
+                    options["repeat"],
+                )
+            self.measure(
+                "GET /api/tasks/stats/",
+                TaskCounter.objects.filter(count__gt=0),
+                options["repeat"],
+            )
+            self.measure(
+                "scheduler due tasks",
+                Task.objects.filter(status=Task.STATUS_SCHEDULED)
+                .order_by("scheduled_at")
+                .values_list("scheduled_at", "id")[:1000],
+                options["repeat"],
+            )
+        finally:
+            if options["count"] and not options["keep"]:
+                self.cleanup()
+
+    # Delete the seeded tasks with plain DELETE statements, without the collector and the signals of
+    # Task deletes. The closure table, the counters and the graph version are recomputed afterwards.
+    def cleanup(self):
+        seeded = Task.objects.filter(description="Index benchmark")
+        with transaction.atomic():
+            Task.dependencies.through.objects.filter(
+                Q(from_task__in=seeded) | Q(to_task__in=seeded)
+            )._raw_delete(connection.alias)
+            TaskDependencyClosure.objects.filter(
+                Q(task__in=seeded) | Q(dependency__in=seeded)
+            )._raw_delete(connection.alias)
+            seeded._raw_delete(connection.alias)
+            DAGManager.bump_version()
+        closure.rebuild()
+        counters.reconcile()
+
+    # Queryset of the first page the task list endpoint reads for the query string, built by the view's
+    # own filter backends and in the order of its keyset pagination
+    def list_queryset(self, query):
+        view = TaskViewSet()
+        view.request = Request(APIRequestFactory().get(f"/api/tasks/?{query}"))
+        view.format_kwarg = None
+        view.action = "list"
+        queryset = view.filter_queryset(view.get_queryset())
+        ordering = TaskCursorPagination().get_ordering(view.request, queryset, view)
+        return queryset.order_by(*ordering)
+
+    def measure(self, label, queryset, repeat):
+        options = {"analyze": True} if connection.vendor == "postgresql" else {}
+        plan = queryset.explain(**options)
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            list(queryset.all())
+            timings.append(time.perf_counter() - started)
+        timings.sort()
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"{label}: median {timings[len(timings) // 2] * 1000:.2f}ms, "
+                f"max {timings[-1] * 1000:.2f}ms"
+            )
+        )
+        self.stdout.write(plan)
+        self.stdout.write("")
+
+    def seed(self, rng, count, batch_size=10000):
+        statuses = list(STATUS_WEIGHTS)
+        weights = list(STATUS_WEIGHTS.values())
+        started = time.perf_counter()
+        for offset in range(0, count, batch_size):
+            tasks = Task.objects.bulk_create(
+                [
+                    Task(
+                        title=f"Index benchmark task {offset + i}",
+                        description="Index benchmark",
+                        status=status,
+                        priority=rng.randint(1, 3),
+                    )
+                    for i, status in enumerate(
+                        rng.choices(
+                            statuses, weights, k=min(batch_size, count - offset)
+                        )
+                    )
+                ]
+            )
+            counters.created(tasks)
+        self.stdout.write(
+            f"Seeded {count} tasks in {time.perf_counter() - started:.1f}s"
+        )
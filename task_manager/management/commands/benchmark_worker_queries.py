@@ -0,0 +1,96 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from task_manager import counters, task_cache
+from task_manager.models import Task
+from task_manager.queue_manager import QueueManager
+from task_manager.worker import handle_message
+
+
+class Command(BaseCommand):
+    help = "Count the database queries the worker runs per task, with and without batch prefetching"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--count", type=int, default=200, help="Tasks per run")
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=40,
+            help="Deliveries buffered together, like concurrency * prefetch multiplier",
+        )
+        parser.add_argument(
+            "--dependencies",
+            type=int,
+            default=3,
+            help="Completed dependencies shared by every task",
+        )
+
+    def handle(self, *args, **options):
+        settings.WORKER_SIMULATED_TASK_SECONDS = 0
+        count = options["count"]
+        dependencies = Task.objects.bulk_create(
+            [
+                Task(
+                    title=f"Query benchmark dependency {i}",
+                    description="Query benchmark",
+                    status=Task.STATUS_COMPLETED,
+                )
+                for i in range(options["dependencies"])
+            ]
+        )
+        counters.created(dependencies)
+        try:
+            single = self.run(count, 1, dependencies)
+            batched = self.run(count, options["batch_size"], dependencies)
+        finally:
+            Task.objects.filter(id__in=[task.id for task in dependencies]).delete()
+
+        self.stdout.write(f"one delivery at a time: {single / count:.1f} queries/task")
+        self.stdout.write(
+            f"batches of {options['batch_size']}: {batched / count:.1f} queries/task"
+        )
+
+    # Handle `count` deliveries in batches and return the number of queries they ran
+    # Nothing is published: the tasks have no dependents and do not recur
+    def run(self, count, batch_size, dependencies):
+        tasks = Task.objects.bulk_create(
+            [
+                Task(
+                    title=f"Query benchmark task {i}",
+                    description="Query benchmark",
+                    status=Task.STATUS_QUEUED,
+                )
+                for i in range(count)
+            ]
+        )
+        counters.created(tasks)
+        TaskDependency = Task.dependencies.through
+        TaskDependency.objects.bulk_create(
+            [
+                TaskDependency(from_task_id=task.id, to_task_id=dependency.id)
+                for task in tasks
+                for dependency in dependencies
+            ]
+        )
+        task_cache.get_cache().clear()
+
+        try:
+            with QueueManager() as queue_manager, CaptureQueriesContext(
+                connection
+            ) as queries:
+                headers = queue_manager._codec_properties()["headers"]
+                for offset in range(0, count, batch_size):
+                    batch = tasks[offset : offset + batch_size]
+                    task_ids = [task.id for task in batch]
+                    for task in batch:
+                        handle_message(
+                            queue_manager.codec.encode(task),
+                            queue_manager,
+                            queue_manager.codec.content_type,
+                            headers,
+                            task_ids,
+                        )
+            return len(queries)
+        finally:
+            Task.objects.filter(id__in=[task.id for task in tasks]).delete()
@@ -0,0 +1,126 @@
+import asyncio
+import threading
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from task_manager import counters
+from task_manager.models import Task
+from task_manager.queue_manager import QueueManager
+from task_manager.worker import Worker, POOL_THREAD, POOL_PROCESS
+
+
+class Command(BaseCommand):
+    help = "Compare the blocking and asyncio worker engines at equal concurrency"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--count", type=int, default=500, help="Tasks per run")
+        parser.add_argument(
+            "--concurrency", type=int, default=50, help="Execution slots per engine"
+        )
+        parser.add_argument(
+            "--task-seconds",
+            type=float,
+            default=0.2,
+            help="Simulated I/O time of every task",
+        )
+        parser.add_argument(
+            "--blocking-pool",
+            type=str,
+            choices=[POOL_THREAD, POOL_PROCESS],
+            default=POOL_THREAD,
+            help="Pool used by the blocking engine",
+        )
+        parser.add_argument(
+            "--queue",
+            type=str,
+            default="benchmark_worker_queue",
+            help="Queue to consume from, kept separate from the regular workers",
+        )
+        parser.add_argument(
+            "--timeout", type=float, default=600, help="Seconds to wait for a run"
+        )
+
+    def handle(self, *args, **options):
+        settings.WORKER_SIMULATED_TASK_SECONDS = options["task_seconds"]
+        self.options = options
+
+        blocking = self.run_engine(self.run_blocking)
+        asynchronous = self.run_engine(self.run_asyncio)
+
+        count = options["count"]
+        self.stdout.write(
+            f"blocking ({options['blocking_pool']} pool, concurrency {options['concurrency']}): "
+            f"{count} tasks in {blocking:.2f}s ({count / blocking:.0f} tasks/s)"
+        )
+        self.stdout.write(
+            f"asyncio (concurrency {options['concurrency']}): "
+            f"{count} tasks in {asynchronous:.2f}s ({count / asynchronous:.0f} tasks/s)"
+        )
+        self.stdout.write(
+            self.style.SUCCESS(f"asyncio speedup: {blocking / asynchronous:.1f}x")
+        )
+
+    # Seed and publish the tasks, run the engine until they are all completed and return the elapsed time
+    def run_engine(self, run):
+        tasks = Task.objects.bulk_create(
+            [
+                Task(
+                    title=f"Worker benchmark task {i}",
+                    description="Worker benchmark",
+                )
+                for i in range(self.options["count"])
+            ]
+        )
+        counters.created(tasks)
+        ids = [task.id for task in tasks]
+        with QueueManager(queue_name=self.options["queue"]) as queue_manager:
+            queue_manager.submit_tasks(tasks)
+
+        try:
+            start = time.perf_counter()
+            run(ids)
+            return time.perf_counter() - start
+        finally:
+            Task.objects.filter(id__in=ids).delete()
+
+    def wait_for_completion(self, ids):
+        deadline = time.monotonic() + self.options["timeout"]
+        while time.monotonic() < deadline:
+            completed = Task.objects.filter(
+                id__in=ids, status=Task.STATUS_COMPLETED
+            ).count()
+            if completed == len(ids):
+                return
+            time.sleep(0.1)
+        raise TimeoutError("Benchmark run did not complete in time")
+
+    def run_blocking(self, ids):
+        worker = Worker(
+            queues=[(self.options["queue"], 1)],
+            concurrency=self.options["concurrency"],
+            pool=self.options["blocking_pool"],
+        )
+        thread = threading.Thread(target=worker.start, daemon=True)
+        thread.start()
+        try:
+            self.wait_for_completion(ids)
+        finally:
+            worker.connection.add_callback_threadsafe(worker.channel.stop_consuming)
+            thread.join()
+
+    def run_asyncio(self, ids):
+        from task_manager.async_worker import AsyncWorker
+
+        async def run():
+            worker = AsyncWorker(
+                queues=[(self.options["queue"], 1)],
+                concurrency=self.options["concurrency"],
+            )
+            engine = asyncio.create_task(worker.run())
+            try:
+                await asyncio.to_thread(self.wait_for_completion, ids)
+            finally:
+                worker.stop()
+                await engine
+
+        asyncio.run(run())
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand, CommandError
+from task_manager import closure
+
+
+class Command(BaseCommand):
+    help = "Check that the task dependency closure table matches the dependency edges"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--fix", action="store_true", help="Rebuild the table if it is inconsistent"
+        )
+
+    def handle(self, *args, **options):
+        missing, stale = closure.find_inconsistencies()
+        if not missing and not stale:
+            self.stdout.write(self.style.SUCCESS("Dependency closure is consistent"))
+            return
+
+        for task_id, dependency_id in sorted(missing, key=str)[:20]:
+            self.stdout.write(f"missing: {task_id} -> {dependency_id}")
+        for task_id, dependency_id in sorted(stale, key=str)[:20]:
+            self.stdout.write(f"stale: {task_id} -> {dependency_id}")
+
+        if options["fix"]:
+            count = closure.rebuild()
+            self.stdout.write(
+                self.style.SUCCESS(f"Rebuilt dependency closure with {count} rows")
+            )
+            return
+        raise CommandError(
+            f"Dependency closure is inconsistent: {len(missing)} missing, {len(stale)} stale rows"
+        )
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+from task_manager import closure
+
+
+class Command(BaseCommand):
+    help = "Rebuild the task dependency closure table from the dependency edges"
+
+    def handle(self, *args, **options):
+        count = closure.rebuild()
+        self.stdout.write(
+            self.style.SUCCESS(f"Rebuilt dependency closure with {count} rows")
+        )
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from task_manager import counters
+
+
+class Command(BaseCommand):
+    help = "Recompute the task counters of the stats endpoint from the task table"
+
+    def handle(self, *args, **options):
+        counters.flush()
+        wrong = counters.reconcile()
+        if wrong:
+            self.stdout.write(self.style.WARNING(f"Corrected {wrong} task counters"))
+        else:
+            self.stdout.write(self.style.SUCCESS("Task counters are consistent"))
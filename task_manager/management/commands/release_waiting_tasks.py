@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+from task_manager import dispatcher
+from task_manager.queue_manager import QueueManager
+
+
+class Command(BaseCommand):
+    help = "Recompute the dependency counters of waiting tasks and publish the ones that are ready"
+
+    def handle(self, *args, **options):
+        with QueueManager() as queue_manager:
+            released = dispatcher.release_waiting_tasks(queue_manager)
+        self.stdout.write(self.style.SUCCESS(f"Released {len(released)} waiting tasks"))
@@ -0,0 +1,27 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from task_manager.scheduler import start_scheduler
+
+
+class Command(BaseCommand):
+    help = "Start the scheduler that publishes scheduled and recurring tasks when they are due"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--poll-interval",
+            type=float,
+            default=settings.SCHEDULER_POLL_INTERVAL,
+            help="Seconds between two queries for due tasks",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=settings.SCHEDULER_BATCH_SIZE,
+            help="Maximum number of due tasks loaded per query",
+        )
+
+    def handle(self, *args, **options):
+        self.stdout.write(self.style.SUCCESS("Starting task scheduler..."))
+        start_scheduler(
+            poll_interval=options["poll_interval"], batch_size=options["batch_size"]
+        )
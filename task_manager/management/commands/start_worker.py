@@ -1,10 +1,56 @@
-from django.core.management.base import BaseCommand
-from task_manager.worker import start_worker
+import argparse
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from task_manager.routing import parse_queues
+from task_manager.worker import start_worker, POOL_CHOICES
 
 
 class Command(BaseCommand):
     help = "Start the task worker"
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--queues",
+            type=str,
+            default=settings.WORKER_QUEUES,
+            help="Queues to consume with their weights, as fast:3,reports:1",
+        )
+        parser.add_argument(
+            "--concurrency",
+            type=int,
+            default=settings.WORKER_CONCURRENCY,
+            help="Number of tasks executed at once, also used as the prefetch count",
+        )
+        parser.add_argument(
+            "--pool",
+            type=str,
+            choices=POOL_CHOICES,
+            default=settings.WORKER_POOL,
+            help="Run tasks inline (solo), in a thread pool or in a process pool",
+        )
+        parser.add_argument(
+            "--prefetch-multiplier",
+            type=int,
+            default=settings.WORKER_PREFETCH_MULTIPLIER,
+            help="Deliveries buffered per execution slot",
+        )
+        parser.add_argument(
+            "--write-behind",
+            action=argparse.BooleanOptionalAction,
+            default=settings.WORKER_WRITE_BEHIND,
+            help="Coalesce task completions of the thread pool into bulk updates",
+        )
+
     def handle(self, *args, **options):
+        try:
+            queues = parse_queues(options["queues"])
+        except ValueError as e:
+            raise CommandError(str(e))
         self.stdout.write(self.style.SUCCESS("Starting task worker..."))
-        start_worker()
+        start_worker(
+            queues=queues,
+            concurrency=options["concurrency"],
+            pool=options["pool"],
+            prefetch_multiplier=options["prefetch_multiplier"],
+            write_behind=options["write_behind"],
+        )
@@ -0,0 +1,129 @@
+import json
+import struct
+import uuid
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+# Task messages are encoded by a codec picked with TASK_MESSAGE_CODEC. The content type property tells
+# consumers how to decode a message and the schema header which version of the layout it uses, so
+# producers and workers running different codecs can share a queue.
+
+SCHEMA_HEADER = "x-task-schema"
+
+
+class CodecError(ValueError):
+    pass
+
+
+def task_fields(task):
+    return {
+        "id": str(task.id),
+        "title": task.title,
+        "description": task.description,
+        "priority": task.priority,
+    }
+
+
+class JsonCodec:
+    # The full task fields as JSON, the layout of messages published before codecs existed
+    name = "json"
+    content_type = "application/json"
+    version = 1
+
+    def encode(self, task):
+        return json.dumps(task_fields(task)).encode()
+
+    def decode(self, body):
+        return json.loads(body)
+
+
+class SlimJsonCodec(JsonCodec):
+    # Only the task id: workers load the task from the database anyway, so the title and
+    # description do not need to travel through the broker
+    name = "slim"
+    content_type = "application/vnd.task-queue.slim+json"
+
+    def encode(self, task):
+        return json.dumps({"id": str(task.id)}).encode()
+
+
+class MsgpackCodec:
+    # The full task fields as MessagePack, needs the optional msgpack package
+    name = "msgpack"
+    content_type = "application/msgpack"
+    version = 1
+
+    def __init__(self):
+        try:
+            import msgpack
+        except ImportError:
+            raise ImproperlyConfigured("The msgpack codec needs the msgpack package")
+        self.msgpack = msgpack
+
+    def encode(self, task):
+        return self.msgpack.packb(dict(task_fields(task), id=task.id.bytes))
+
+    def decode(self, body):
+        data = self.msgpack.unpackb(body)
+        data["id"] = str(uuid.UUID(bytes=data["id"]))
+        return data
+
+
+class StructCodec:
+    # 17 bytes: the 16 bytes of the task id followed by the priority
+    name = "struct"
+    content_type = "application/vnd.task-queue.struct"
+    version = 1
+    layout = struct.Struct("!16sB")
+
+    def encode(self, task):
+        return self.layout.pack(task.id.bytes, task.priority)
+
+    def decode(self, body):
+        try:
+            task_id, priority = self.layout.unpack(body)
+        except struct.error as e:
+            raise CodecError(f"Invalid struct task message: {e}")
+        return {"id": str(uuid.UUID(bytes=task_id)), "priority": priority}
+
+
+CODECS = {
+    codec.name: codec for codec in (JsonCodec, SlimJsonCodec, MsgpackCodec, StructCodec)
+}
+_instances = {}
+
+
+def get_codec(name=None):
+    name = name or settings.TASK_MESSAGE_CODEC
+    if name not in CODECS:
+        raise ImproperlyConfigured(f"Unknown task message codec: {name}")
+    if name not in _instances:
+        _instances[name] = CODECS[name]()
+    return _instances[name]
+
+
+# A message this process cannot decode is malformed for it, the consumers dead-letter it
+def _codec_for_content_type(content_type):
+    for codec in CODECS.values():
+        if codec.content_type == content_type:
+            try:
+                return get_codec(codec.name)
+            except ImproperlyConfigured as e:
+                raise CodecError(f"Unsupported content type {content_type}: {e}")
+    raise CodecError(f"Unsupported content type: {content_type}")
+
+
+# Decode a task message with the codec matching its content type
+# Messages without a content type predate the codecs and are JSON
+def decode(body, content_type=None, headers=None):
+    codec = _codec_for_content_type(content_type or JsonCodec.content_type)
+    version = (headers or {}).get(SCHEMA_HEADER, 1)
+    if version > codec.version:
+        raise CodecError(
+            f"Message schema version {version} of {codec.content_type} is newer than "
+            f"the supported version {codec.version}"
+        )
+    data = codec.decode(body)
+    if not isinstance(data, dict) or "id" not in data:
+        raise CodecError("Task message has no task id")
+    return data
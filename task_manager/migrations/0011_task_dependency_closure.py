@@ -0,0 +1,58 @@
+# Generated by Django 4.2.7 on 2026-10-17 12:33
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def populate_closure(apps, schema_editor):
+    Task = apps.get_model("task_manager", "Task")
+    TaskDependencyClosure = apps.get_model("task_manager", "TaskDependencyClosure")
+
+    graph = {}
+    for task_id, dependency_id in Task.dependencies.through.objects.values_list(
+        "from_task_id", "to_task_id"
+    ):
+        graph.setdefault(task_id, []).append(dependency_id)
+
+    rows = []
+    for task_id in graph:
+        # Walk the dependencies of every task, visiting each node once
+        visited = set()
+        stack = list(graph[task_id])
+        while stack:
+            dependency_id = stack.pop()
+            if dependency_id in visited:
+                continue
+            visited.add(dependency_id)
+            stack.extend(graph.get(dependency_id, []))
+        rows.extend(
+            TaskDependencyClosure(task_id=task_id, dependency_id=dependency_id)
+            for dependency_id in visited
+        )
+    TaskDependencyClosure.objects.bulk_create(rows, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('task_manager', '0010_task_user_timezone'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TaskDependencyClosure',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('dependency', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='dependent_closure', to='task_manager.task')),
+                ('task', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='dependency_closure', to='task_manager.task')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['dependency', 'task'], name='task_manage_depende_5bc10a_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='taskdependencyclosure',
+            constraint=models.UniqueConstraint(fields=('task', 'dependency'), name='unique_task_dependency_closure'),
+        ),
+        migrations.RunPython(populate_closure, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.7 on 2026-10-17 12:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('task_manager', '0011_task_dependency_closure'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='task',
+            name='pending_dependencies',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='task',
+            name='status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('waiting', 'Waiting for dependencies'), ('queued', 'Queued'), ('in_progress', 'In Progress'), ('completed', 'Completed'), ('failed', 'Failed')], default='pending', max_length=20),
+        ),
+    ]
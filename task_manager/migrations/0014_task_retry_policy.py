@@ -0,0 +1,34 @@
+# Generated by Django 4.2.7 on 2026-10-17 12:43
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('task_manager', '0013_task_scheduled_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='task',
+            name='retry_base_delay',
+            field=models.FloatField(default=1.0, validators=[django.core.validators.MinValueValidator(0)]),
+        ),
+        migrations.AddField(
+            model_name='task',
+            name='retry_jitter',
+            field=models.FloatField(default=1.0, validators=[django.core.validators.MinValueValidator(0), django.core.validators.MaxValueValidator(1)]),
+        ),
+        migrations.AddField(
+            model_name='task',
+            name='retry_max_delay',
+            field=models.FloatField(default=300.0, validators=[django.core.validators.MinValueValidator(0)]),
+        ),
+        migrations.AddField(
+            model_name='task',
+            name='retry_multiplier',
+            field=models.FloatField(default=2.0, validators=[django.core.validators.MinValueValidator(1)]),
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 4.2.7 on 2026-10-17 13:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('task_manager', '0016_task_counters'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='task',
+            name='task_status_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='task',
+            name='task_status_priority_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='task',
+            name='task_priority_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='task',
+            name='task_created_at_idx',
+        ),
+        migrations.AddIndex(
+            model_name='task',
+            index=models.Index(fields=['status', 'created_at', 'id'], name='task_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='task',
+            index=models.Index(fields=['status', 'priority', 'created_at', 'id'], name='task_status_priority_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='task',
+            index=models.Index(fields=['priority', 'created_at', 'id'], name='task_priority_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='task',
+            index=models.Index(fields=['created_at', 'id'], name='task_created_at_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-17 13:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('task_manager', '0017_task_list_keyset_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='task',
+            name='task_type',
+            field=models.CharField(default='default', max_length=100),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 4.2.7 on 2026-10-17 13:22
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('task_manager', '0018_task_type'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='task',
+            name='soft_time_limit',
+            field=models.FloatField(blank=True, null=True, validators=[django.core.validators.MinValueValidator(0)]),
+        ),
+        migrations.AddField(
+            model_name='task',
+            name='time_limit',
+            field=models.FloatField(blank=True, null=True, validators=[django.core.validators.MinValueValidator(0)]),
+        ),
+        migrations.AlterField(
+            model_name='task',
+            name='status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('waiting', 'Waiting for dependencies'), ('scheduled', 'Scheduled'), ('queued', 'Queued'), ('in_progress', 'In Progress'), ('completed', 'Completed'), ('failed', 'Failed'), ('cancelled', 'Cancelled')], default='pending', max_length=20),
+        ),
+        migrations.AlterField(
+            model_name='taskcounter',
+            name='status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('waiting', 'Waiting for dependencies'), ('scheduled', 'Scheduled'), ('queued', 'Queued'), ('in_progress', 'In Progress'), ('completed', 'Completed'), ('failed', 'Failed'), ('cancelled', 'Cancelled')], max_length=20),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-17 13:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('task_manager', '0019_task_time_limits_cancelled'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='task',
+            name='queue',
+            field=models.CharField(blank=True, default='', max_length=100),
+        ),
+    ]
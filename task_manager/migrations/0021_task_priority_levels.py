@@ -0,0 +1,23 @@
+# Generated by Django 4.2.7 on 2026-10-17 13:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('task_manager', '0020_task_queue'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='task',
+            name='priority',
+            field=models.IntegerField(choices=[(1, 'Low'), (2, 'Medium'), (3, 'High'), (4, 'Urgent'), (5, 'Critical')], default=2),
+        ),
+        migrations.AlterField(
+            model_name='taskcounter',
+            name='priority',
+            field=models.IntegerField(choices=[(1, 'Low'), (2, 'Medium'), (3, 'High'), (4, 'Urgent'), (5, 'Critical')]),
+        ),
+    ]
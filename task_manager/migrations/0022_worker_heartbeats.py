@@ -0,0 +1,40 @@
+# Generated by Django 4.2.7 on 2026-10-17 13:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('task_manager', '0021_task_priority_levels'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='task',
+            name='worker',
+            field=models.CharField(blank=True, default='', max_length=255),
+        ),
+        migrations.CreateModel(
+            name='WorkerHeartbeat',
+            fields=[
+                ('id', models.CharField(max_length=255, primary_key=True, serialize=False)),
+                ('hostname', models.CharField(max_length=255)),
+                ('pid', models.IntegerField()),
+                ('pool', models.CharField(max_length=20)),
+                ('queues', models.CharField(max_length=255)),
+                ('concurrency', models.IntegerField()),
+                ('running', models.IntegerField(default=0)),
+                ('running_tasks', models.JSONField(default=list)),
+                ('processed', models.BigIntegerField(default=0)),
+                ('requeued', models.BigIntegerField(default=0)),
+                ('throughput', models.FloatField(default=0)),
+                ('status', models.CharField(choices=[('alive', 'Alive'), ('stopped', 'Stopped'), ('dead', 'Dead')], default='alive', max_length=20)),
+                ('started_at', models.DateTimeField()),
+                ('last_seen', models.DateTimeField()),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'last_seen'], name='task_manage_status_74d0b2_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 4.2.7 on 2026-10-17 13:59
+
+from django.db import migrations, models
+
+
+def create_version(apps, schema_editor):
+    DependencyGraphVersion = apps.get_model("task_manager", "DependencyGraphVersion")
+    DependencyGraphVersion.objects.create(pk=1, version=0)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('task_manager', '0022_worker_heartbeats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DependencyGraphVersion',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('version', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(create_version, migrations.RunPython.noop),
+    ]
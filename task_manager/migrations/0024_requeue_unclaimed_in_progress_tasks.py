@@ -0,0 +1,23 @@
+# Generated by Django 4.2.7 on 2026-10-17 14:10
+
+from django.db import migrations
+
+
+# Workers before the worker field was added marked tasks in progress before checking whether they could
+# run, and published them again to run later. Those rows have no worker, so their redeliveries would be
+# dropped as duplicates and no dead-worker recovery would ever match them: they go back to queued.
+# The task counters pick the change up at their next reconciliation.
+def requeue_unclaimed_tasks(apps, schema_editor):
+    Task = apps.get_model("task_manager", "Task")
+    Task.objects.filter(status="in_progress", worker="").update(status="queued")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('task_manager', '0023_dependency_graph_version'),
+    ]
+
+    operations = [
+        migrations.RunPython(requeue_unclaimed_tasks, migrations.RunPython.noop),
+    ]
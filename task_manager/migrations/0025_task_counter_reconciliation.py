@@ -0,0 +1,26 @@
+# Generated by Django 4.2.7 on 2026-10-17 14:11
+
+from django.db import migrations, models
+
+
+def create_reconciliation(apps, schema_editor):
+    TaskCounterReconciliation = apps.get_model("task_manager", "TaskCounterReconciliation")
+    TaskCounterReconciliation.objects.create(pk=1)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('task_manager', '0024_requeue_unclaimed_in_progress_tasks'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TaskCounterReconciliation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('reconciled_at', models.DateTimeField(null=True)),
+            ],
+        ),
+        migrations.RunPython(create_reconciliation, migrations.RunPython.noop),
+    ]
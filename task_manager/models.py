@@ -1,9 +1,12 @@
-from django.db import models
+from django.core.validators import MaxValueValidator, MinValueValidator
+from django.db import connection, models, transaction
+import random
 import uuid
 from datetime import timedelta
 from django.utils import timezone
 import pytz
 import logging
+from . import delayed
 
 logging.basicConfig(
     level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
@@ -11,25 +14,63 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
+class TaskQuerySet(models.QuerySet):
+    # Delete the tasks and update the dependency closure and the graph version once for the whole batch,
+    # the per-task signals skip that work meanwhile, see task_manager.signals
+    def delete(self):
+        from . import closure, signals
+        from .dag_manager import DAGManager
+
+        with transaction.atomic(using=self.db):
+            task_ids = set(self.values_list("id", flat=True))
+            affected = closure.affected_by(task_ids) - task_ids
+            token = signals.deleting_batch.set(True)
+            try:
+                deleted = super().delete()
+            finally:
+                signals.deleting_batch.reset(token)
+            closure.refresh(affected)
+            if task_ids:
+                DAGManager.bump_version()
+        return deleted
+
+
 class Task(models.Model):
     STATUS_PENDING = "pending"
+    STATUS_WAITING = "waiting"
+    STATUS_SCHEDULED = "scheduled"
     STATUS_QUEUED = "queued"
     STATUS_IN_PROGRESS = "in_progress"
     STATUS_COMPLETED = "completed"
     STATUS_FAILED = "failed"
+    STATUS_CANCELLED = "cancelled"
+    # Statuses a task can still be cancelled from
+    CANCELLABLE_STATUSES = (
+        STATUS_PENDING,
+        STATUS_WAITING,
+        STATUS_SCHEDULED,
+        STATUS_QUEUED,
+        STATUS_IN_PROGRESS,
+    )
 
+    # Every level is a queue of its own on the broker, see routing.py
     PRIORITY_CHOICES = (
         (1, "Low"),
         (2, "Medium"),
         (3, "High"),
+        (4, "Urgent"),
+        (5, "Critical"),
     )
 
     STATUS_CHOICES = (
         ("pending", "Pending"),
+        ("waiting", "Waiting for dependencies"),
+        ("scheduled", "Scheduled"),
         ("queued", "Queued"),
         ("in_progress", "In Progress"),
         ("completed", "Completed"),
         ("failed", "Failed"),
+        ("cancelled", "Cancelled"),
     )
 
     RECURRENCE_TYPE_CHOICES = (
@@ -49,6 +90,20 @@ class Task(models.Model):
     result = models.TextField(blank=True, null=True)
     retry_count = models.IntegerField(default=0)
     max_retries = models.IntegerField(default=3)
+    # Retry policy: the n-th retry waits retry_base_delay * retry_multiplier ** (n - 1) seconds, capped at
+    # retry_max_delay. retry_jitter is the fraction of that delay that is randomized, 1 is full jitter.
+    retry_base_delay = models.FloatField(
+        default=1.0, validators=[MinValueValidator(0)]
+    )
+    retry_multiplier = models.FloatField(
+        default=2.0, validators=[MinValueValidator(1)]
+    )
+    retry_max_delay = models.FloatField(
+        default=300.0, validators=[MinValueValidator(0)]
+    )
+    retry_jitter = models.FloatField(
+        default=1.0, validators=[MinValueValidator(0), MaxValueValidator(1)]
+    )
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     scheduled_at = models.DateTimeField(null=True, blank=True)
@@ -59,11 +114,55 @@ class Task(models.Model):
         max_length=20, choices=RECURRENCE_TYPE_CHOICES, default="none"
     )
     last_run_at = models.DateTimeField(null=True, blank=True)
+    # Number of direct dependencies that have not completed yet, a waiting task is released at zero
+    pending_dependencies = models.IntegerField(default=0)
+    # Selects the handler that runs the task, see task_manager.handlers
+    task_type = models.CharField(max_length=100, default="default")
+    # Queue the task is published to, empty routes it by task type, see task_manager.routing
+    queue = models.CharField(max_length=100, blank=True, default="")
+    # Seconds after which a running task is interrupted, the soft limit raises inside the task so it can
+    # clean up and the hard limit frees its execution slot. Unset falls back to the handler's limits.
+    soft_time_limit = models.FloatField(
+        null=True, blank=True, validators=[MinValueValidator(0)]
+    )
+    time_limit = models.FloatField(
+        null=True, blank=True, validators=[MinValueValidator(0)]
+    )
+    # Worker that claimed the task last, tasks left in progress by a dead worker are recovered through
+    # it, see task_manager.heartbeats
+    worker = models.CharField(max_length=255, blank=True, default="")
     # A task can have multiple dependencies and a dependency can be shared by multiple tasks
     dependencies = models.ManyToManyField(
         "self", symmetrical=False, related_name="dependent_tasks"
     )
 
+    objects = TaskQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # Due tasks lookup of the scheduler
+            models.Index(
+                fields=["scheduled_at"],
+                condition=models.Q(status="scheduled"),
+                name="task_scheduled_due_idx",
+            ),
+            # Task list filtered by status and ordered by creation, also serves the counts by
+            # status of the stats endpoint
+            # The list indexes end with the id, the tiebreaker of the keyset pagination
+            models.Index(fields=["status", "created_at", "id"], name="task_status_idx"),
+            # Task list filtered by status and priority and ordered by creation
+            models.Index(
+                fields=["status", "priority", "created_at", "id"],
+                name="task_status_priority_idx",
+            ),
+            # Task list filtered by or ordered on priority
+            models.Index(
+                fields=["priority", "created_at", "id"], name="task_priority_idx"
+            ),
+            # Unfiltered task list ordered by creation
+            models.Index(fields=["created_at", "id"], name="task_created_at_idx"),
+        ]
+
     def __str__(self):
         return self.title
 
@@ -75,19 +174,96 @@ class Task(models.Model):
         else:
             return f"Task is {self.status}"
 
+    # Move the task to `status` with a conditional UPDATE of the given fields only
+    # The update applies only while the row is still in one of `from_status`, by default the status the
+    # instance was loaded with. Returns whether this transition won, the instance is updated when it did.
+    # `where` adds lookups the row must still match, e.g. the worker that claimed it.
+    # With several allowed statuses there is one UPDATE per status until one wins, starting with the
+    # status the instance was loaded with, so the counters move the task out of the status it really had.
+    def transition(self, status, from_status=None, where=None, **fields):
+        from . import counters
+
+        values = self._transition_values(status, fields)
+        won = 0
+        for old in self._from_statuses(from_status):
+            won = Task.objects.filter(
+                id=self.id, status=old, **(where or {})
+            ).update(**values)
+            if won:
+                counters.record(self._counter_deltas(old, status))
+                break
+        return self._apply_transition(won, values)
+
+    async def atransition(self, status, from_status=None, where=None, **fields):
+        from asgiref.sync import sync_to_async
+        from . import counters
+
+        values = self._transition_values(status, fields)
+        won = 0
+        for old in self._from_statuses(from_status):
+            won = await Task.objects.filter(
+                id=self.id, status=old, **(where or {})
+            ).aupdate(**values)
+            if won:
+                # aupdate commits on its own, there is no transaction to wait for
+                await sync_to_async(counters.add)(self._counter_deltas(old, status))
+                break
+        return self._apply_transition(won, values)
+
+    def _from_statuses(self, from_status):
+        if from_status is None:
+            return [self.status]
+        if isinstance(from_status, str):
+            return [from_status]
+        statuses = list(dict.fromkeys(from_status))
+        if self.status in statuses:
+            statuses.remove(self.status)
+            statuses.insert(0, self.status)
+        return statuses
+
+    def _transition_values(self, status, fields):
+        # update() skips auto_now, updated_at is set explicitly
+        return dict(fields, status=status, updated_at=timezone.now())
+
+    def _counter_deltas(self, old, status):
+        from . import counters
+
+        return counters.moved([counters.key(self, old)], status)
+
+    def _apply_transition(self, won, values):
+        if won:
+            for field, value in values.items():
+                setattr(self, field, value)
+        return bool(won)
+
+    # Seconds to wait before the next retry, following the retry policy of the task
+    def get_retry_delay(self):
+        exponent = max(self.retry_count - 1, 0)
+        try:
+            delay = self.retry_base_delay * self.retry_multiplier**exponent
+        except OverflowError:
+            delay = self.retry_max_delay
+        # Retries go through delayed delivery, which cannot wait longer than its highest level
+        delay = min(delay, self.retry_max_delay, delayed.max_delay() / 1000)
+        # Spread the retries of tasks that failed together so they do not hit the same resource at once
+        return delay * (1 - self.retry_jitter * random.random())
+
     # Check if the task has a circular dependency: preventing infinite loops
+    # Adding `task` as a dependency is circular when this task is already one of its dependencies
     def has_circular_dependency(self, task):
         if task == self:
             return True
-        for dependency in task.dependencies.all():
-            if self.has_circular_dependency(dependency):
-                return True
-        return False
+        return TaskDependencyClosure.objects.filter(
+            task_id=task.id, dependency_id=self.id
+        ).exists()
 
     # Add a dependency to the current task
+    # The closure update rejects a cycle that a concurrent addition closed after this check, the savepoint
+    # keeps a transaction of the caller usable when it does
     def add_dependency(self, dependency_task):
         if not self.has_circular_dependency(dependency_task):
-            self.dependencies.add(dependency_task)
+            with transaction.atomic():
+                self.dependencies.add(dependency_task)
         else:
             raise ValueError(
                 "Adding this dependency would cause a circular dependency."
@@ -95,11 +271,50 @@ class Task(models.Model):
 
     # Get all direct and indirect dependencies of current task
     def get_all_dependencies(self):
-        all_dependencies = set()
-        for dependency in self.dependencies.all():
-            all_dependencies.add(dependency)
-            all_dependencies.update(dependency.get_all_dependencies())
-        return all_dependencies
+        return set(Task.objects.filter(dependent_closure__task_id=self.id))
+
+    # Get the ids of all direct and indirect dependencies of the given tasks by walking the dependency edges
+    # The closure table is derived from this, it is used to maintain and verify TaskDependencyClosure
+    # The transitive closure is fetched in a bounded number of queries and every node is visited once
+    @classmethod
+    def get_dependency_ids(cls, task_ids):
+        task_ids = list(task_ids)
+        if not task_ids:
+            return set()
+        if connection.vendor == "postgresql":
+            return cls._get_dependency_ids_recursive(task_ids)
+
+        # Walk the graph one level at a time: one query per level instead of one per node
+        TaskDependency = cls.dependencies.through
+        visited = set()
+        frontier = set(task_ids)
+        while frontier:
+            level = set(
+                TaskDependency.objects.filter(from_task_id__in=frontier).values_list(
+                    "to_task_id", flat=True
+                )
+            )
+            frontier = level - visited
+            visited |= frontier
+        return visited
+
+    # PostgreSQL resolves the whole closure in one recursive query, UNION discards visited nodes
+    @classmethod
+    def _get_dependency_ids_recursive(cls, task_ids):
+        table = cls.dependencies.through._meta.db_table
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                WITH RECURSIVE closure(id) AS (
+                    SELECT to_task_id FROM {table} WHERE from_task_id = ANY(%s)
+                    UNION
+                    SELECT d.to_task_id FROM {table} d JOIN closure c ON d.from_task_id = c.id
+                )
+                SELECT id FROM closure
+                """,
+                [task_ids],
+            )
+            return {row[0] for row in cursor.fetchall()}
 
     # Check if the task is ready to run
     def is_ready_to_run(self):
@@ -122,10 +337,14 @@ class Task(models.Model):
             return True
 
     # Update the next run time of the task
+    # The task is parked as scheduled, the scheduler publishes it again once it is due
     def update_next_run_time(self):
         if self.is_recurring and self.recurrence_interval:
-            self.scheduled_at = timezone.now() + self.recurrence_interval
-            self.save()
+            return self.transition(
+                Task.STATUS_SCHEDULED,
+                scheduled_at=timezone.now() + self.recurrence_interval,
+            )
+        return False
 
     @property
     def is_recurring(self):
@@ -140,3 +359,106 @@ class Task(models.Model):
         elif self.recurrence_type == "monthly":
             return timedelta(days=30)
         return None
+
+
+# Materialized transitive closure of Task.dependencies
+# One row per pair where `task` directly or indirectly depends on `dependency`, kept up to date by closure.py
+class TaskDependencyClosure(models.Model):
+    task = models.ForeignKey(
+        Task, on_delete=models.CASCADE, related_name="dependency_closure"
+    )
+    dependency = models.ForeignKey(
+        Task, on_delete=models.CASCADE, related_name="dependent_closure"
+    )
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["task", "dependency"], name="unique_task_dependency_closure"
+            )
+        ]
+        # The unique constraint serves lookups by task, this index serves lookups by dependency
+        indexes = [models.Index(fields=["dependency", "task"])]
+
+    def __str__(self):
+        return f"{self.task_id} -> {self.dependency_id}"
+
+
+# Number of tasks per status, priority and recurrence type, maintained by task_manager.counters
+class TaskCounter(models.Model):
+    status = models.CharField(max_length=20, choices=Task.STATUS_CHOICES)
+    priority = models.IntegerField(choices=Task.PRIORITY_CHOICES)
+    recurrence_type = models.CharField(
+        max_length=20, choices=Task.RECURRENCE_TYPE_CHOICES
+    )
+    count = models.BigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["status", "priority", "recurrence_type"],
+                name="unique_task_counter",
+            )
+        ]
+
+    def __str__(self):
+        return f"{self.status}/{self.priority}/{self.recurrence_type}: {self.count}"
+
+
+# Start of the last recount of the task counters, a single row. Deltas buffered before it are already
+# part of the recount, see task_manager.counters
+class TaskCounterReconciliation(models.Model):
+    reconciled_at = models.DateTimeField(null=True)
+
+    def __str__(self):
+        return f"Task counters reconciled at {self.reconciled_at}"
+
+
+# Version of the dependency graph, a single row bumped whenever a task or a dependency edge is added or
+# removed, see DAGManager.get_version
+class DependencyGraphVersion(models.Model):
+    version = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return f"Dependency graph version {self.version}"
+
+
+# Last heartbeat of every worker process, written by task_manager.heartbeats
+class WorkerHeartbeat(models.Model):
+    STATUS_ALIVE = "alive"
+    STATUS_STOPPED = "stopped"
+    STATUS_DEAD = "dead"
+
+    STATUS_CHOICES = (
+        (STATUS_ALIVE, "Alive"),
+        (STATUS_STOPPED, "Stopped"),
+        (STATUS_DEAD, "Dead"),
+    )
+
+    id = models.CharField(max_length=255, primary_key=True)
+    hostname = models.CharField(max_length=255)
+    pid = models.IntegerField()
+    pool = models.CharField(max_length=20)
+    # Consumed queues with their weights, as "fast:3,reports:1"
+    queues = models.CharField(max_length=255)
+    concurrency = models.IntegerField()
+    # Deliveries being executed and the ids of their tasks
+    running = models.IntegerField(default=0)
+    running_tasks = models.JSONField(default=list)
+    # Deliveries finished since the worker started, and those of them that were requeued
+    processed = models.BigIntegerField(default=0)
+    requeued = models.BigIntegerField(default=0)
+    # Deliveries finished per second since the previous heartbeat
+    throughput = models.FloatField(default=0)
+    status = models.CharField(
+        max_length=20, choices=STATUS_CHOICES, default=STATUS_ALIVE
+    )
+    started_at = models.DateTimeField()
+    last_seen = models.DateTimeField()
+
+    class Meta:
+        # Workers that stopped sending heartbeats, looked up by the scheduler
+        indexes = [models.Index(fields=["status", "last_seen"])]
+
+    def __str__(self):
+        return f"{self.id}: {self.status}"
@@ -0,0 +1,137 @@
+import base64
+import json
+from django.conf import settings
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db import connection
+from django.db.models import BooleanField, Q
+from django.db.models.expressions import RawSQL
+from rest_framework import filters
+from rest_framework.exceptions import ValidationError
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class TaskCursorPagination(BasePagination):
+    # Keyset pagination for task lists. The ordering of the OrderingFilter is completed with created_at
+    # and id, so every row has a unique position, and the cursor holds those values of the last row of
+    # the page. The next page is the rows after that position: a range scan on the ordering index that
+    # costs the same on the first page and on the millionth, unlike OFFSET.
+    cursor_query_param = "cursor"
+    page_size_query_param = "page_size"
+    tiebreakers = ("created_at", "id")
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.model = queryset.model
+        self.page_size = self.get_page_size(request)
+        self.ordering = self.get_ordering(request, queryset, view)
+        queryset = queryset.order_by(*self.ordering)
+
+        position = self.decode_cursor(request)
+        if position is not None:
+            queryset = queryset.filter(self.after(position))
+
+        rows = list(queryset[: self.page_size + 1])
+        self.has_next = len(rows) > self.page_size
+        self.page = rows[: self.page_size]
+        return self.page
+
+    def get_paginated_response(self, data):
+        return Response({"next": self.get_next_link(), "results": data})
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(
+                request.query_params.get(
+                    self.page_size_query_param, settings.TASK_LIST_PAGE_SIZE
+                )
+            )
+        except ValueError:
+            raise ValidationError({self.page_size_query_param: "Invalid page size."})
+        return max(1, min(page_size, settings.TASK_LIST_MAX_PAGE_SIZE))
+
+    # Requested ordering followed by the tiebreakers, in the direction of the first ordering field
+    def get_ordering(self, request, queryset, view):
+        ordering = list(
+            filters.OrderingFilter().get_ordering(request, queryset, view) or []
+        )
+        descending = bool(ordering) and ordering[0].startswith("-")
+        names = {field.lstrip("-") for field in ordering}
+        for name in self.tiebreakers:
+            if name not in names:
+                ordering.append(f"-{name}" if descending else name)
+        return ordering
+
+    # Rows strictly after `position` in the ordering
+    def after(self, position):
+        directions = {field.startswith("-") for field in self.ordering}
+        if len(directions) == 1:
+            return self.after_row(position, directions.pop())
+        return self.after_nested(list(zip(self.ordering, position)))
+
+    # (a, b, id) > (x, y, z) is a single index range on PostgreSQL and SQLite
+    def after_row(self, position, descending):
+        quote = connection.ops.quote_name
+        table = quote(self.model._meta.db_table)
+        fields = [self.field(field.lstrip("-")) for field in self.ordering]
+        columns = ", ".join(f"{table}.{quote(field.column)}" for field in fields)
+        placeholders = ", ".join(["%s"] * len(fields))
+        operator = "<" if descending else ">"
+        return RawSQL(
+            f"({columns}) {operator} ({placeholders})",
+            [
+                field.get_db_prep_value(value, connection)
+                for field, value in zip(fields, position)
+            ],
+            output_field=BooleanField(),
+        )
+
+    # Mixed directions: a >= x and (a > x or (a = x and <rest after>)), the leading bound of every
+    # level keeps the scan on the ordering index
+    def after_nested(self, levels):
+        field, value = levels[0]
+        name = field.lstrip("-")
+        strict, bound = ("lt", "lte") if field.startswith("-") else ("gt", "gte")
+        if len(levels) == 1:
+            return Q(**{f"{name}__{strict}": value})
+        return Q(**{f"{name}__{bound}": value}) & (
+            Q(**{f"{name}__{strict}": value})
+            | (Q(**{name: value}) & self.after_nested(levels[1:]))
+        )
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        last = self.page[-1]
+        position = [
+            self.field(name).value_to_string(last)
+            for name in (field.lstrip("-") for field in self.ordering)
+        ]
+        cursor = json.dumps({"ordering": self.ordering, "position": position})
+        return replace_query_param(
+            self.request.build_absolute_uri(),
+            self.cursor_query_param,
+            base64.urlsafe_b64encode(cursor.encode()).decode(),
+        )
+
+    # Position of the cursor, None on the first page
+    # A cursor of another ordering is rejected instead of returning rows from the wrong position
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            cursor = json.loads(base64.urlsafe_b64decode(encoded))
+            position = cursor["position"]
+            if cursor["ordering"] != self.ordering or len(position) != len(self.ordering):
+                raise ValueError("Cursor of another ordering")
+            return [
+                self.field(field.lstrip("-")).to_python(value)
+                for field, value in zip(self.ordering, position)
+            ]
+        except (ValueError, KeyError, TypeError, DjangoValidationError):
+            raise ValidationError({self.cursor_query_param: "Invalid cursor."})
+
+    def field(self, name):
+        return self.model._meta.get_field(name)
@@ -0,0 +1,305 @@
+import os
+import threading
+import logging
+from concurrent.futures import Future
+import pika
+from pika.exceptions import AMQPChannelError, AMQPConnectionError
+
+logger = logging.getLogger("task_manager")
+
+
+class PublishNackedError(Exception):
+    def __init__(self, delivery_tag):
+        self.delivery_tag = delivery_tag
+        super().__init__(f"Broker rejected message with delivery tag {delivery_tag}")
+
+
+class ConfirmPublisher:
+    # Publishes messages on a channel in publisher-confirm mode driven by a dedicated IO thread.
+    # Publishing never waits for the broker: every message gets a Future that is resolved when the
+    # broker acks or nacks it. At most `max_outstanding` messages can be unconfirmed at once, further
+    # publishes block until the window has room again, for up to `publish_timeout` seconds.
+    def __init__(
+        self, parameters, max_outstanding=1000, connect_timeout=10, publish_timeout=30
+    ):
+        self.parameters = parameters
+        self.connect_timeout = connect_timeout
+        self.publish_timeout = publish_timeout
+        self._window = threading.BoundedSemaphore(max_outstanding)
+        self._lock = threading.Lock()
+        # Futures of the publishes handed to the IO thread but not sent yet. Whoever removes a future
+        # from the set, under the lock, releases its window slot and settles it.
+        self._queued = set()
+        self._queued_lock = threading.Lock()
+        # Set once the IO loop has stopped, no callback scheduled on it will run anymore
+        self._stopped = False
+        self._ready = threading.Event()
+        self._thread = None
+        self._connection = None
+        self._channel = None
+        self._error = None
+        self._closed = False
+        # Only touched from the IO thread
+        self._pending = {}
+        self._delivery_tag = 0
+        self._declared = set()
+        self._declaring = set()
+
+    @property
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        with self._lock:
+            # The IO thread exits once its connection is closed, wait for it before reconnecting
+            if self.is_running and self._closed:
+                self._thread.join(self.connect_timeout)
+            if not self.is_running:
+                self._ready.clear()
+                self._error = None
+                self._closed = False
+                self._stopped = False
+                self._thread = threading.Thread(
+                    target=self._run, name="confirm-publisher", daemon=True
+                )
+                self._thread.start()
+
+        if not self._ready.wait(self.connect_timeout):
+            raise AMQPConnectionError("Timed out opening the publisher channel")
+        if self._error is not None:
+            raise AMQPConnectionError(
+                f"Could not open the publisher connection: {self._error!r}"
+            )
+
+    def close(self):
+        with self._lock:
+            if not self.is_running:
+                return
+            self._connection.ioloop.add_callback_threadsafe(self._close_connection)
+            thread = self._thread
+        thread.join(self.connect_timeout)
+
+    def publish(self, exchange, routing_key, body, properties=None, callback=None):
+        self.start()
+        future = Future()
+        if callback is not None:
+            future.add_done_callback(callback)
+
+        # Back pressure: wait for a slot in the window of unconfirmed deliveries
+        if not self._window.acquire(timeout=self.publish_timeout):
+            raise AMQPConnectionError(
+                f"Timed out waiting for a confirm window slot ({self.publish_timeout}s)"
+            )
+        with self._queued_lock:
+            if self._stopped:
+                self._window.release()
+                raise AMQPConnectionError("Publisher connection is closed")
+            self._queued.add(future)
+        try:
+            self._connection.ioloop.add_callback_threadsafe(
+                lambda: self._basic_publish(
+                    exchange, routing_key, body, properties, future
+                )
+            )
+        except Exception:
+            if self._claim(future):
+                self._window.release()
+            raise
+        return future
+
+    def _claim(self, future):
+        with self._queued_lock:
+            if future not in self._queued:
+                return False
+            self._queued.discard(future)
+            return True
+
+    def declare_queue(self, queue, arguments=None):
+        return self.declare(
+            queue,
+            [("queue_declare", {"queue": queue, "durable": True, "arguments": arguments})],
+        )
+
+    # Run a sequence of (channel method, kwargs) declarations in order
+    # Declarations are cached per channel under `key`, they run once until the channel reopens
+    def declare(self, key, operations):
+        self.start()
+        future = Future()
+        if key in self._declared:
+            # Already declared on the current channel, skip the hop to the IO thread
+            future.set_result(key)
+            return future
+        self._connection.ioloop.add_callback_threadsafe(
+            lambda: self._declare(key, list(operations), future)
+        )
+        return future
+
+    # The methods below run on the IO thread
+
+    def _run(self):
+        try:
+            self._connection = pika.SelectConnection(
+                self.parameters,
+                on_open_callback=self._on_connection_open,
+                on_open_error_callback=self._on_connection_open_error,
+                on_close_callback=self._on_connection_closed,
+            )
+            self._connection.ioloop.start()
+        except Exception as e:
+            logger.error(f"Confirm publisher IO loop crashed: {e}")
+            self._error = e
+            self._closed = True
+            self._fail_pending(e)
+            self._ready.set()
+        finally:
+            # Publishes scheduled on the stopped loop never run, fail them and free their slots
+            with self._queued_lock:
+                self._stopped = True
+            self._fail_pending("Publisher IO loop stopped")
+
+    def _on_connection_open(self, connection):
+        connection.channel(on_open_callback=self._on_channel_open)
+
+    def _on_connection_open_error(self, connection, error):
+        self._error = error
+        self._closed = True
+        self._ready.set()
+        connection.ioloop.stop()
+
+    def _on_connection_closed(self, connection, reason):
+        logger.warning(f"Confirm publisher connection closed: {reason}")
+        self._channel = None
+        self._closed = True
+        self._fail_pending(reason)
+        connection.ioloop.stop()
+
+    def _on_channel_open(self, channel):
+        self._channel = channel
+        self._delivery_tag = 0
+        self._declared = set()
+        channel.add_on_close_callback(self._on_channel_closed)
+        channel.confirm_delivery(
+            ack_nack_callback=self._on_delivery_confirmation,
+            callback=lambda frame: self._ready.set(),
+        )
+
+    def _on_channel_closed(self, channel, reason):
+        logger.warning(f"Confirm publisher channel closed: {reason}")
+        self._channel = None
+        self._fail_pending(reason)
+        if self._connection.is_open:
+            self._connection.close()
+
+    def _close_connection(self):
+        if self._connection.is_open:
+            self._connection.close()
+        else:
+            self._connection.ioloop.stop()
+
+    def _basic_publish(self, exchange, routing_key, body, properties, future):
+        # Already failed by _fail_pending
+        if not self._claim(future):
+            return
+        if self._channel is None or not self._channel.is_open:
+            self._window.release()
+            future.set_exception(AMQPChannelError("Publisher channel is closed"))
+            return
+        try:
+            self._channel.basic_publish(exchange, routing_key, body, properties)
+        except Exception as e:
+            self._window.release()
+            future.set_exception(e)
+            return
+        # The broker numbers deliveries on the channel in publish order, starting at 1
+        self._delivery_tag += 1
+        self._pending[self._delivery_tag] = future
+
+    def _declare(self, key, operations, future):
+        if key in self._declared:
+            future.set_result(key)
+            return
+        if self._channel is None or not self._channel.is_open:
+            future.set_exception(AMQPChannelError("Publisher channel is closed"))
+            return
+
+        channel = self._channel
+        self._declaring.add(future)
+        remaining = iter(operations)
+
+        # Each declaration is sent once the broker has answered the previous one
+        def next_operation(frame=None):
+            operation = next(remaining, None)
+            if operation is None:
+                self._declaring.discard(future)
+                self._declared.add(key)
+                future.set_result(key)
+                return
+            method, kwargs = operation
+            getattr(channel, method)(callback=next_operation, **kwargs)
+
+        next_operation()
+
+    def _on_delivery_confirmation(self, frame):
+        method = frame.method
+        acked = isinstance(method, pika.spec.Basic.Ack)
+        # With `multiple` set the broker confirms every delivery up to and including the tag
+        if method.multiple:
+            tags = sorted(tag for tag in self._pending if tag <= method.delivery_tag)
+        else:
+            tags = [method.delivery_tag]
+
+        for tag in tags:
+            future = self._pending.pop(tag, None)
+            if future is None:
+                continue
+            self._window.release()
+            if acked:
+                future.set_result(tag)
+            else:
+                future.set_exception(PublishNackedError(tag))
+
+    def _fail_pending(self, reason):
+        pending, self._pending = self._pending, {}
+        with self._queued_lock:
+            queued, self._queued = self._queued, set()
+        for future in list(pending.values()) + list(queued):
+            self._window.release()
+            future.set_exception(AMQPConnectionError(str(reason)))
+        # A failed declaration closes the channel, its future fails here
+        declaring, self._declaring = self._declaring, set()
+        for future in declaring:
+            future.set_exception(AMQPChannelError(str(reason)))
+
+
+_publishers = {}
+_publishers_lock = threading.Lock()
+
+
+def _reset_publishers_after_fork():
+    global _publishers_lock
+    # A forked child must not reuse the IO thread and socket of its parent
+    _publishers_lock = threading.Lock()
+    _publishers.clear()
+
+
+os.register_at_fork(after_in_child=_reset_publishers_after_fork)
+
+
+# Get the process-wide confirm publisher for the given connection parameters
+def get_publisher(parameters, max_outstanding=1000, publish_timeout=30):
+    key = (
+        parameters.host,
+        parameters.port,
+        parameters.virtual_host,
+        parameters.credentials.username,
+    )
+    with _publishers_lock:
+        publisher = _publishers.get(key)
+        if publisher is None:
+            publisher = ConfirmPublisher(
+                parameters,
+                max_outstanding=max_outstanding,
+                publish_timeout=publish_timeout,
+            )
+            _publishers[key] = publisher
+        return publisher
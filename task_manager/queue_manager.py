@@ -1,9 +1,19 @@
 import pika
 import json
+import time
+from concurrent.futures import Future, wait
 from django.conf import settings
+from .publisher import get_publisher
+from .connection_pool import get_connection_parameters, get_pool
+from . import cancellation, delayed, dispatcher, message_codecs, routing
 
 
 class QueueManager:
+    # confirm: messages are pipelined and confirmed asynchronously by the broker (default)
+    # transactional: every publish is committed with a synchronous tx_commit round trip
+    PUBLISH_MODE_CONFIRM = "confirm"
+    PUBLISH_MODE_TRANSACTIONAL = "transactional"
+
     def __init__(
         self,
         host=None,
@@ -11,160 +21,321 @@ class QueueManager:
         virtual_host=None,
         username=None,
         password=None,
-        queue_name="task_queue",
+        queue_name=None,
+        publish_mode=None,
+        codec=None,
     ):
         self.host = host or settings.RABBITMQ_HOST
         self.port = port or settings.RABBITMQ_PORT
         self.virtual_host = virtual_host or settings.RABBITMQ_VIRTUAL_HOST
         self.username = username or settings.RABBITMQ_USERNAME
         self.password = password or settings.RABBITMQ_PASSWORD
-        self.queue_name = queue_name
-        self.default_routing_key = queue_name
+        # Queue of the tasks that are not routed elsewhere, see routing.py
+        self.queue_name = queue_name or settings.TASK_DEFAULT_QUEUE
+        self.publish_mode = publish_mode or settings.RABBITMQ_PUBLISH_MODE
+        # Encoding of task messages, see message_codecs.py
+        self.codec = message_codecs.get_codec(codec)
         self.connection = None
         self.channel = None
+        self.publisher = None
+        self.lease = None
         # Note: The connection and channel are created in the constructor, but the connection is not opened until the `connect` method is called, allowing for better flexibility and resource management.
 
+    @property
+    def confirm_mode(self):
+        return self.publish_mode == self.PUBLISH_MODE_CONFIRM
+
+    @property
+    def is_connected(self):
+        if self.confirm_mode:
+            return self.publisher is not None
+        return self.connection is not None and self.connection.is_open
+
+    def get_connection_parameters(self):
+        return get_connection_parameters(
+            self.host, self.port, self.virtual_host, self.username, self.password
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
     def connect(self):
-        if self.connection is None or self.connection.is_closed:
-            credentials = pika.PlainCredentials(self.username, self.password)
-            parameters = pika.ConnectionParameters(
-                host=self.host,
-                port=self.port,
-                virtual_host=self.virtual_host,
-                credentials=credentials,
-            )
-            self.connection = pika.BlockingConnection(parameters)
-            self.channel = self.connection.channel()
-            self.channel.queue_declare(
-                queue=self.queue_name, durable=True, arguments={"x-max-priority": 3}
+        if self.confirm_mode:
+            # Confirm mode publishes through the process-wide publisher shared by all queue managers
+            if self.publisher is None:
+                self.publisher = get_publisher(
+                    self.get_connection_parameters(),
+                    max_outstanding=settings.RABBITMQ_CONFIRM_WINDOW,
+                    publish_timeout=settings.RABBITMQ_CONFIRM_TIMEOUT,
+                )
+            self._declare_route(self.queue_name)
+        elif self.connection is None or self.connection.is_closed:
+            self.close()
+            # Borrow a channel with transactions enabled from the process-wide pool
+            self.lease = get_pool(self.get_connection_parameters()).acquire(
+                transactional=True
             )
-            self.channel.tx_select()  # Enable transactions for the channel
+            self.connection = self.lease.connection
+            self.channel = self.lease.channel
+            self._declare_route(self.queue_name)
 
+    # Return the borrowed channel to the pool, the connection itself stays open for reuse
     def close(self):
-        if self.connection and self.connection.is_open:
-            self.connection.close()
+        if self.lease is not None:
+            get_pool(self.get_connection_parameters()).release(self.lease)
+            self.lease = None
+            self.connection = None
+            self.channel = None
 
     # generic method to publish a message to a queue
-    def publish_message(self, message, routing_key=None, priority=None, delay=0):
-        try:
-            if not self.connection or self.connection.is_closed:
-                self.connect()
-
-            if routing_key is None:
-                routing_key = self.queue_name
-
-            if not isinstance(message, str):
-                message = json.dumps(message)
-
-            properties = pika.BasicProperties(delivery_mode=2)
-
-            if priority is not None:
-                properties.priority = priority
-
-            if delay > 0:
-                # Create a delay queue
-                delay_queue_name = f"{self.queue_name}_delay"
-                self.channel.queue_declare(
-                    queue=delay_queue_name,
-                    durable=True,
-                    arguments={
-                        "x-message-ttl": delay,
-                        "x-dead-letter-exchange": "",
-                        "x-dead-letter-routing-key": routing_key,
-                    },
-                )
-
-                # Publish the message to the delay queue
-                self.channel.basic_publish(
-                    exchange="",
-                    routing_key=delay_queue_name,
-                    body=message,
-                    properties=properties,
-                )
+    # Returns a future that resolves once the broker has confirmed the message
+    # A message with a delay (in milliseconds) is delivered once the delay has elapsed, see delayed.py
+    def publish_message(
+        self,
+        message,
+        routing_key=None,
+        priority=None,
+        delay=0,
+        callback=None,
+        headers=None,
+        content_type=None,
+        exchange="",
+    ):
+        if not self.is_connected:
+            self.connect()
 
-            else:
-                self.channel.basic_publish(
-                    exchange="",
-                    routing_key=routing_key,
-                    body=message,
-                    properties=properties,
-                )
+        if self.confirm_mode:
+            return self._publish(
+                message,
+                routing_key,
+                priority,
+                delay,
+                callback,
+                headers,
+                content_type,
+                exchange,
+            )
 
+        try:
+            self._publish(
+                message,
+                routing_key,
+                priority,
+                delay,
+                headers=headers,
+                content_type=content_type,
+                exchange=exchange,
+            )
             self.channel.tx_commit()  # Commit the transaction
         except Exception as e:
             self.channel.tx_rollback()  # Rollback the transaction
             raise e
+        return self._committed_future(callback)
 
-    # explict method to publish a message to the default queue - task_queue
-    def submit_task(self, task):
-        delay = 0
-        # Publish all dependencies to the queue first
-        all_dependencies = task.get_all_dependencies()
-        for dependency in all_dependencies:
-            is_ready = dependency.is_ready_to_run()
-
-            if not is_ready:
-                delay = 60000  # 1 minute
-            else:
-                delay = 0
-
-            self.publish_message(
-                {
-                    "id": str(dependency.id),
-                    "title": dependency.title,
-                    "description": dependency.description,
-                    "priority": dependency.priority,
-                },
-                self.default_routing_key,
-                dependency.priority,
-                delay=delay,
+    # Publish a message without waiting for the broker
+    # In transactional mode the message is only delivered once the caller commits the channel
+    def _publish(
+        self,
+        message,
+        routing_key=None,
+        priority=None,
+        delay=0,
+        callback=None,
+        headers=None,
+        content_type=None,
+        exchange="",
+    ):
+        if routing_key is None:
+            routing_key = self.queue_name
+
+        if not isinstance(message, (str, bytes)):
+            message = json.dumps(message)
+            content_type = content_type or "application/json"
+
+        properties = pika.BasicProperties(
+            delivery_mode=2, headers=headers, content_type=content_type
+        )
+
+        if priority is not None:
+            properties.priority = priority
+
+        if delay > 0:
+            # The delay levels and the binding of the destination are declared once per channel
+            self._declare("task_delay", delayed.topology())
+            self._declare(f"task_delay:{routing_key}", delayed.destination(routing_key))
+            exchange = delayed.entry_exchange()
+            routing_key = delayed.routing_key(routing_key, delay)
+
+        if self.confirm_mode:
+            return self.publisher.publish(
+                exchange, routing_key, message, properties, callback=callback
             )
 
-        is_ready = task.is_ready_to_run()
+        self.channel.basic_publish(
+            exchange=exchange,
+            routing_key=routing_key,
+            body=message,
+            properties=properties,
+        )
 
-        # Publish the task itself to the queue
-        if not is_ready:
-            delay = 60000
+    def _declare(self, key, operations):
+        if self.confirm_mode:
+            self.publisher.declare(key, operations).result(
+                timeout=settings.RABBITMQ_CONFIRM_TIMEOUT
+            )
         else:
-            delay = 0
+            self.lease.declare(key, operations)
 
-        message = {
-            "id": str(task.id),
-            "title": task.title,
-            "description": task.description,
-            "priority": task.priority,
-        }
-        self.publish_message(message, self.default_routing_key, task.priority, delay)
-
-    def publish_to_delay_queue(self, channel, task, delay=60000):
-        delay_queue_name = f"{self.queue_name}_delay"
-        channel.queue_declare(
-            queue=delay_queue_name,
-            durable=True,
-            arguments={
-                "x-message-ttl": delay,
-                "x-dead-letter-exchange": "",
-                "x-dead-letter-routing-key": self.default_routing_key,
-            },
+    @staticmethod
+    def _committed_future(callback=None):
+        future = Future()
+        if callback is not None:
+            future.add_done_callback(callback)
+        future.set_result(None)
+        return future
+
+    # Wait until the broker has confirmed every future, raising the first failure
+    @staticmethod
+    def wait_for_confirms(futures, timeout=None):
+        timeout = timeout or settings.RABBITMQ_CONFIRM_TIMEOUT
+        done, not_done = wait(futures, timeout=timeout)
+        if not_done:
+            raise TimeoutError(
+                f"{len(not_done)} messages were not confirmed within {timeout}s"
+            )
+        for future in done:
+            future.result()
+
+    # Publish a single task without its dependencies
+    def publish_task(self, task, delay=0, callback=None):
+        if not self.is_connected:
+            self.connect()
+        return self.publish_message(
+            self.codec.encode(task),
+            self._route(task),
+            task.priority,
+            delay,
+            callback,
+            exchange=routing.TASK_EXCHANGE,
+            **self._task_properties(delay),
+        )
+
+    # Publish a task encoded with the codec without waiting for the broker
+    def _publish_task(self, task):
+        return self._publish(
+            self.codec.encode(task),
+            self._route(task),
+            task.priority,
+            exchange=routing.TASK_EXCHANGE,
+            **self._task_properties(),
         )
 
-        properties = pika.BasicProperties(delivery_mode=2)
+    # Queue of a task's priority level, its queue is declared and bound once per channel before the
+    # first task is routed to it
+    def _route(self, task):
+        queue = routing.queue_for(task, self.queue_name)
+        self._declare_route(queue)
+        return routing.priority_queue(queue, task.priority)
+
+    def _declare_route(self, queue):
+        self._declare(f"route:{queue}", routing.topology(queue))
 
-        if task.priority is not None:
-            properties.priority = task.priority
+    # Content type and schema version the consumers decode the task messages with
+    def _codec_properties(self):
+        return {
+            "headers": {message_codecs.SCHEMA_HEADER: self.codec.version},
+            "content_type": self.codec.content_type,
+        }
+
+    # Codec properties and the time the task becomes ready, delays are in milliseconds
+    def _task_properties(self, delay=0):
+        properties = self._codec_properties()
+        properties["headers"][routing.READY_AT_HEADER] = time.time() + delay / 1000
+        return properties
 
-        message = json.dumps(
-            {
-                "id": str(task.id),
-                "title": task.title,
-                "description": task.description,
-                "priority": task.priority,
-            }
+    # Park a message that cannot be processed in the dead-letter queue of `queue`, where it no longer
+    # holds up the queue and can be inspected
+    def dead_letter(self, message, reason, queue=None):
+        if not self.is_connected:
+            self.connect()
+        queue = f"{queue or self.queue_name}_dead_letter"
+        self._declare(
+            queue,
+            [("queue_declare", {"queue": queue, "durable": True, "arguments": None})],
         )
-        # Publish the message to the delay queue
-        channel.basic_publish(
-            exchange="",
-            routing_key=delay_queue_name,
-            body=message,
-            properties=properties,
+        return self.publish_message(
+            message, queue, headers={"x-dead-letter-reason": reason}
         )
+
+    # Send a control message to every running worker process, see cancellation.py
+    # Control messages are transient, a worker that is not connected has nothing to act on
+    def broadcast(self, message):
+        if not self.is_connected:
+            self.connect()
+        self._declare(cancellation.CONTROL_EXCHANGE, cancellation.topology())
+        body = json.dumps(message)
+        properties = pika.BasicProperties(content_type="application/json")
+        if self.confirm_mode:
+            return self.publisher.publish(
+                cancellation.CONTROL_EXCHANGE, "", body, properties
+            )
+        try:
+            self.channel.basic_publish(
+                exchange=cancellation.CONTROL_EXCHANGE,
+                routing_key="",
+                body=body,
+                properties=properties,
+            )
+            self.channel.tx_commit()
+        except Exception as e:
+            self.channel.tx_rollback()
+            raise e
+        return self._committed_future()
+
+    @staticmethod
+    def task_message(task):
+        return message_codecs.task_fields(task)
+
+    # explict method to publish a task to its queue
+    def submit_task(self, task):
+        return self.submit_tasks([task])
+
+    # Submit tasks for execution, together with their dependencies that were never submitted
+    # Tasks whose dependencies have not completed yet are held back as waiting, dispatcher.release_dependents
+    # publishes them once their last dependency completes. Tasks scheduled in the future are held back as
+    # scheduled until the scheduler publishes them.
+    def submit_tasks(self, tasks):
+        ready = dispatcher.claim_for_submission(tasks)
+        try:
+            self.publish_tasks(ready)
+        except Exception:
+            dispatcher.revert_submission(ready)
+            raise
+        return len(ready)
+
+    # Publish a batch of tasks with a single commit or a single wait for publisher confirms
+    def publish_tasks(self, tasks):
+        if not tasks:
+            return 0
+
+        if not self.is_connected:
+            self.connect()
+
+        if self.confirm_mode:
+            # Every message is in flight at once, the broker confirms them as a pipeline
+            futures = [self._publish_task(task) for task in tasks]
+            self.wait_for_confirms(futures)
+            return len(tasks)
+
+        try:
+            for task in tasks:
+                self._publish_task(task)
+
+            self.channel.tx_commit()  # One broker round trip for the whole batch
+        except Exception as e:
+            self.channel.tx_rollback()
+            raise e
+        return len(tasks)
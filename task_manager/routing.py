@@ -0,0 +1,187 @@
+import time
+from collections import deque
+from django.conf import settings
+from .models import Task
+
+# Routing of tasks to named queues.
+# Every task queue is bound to the TASK_EXCHANGE direct exchange under its own name, and a task is
+# published with its queue as routing key: the task's own `queue`, else the queue TASK_ROUTES maps its
+# task type to, else the default queue of the publisher. Slow and fast workloads get queues of their
+# own, so fast tasks never wait behind a backlog of slow ones, and workers consume the queues they are
+# sized for with a weight each.
+# Every priority level of a queue is a first in first out queue of its own, "<queue>.p<level>". In a
+# single broker priority queue a steady stream of high priority tasks starves the lower ones: the
+# broker never delivers them. Split by level, every level is delivered up to the prefetch count and
+# the worker picks among the oldest deliveries of the levels with priority aging, see AgingQueue.
+
+TASK_EXCHANGE = "tasks"
+# Arguments of the queue "<queue>" itself, the broker rejects a redeclaration with other arguments.
+# Tasks were published there before they were split by priority, workers still drain it.
+QUEUE_ARGUMENTS = {"x-max-priority": 3}
+# Header with the time a task message becomes ready, its publication plus its delay, its priority
+# ages from then on
+READY_AT_HEADER = "x-ready-at"
+PRIORITY_LEVELS = [priority for priority, _ in Task.PRIORITY_CHOICES]
+DEFAULT_PRIORITY = Task._meta.get_field("priority").default
+
+
+def queue_for(task, default=None):
+    return (
+        task.queue
+        or settings.TASK_ROUTES.get(task.task_type)
+        or default
+        or settings.TASK_DEFAULT_QUEUE
+    )
+
+
+# Queue of the tasks of `priority` in `queue`, also the routing key they are published with
+def priority_queue(queue, priority):
+    return f"{queue}.p{priority}"
+
+
+# Queues of every priority level of `queue`, highest first
+def priority_queues(queue):
+    return [priority_queue(queue, level) for level in reversed(PRIORITY_LEVELS)]
+
+
+# Declarations of the priority level queues of a task queue and their bindings, as (channel method,
+# kwargs) pairs
+def topology(queue):
+    operations = [
+        (
+            "exchange_declare",
+            {"exchange": TASK_EXCHANGE, "exchange_type": "direct", "durable": True},
+        )
+    ]
+    for name in priority_queues(queue):
+        operations += [
+            ("queue_declare", {"queue": name, "durable": True, "arguments": None}),
+            (
+                "queue_bind",
+                {"queue": name, "exchange": TASK_EXCHANGE, "routing_key": name},
+            ),
+        ]
+    return operations
+
+
+# Declarations of the queues a worker consumes for a task queue: its priority levels and the queue
+# "<queue>" itself
+def consumer_topology(queue):
+    return topology(queue) + [
+        (
+            "queue_declare",
+            {"queue": queue, "durable": True, "arguments": QUEUE_ARGUMENTS},
+        )
+    ]
+
+
+# Priority level and ready time of a task message
+# Messages of earlier publishers carry no ready time, they age from their delivery
+def message_priority(priority, headers):
+    ready_at = (headers or {}).get(READY_AT_HEADER)
+    return priority or DEFAULT_PRIORITY, time.time() if ready_at is None else ready_at
+
+
+# Parse "fast:3,reports" into [("fast", 3), ("reports", 1)]
+def parse_queues(spec):
+    queues = []
+    for part in spec.split(","):
+        name, _, weight = part.strip().partition(":")
+        if not name:
+            continue
+        try:
+            weight = int(weight) if weight else 1
+        except ValueError:
+            raise ValueError(f"Invalid weight of queue {name}: {weight}")
+        if weight < 1:
+            raise ValueError(f"Weight of queue {name} must be at least 1")
+        queues.append((name, weight))
+    if not queues:
+        raise ValueError("No queue to consume")
+    if len({name for name, _ in queues}) != len(queues):
+        raise ValueError("A queue is listed more than once")
+    return queues
+
+
+class AgingQueue:
+    # Deliveries of one queue by priority level, first in first out within a level. pop() takes the
+    # oldest delivery of the level whose oldest delivery has the highest effective priority: its level
+    # plus one for every `aging_interval` seconds since it became ready, ties go to the higher level.
+    # A task that waited long enough overtakes newer tasks of any level, a stream of higher priority
+    # tasks holds it back by at most (highest level - its level) * aging_interval. Without an interval
+    # the levels are served strictly by priority.
+    def __init__(self, aging_interval=None):
+        self.aging_interval = aging_interval
+        self._levels = {}
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def push(self, item, level, ready_at):
+        pending = self._levels.get(level)
+        if pending is None:
+            pending = self._levels[level] = deque()
+        pending.append((ready_at, item))
+        self._size += 1
+
+    def items(self):
+        for pending in self._levels.values():
+            for _, item in pending:
+                yield item
+
+    def pop(self, now=None):
+        if self.aging_interval and now is None:
+            now = time.time()
+        chosen = None
+        for level, pending in self._levels.items():
+            if not pending:
+                continue
+            effective = level
+            if self.aging_interval:
+                effective += max(now - pending[0][0], 0) / self.aging_interval
+            if chosen is None or (effective, level) > (best, chosen):
+                chosen, best = level, effective
+        if chosen is None:
+            raise IndexError("pop from empty AgingQueue")
+        self._size -= 1
+        return self._levels[chosen].popleft()[1]
+
+
+class WeightedQueues:
+    # Deliveries buffered per queue and handed out by smooth weighted round robin. While several queues
+    # have deliveries waiting, a queue of weight 3 gets three of every four free slots next to a queue
+    # of weight 1, interleaved rather than in bursts. An empty queue does not hold back the others.
+    # Within a queue deliveries are taken by aging priority, see AgingQueue.
+    def __init__(self, weights, aging_interval=None):
+        self.weights = dict(weights)
+        self._pending = {queue: AgingQueue(aging_interval) for queue in self.weights}
+        self._current = dict.fromkeys(self.weights, 0)
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def push(self, queue, item, level=DEFAULT_PRIORITY, ready_at=0.0):
+        self._pending[queue].push(item, level, ready_at)
+        self._size += 1
+
+    def items(self):
+        for pending in self._pending.values():
+            yield from pending.items()
+
+    def pop(self, now=None):
+        chosen = None
+        total = 0
+        for queue, pending in self._pending.items():
+            if not pending:
+                continue
+            self._current[queue] += self.weights[queue]
+            total += self.weights[queue]
+            if chosen is None or self._current[queue] > self._current[chosen]:
+                chosen = queue
+        if chosen is None:
+            raise IndexError("pop from empty WeightedQueues")
+        self._current[chosen] -= total
+        self._size -= 1
+        return self._pending[chosen].pop(now)
@@ -0,0 +1,121 @@
+import heapq
+import threading
+import logging
+from datetime import timedelta
+from django import db
+from django.conf import settings
+from django.utils import timezone
+from .models import Task
+from .queue_manager import QueueManager
+from . import counters, dispatcher, heartbeats
+
+logger = logging.getLogger("task_manager")
+
+
+class Scheduler:
+    # Publishes scheduled tasks when they are due, without bouncing them through the broker.
+    # Every `poll_interval` seconds the tasks due before the next poll are loaded from the partial index
+    # on scheduled_at into a heap, and the scheduler sleeps until the earliest of them is due.
+    # Publishing goes through dispatcher.release_scheduled, which claims every task once.
+    # Every `reconcile_interval` seconds it also reconciles the task counters with the task table, and
+    # every `recover_interval` seconds it retries the tasks of dead workers, see heartbeats.py.
+    def __init__(
+        self,
+        poll_interval=5,
+        batch_size=1000,
+        reconcile_interval=300,
+        recover_interval=10,
+    ):
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self.reconcile_interval = reconcile_interval
+        self.recover_interval = recover_interval
+        self._heap = []
+        # (scheduled_at, task id) entries in the heap, a rescheduled task gets a second entry
+        self._entries = set()
+        self._stopping = threading.Event()
+
+    def run(self):
+        logger.info(f"Scheduler started, polling every {self.poll_interval}s")
+        next_poll = timezone.now()
+        next_reconcile = timezone.now()
+        next_recover = timezone.now()
+        while not self._stopping.is_set():
+            db.close_old_connections()
+            if timezone.now() >= next_reconcile:
+                next_reconcile = timezone.now() + timedelta(
+                    seconds=self.reconcile_interval
+                )
+                try:
+                    counters.reconcile()
+                except Exception as e:
+                    logger.error(f"Task counter reconciliation failed: {e}")
+            if timezone.now() >= next_recover:
+                next_recover = timezone.now() + timedelta(seconds=self.recover_interval)
+                try:
+                    heartbeats.recover_dead_workers()
+                except Exception as e:
+                    logger.error(f"Recovery of dead workers failed: {e}")
+            try:
+                if timezone.now() >= next_poll:
+                    next_poll = timezone.now() + timedelta(seconds=self.poll_interval)
+                    # A full batch may have left out tasks due after its last one, poll again once
+                    # that one is due: right away while the due tasks do not fit in one batch
+                    last = self.poll()
+                    if last is not None:
+                        next_poll = min(next_poll, last)
+                self.publish_due()
+            except Exception as e:
+                logger.error(f"Scheduler pass failed: {e}")
+                next_poll = timezone.now() + timedelta(seconds=self.poll_interval)
+
+            wake_at = min(next_poll, next_reconcile, next_recover)
+            if self._heap:
+                wake_at = min(wake_at, self._heap[0][0])
+            self._stopping.wait(max(0, (wake_at - timezone.now()).total_seconds()))
+        logger.info("Scheduler stopped")
+
+    def stop(self):
+        self._stopping.set()
+
+    # Load the scheduled tasks due before the next poll
+    # Returns the due time of the last task of a full batch, None when every due task was loaded
+    def poll(self):
+        horizon = timezone.now() + timedelta(seconds=self.poll_interval)
+        due = Task.objects.filter(
+            status=Task.STATUS_SCHEDULED, scheduled_at__lte=horizon
+        ).order_by("scheduled_at")
+        rows = list(due.values_list("scheduled_at", "id")[: self.batch_size])
+        for entry in rows:
+            if entry not in self._entries:
+                self._entries.add(entry)
+                heapq.heappush(self._heap, entry)
+        if len(rows) < self.batch_size:
+            return None
+        return rows[-1][0]
+
+    def publish_due(self):
+        now = timezone.now()
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            entry = heapq.heappop(self._heap)
+            self._entries.discard(entry)
+            due.append(entry[1])
+        if not due:
+            return []
+        # Entries of tasks that were cancelled, rescheduled or already claimed are skipped by the claim
+        with QueueManager() as queue_manager:
+            return dispatcher.release_scheduled(due, queue_manager)
+
+
+def start_scheduler(poll_interval=None, batch_size=None):
+    scheduler = Scheduler(
+        poll_interval=poll_interval or settings.SCHEDULER_POLL_INTERVAL,
+        batch_size=batch_size or settings.SCHEDULER_BATCH_SIZE,
+        reconcile_interval=settings.TASK_COUNTERS_RECONCILE_INTERVAL,
+        recover_interval=settings.WORKER_HEARTBEAT_INTERVAL,
+    )
+    try:
+        scheduler.run()
+    except KeyboardInterrupt:
+        scheduler.stop()
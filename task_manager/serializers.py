@@ -1,5 +1,7 @@
 from rest_framework import serializers
-from .models import Task
+from .models import Task, WorkerHeartbeat
+from .dag_manager import DAGManager
+from . import closure, counters
 from django.utils import timezone
 import pytz
 import logging
@@ -10,6 +12,41 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
+class TaskListSerializer(serializers.ListSerializer):
+    # Insert all tasks with a single bulk_create and attach their dependencies in one pass
+    def create(self, validated_data):
+        tasks = []
+        task_dependencies = []
+        for attrs in validated_data:
+            attrs = self.child.localize_scheduled_at(dict(attrs))
+            task_dependencies.append(attrs.pop("dependencies", []))
+            tasks.append(Task(**attrs))
+
+        Task.objects.bulk_create(tasks, batch_size=1000)
+        # bulk_create does not send post_save either, the counters are updated explicitly too
+        counters.created(tasks)
+
+        # The M2M through table rows are created directly, skipping one query per dependency
+        # bulk_create does not send m2m_changed, so the closure table is updated explicitly
+        edges = [
+            (task.id, dependency.id)
+            for task, dependencies in zip(tasks, task_dependencies)
+            for dependency in dependencies
+        ]
+        TaskDependency = Task.dependencies.through
+        TaskDependency.objects.bulk_create(
+            [
+                TaskDependency(from_task_id=task_id, to_task_id=dependency_id)
+                for task_id, dependency_id in edges
+            ],
+            batch_size=1000,
+        )
+        closure.add_edges(edges)
+        # Nor post_save, the dependency graph version is bumped once for the batch
+        DAGManager.bump_version()
+        return tasks
+
+
 class TaskSerializer(serializers.ModelSerializer):
     TIMEZONE_CHOICES = [(tz, tz) for tz in pytz.common_timezones]
     # result field is a serializer method field that calls the get_result method on the Task instance
@@ -23,6 +60,16 @@ class TaskSerializer(serializers.ModelSerializer):
 
     user_timezone = serializers.ChoiceField(choices=TIMEZONE_CHOICES, default="UTC")
 
+    # Large columns left out of task lists unless they are asked for with ?fields=
+    LIST_DEFERRED_FIELDS = ("description", "result")
+
+    # `fields` limits the output to the given field names
+    def __init__(self, *args, fields=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if fields is not None:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
+
     class Meta:
         model = Task
         fields = [
@@ -34,6 +81,10 @@ class TaskSerializer(serializers.ModelSerializer):
             "result",
             "retry_count",
             "max_retries",
+            "retry_base_delay",
+            "retry_multiplier",
+            "retry_max_delay",
+            "retry_jitter",
             "created_at",
             "updated_at",
             "dependencies",
@@ -41,6 +92,12 @@ class TaskSerializer(serializers.ModelSerializer):
             "user_timezone",
             "recurrence_type",
             "last_run_at",
+            "pending_dependencies",
+            "task_type",
+            "queue",
+            "soft_time_limit",
+            "time_limit",
+            "worker",
         ]
         read_only_fields = [
             "id",
@@ -48,12 +105,14 @@ class TaskSerializer(serializers.ModelSerializer):
             "created_at",
             "updated_at",
             "retry_count",
-            "max_retries",
             "result",
             "last_run_at",
+            "pending_dependencies",
             "is_recurring",
             "recurrence_interval",
+            "worker",
         ]
+        list_serializer_class = TaskListSerializer
 
     def get_result(self, obj):
         return obj.get_result()
@@ -69,6 +128,9 @@ class TaskSerializer(serializers.ModelSerializer):
         return data
 
     def create(self, validated_data):
+        return super().create(self.localize_scheduled_at(validated_data))
+
+    def localize_scheduled_at(self, validated_data):
         user_timezone = validated_data.get("user_timezone", "UTC")
         scheduled_at = validated_data.get("scheduled_at")
 
@@ -86,7 +148,7 @@ class TaskSerializer(serializers.ModelSerializer):
             # converting back user time zone back to UTC for scheduled_at
             validated_data["scheduled_at"] = aware_local_time.astimezone(pytz.UTC)
 
-        return super().create(validated_data)
+        return validated_data
 
 
 class TaskDependencySerializer(serializers.ModelSerializer):
@@ -110,3 +172,28 @@ class TaskDependencyCreateSerializer(serializers.Serializer):
         if task.has_circular_dependency(dependency_task):
             raise serializers.ValidationError("Circular dependency detected")
         return dependency_id
+
+
+class WorkerHeartbeatSerializer(serializers.ModelSerializer):
+    # Tasks the worker has in progress according to the task table
+    in_progress = serializers.IntegerField(read_only=True)
+
+    class Meta:
+        model = WorkerHeartbeat
+        fields = [
+            "id",
+            "hostname",
+            "pid",
+            "pool",
+            "queues",
+            "concurrency",
+            "running",
+            "running_tasks",
+            "processed",
+            "requeued",
+            "throughput",
+            "status",
+            "started_at",
+            "last_seen",
+            "in_progress",
+        ]
@@ -0,0 +1,105 @@
+from django.db.models.signals import (
+    m2m_changed,
+    pre_delete,
+    post_delete,
+    pre_save,
+    post_save,
+)
+import contextvars
+from collections import Counter
+from django.dispatch import receiver
+from .models import Task
+from .dag_manager import DAGManager
+from . import closure, counters
+
+# Set while TaskQuerySet.delete updates the closure and the graph version for the whole batch
+deleting_batch = contextvars.ContextVar("deleting_batch", default=False)
+
+
+# Keep TaskDependencyClosure in sync with Task.dependencies, from either side of the relation
+@receiver(m2m_changed, sender=Task.dependencies.through)
+def update_dependency_closure(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == "post_add" and pk_set:
+        if reverse:
+            # dependency.dependent_tasks.add(*tasks)
+            closure.add_edges((task_id, instance.pk) for task_id in pk_set)
+        else:
+            closure.add_edges((instance.pk, dependency_id) for dependency_id in pk_set)
+
+    elif action == "post_remove" and pk_set:
+        sources = pk_set if reverse else {instance.pk}
+        closure.refresh(closure.affected_by(sources))
+
+    elif action == "pre_clear":
+        # The removed edges are not passed to post_clear, remember who loses a dependency
+        if reverse:
+            sources = set(instance.dependent_tasks.values_list("id", flat=True))
+        else:
+            sources = {instance.pk}
+        instance._closure_affected = closure.affected_by(sources)
+
+    elif action == "post_clear":
+        closure.refresh(getattr(instance, "_closure_affected", set()))
+
+
+# Deleting a task removes its edges without m2m_changed, tasks that depended on it lose those paths
+@receiver(pre_delete, sender=Task)
+def remember_dependents(sender, instance, **kwargs):
+    if deleting_batch.get():
+        return
+    instance._closure_affected = closure.affected_by({instance.pk}) - {instance.pk}
+
+
+@receiver(post_delete, sender=Task)
+def refresh_dependents(sender, instance, **kwargs):
+    closure.refresh(getattr(instance, "_closure_affected", set()))
+
+
+# Bump the dependency graph version when tasks or dependency edges are added or removed
+@receiver(m2m_changed, sender=Task.dependencies.through)
+def bump_graph_version_on_edges(sender, action, **kwargs):
+    if action in ("post_add", "post_remove", "post_clear"):
+        DAGManager.bump_version()
+
+
+@receiver(post_save, sender=Task)
+def bump_graph_version_on_create(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        DAGManager.bump_version()
+
+
+@receiver(post_delete, sender=Task)
+def bump_graph_version_on_delete(sender, instance, **kwargs):
+    if deleting_batch.get():
+        return
+    DAGManager.bump_version()
+
+
+# Keep TaskCounter in sync with saved and deleted tasks, bulk writes record their own deltas
+@receiver(pre_save, sender=Task)
+def remember_counter_key(sender, instance, raw=False, **kwargs):
+    if raw or instance._state.adding:
+        return
+    instance._counter_key = (
+        Task.objects.filter(pk=instance.pk)
+        .values_list(*counters.KEY_FIELDS)
+        .first()
+    )
+
+
+@receiver(post_save, sender=Task)
+def count_saved_task(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    old = None if created else getattr(instance, "_counter_key", None)
+    new = counters.key(instance)
+    if old != new:
+        deltas = Counter({new: 1})
+        if old is not None:
+            deltas[old] -= 1
+        counters.record(deltas)
+
+
+@receiver(post_delete, sender=Task)
+def count_deleted_task(sender, instance, **kwargs):
+    counters.deleted([instance])
@@ -0,0 +1,126 @@
+import time
+import threading
+import uuid
+from collections import defaultdict
+from django.conf import settings
+from .models import Task
+
+
+class TaskCache:
+    # Short-lived read cache shared by the tasks a worker process is handling at the same time.
+    # The rows of a batch of deliveries are loaded with one query, together with the completion status
+    # of their direct dependencies. Each task row is handed out once, dependency statuses are shared by
+    # every task depending on them. Entries older than `ttl` seconds are reloaded.
+    def __init__(self, ttl=5.0):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # task id -> (loaded at, task)
+        self._tasks = {}
+        # task id -> (loaded at, ids of its direct dependencies)
+        self._dependencies = {}
+        # dependency id -> (loaded at, whether it was completed)
+        self._completed = {}
+
+    def _is_fresh(self, entry, now):
+        return entry is not None and now - entry[0] <= self.ttl
+
+    # Load the tasks that are not cached yet, with the status of their dependencies, in two queries
+    def prefetch(self, task_ids):
+        now = time.monotonic()
+        with self._lock:
+            missing = {
+                task_id
+                for task_id in map(_as_uuid, task_ids)
+                if not self._is_fresh(self._tasks.get(task_id), now)
+            }
+        if not missing:
+            return
+
+        tasks = Task.objects.in_bulk(missing)
+        dependencies = defaultdict(set)
+        completed = {}
+        TaskDependency = Task.dependencies.through
+        for task_id, dependency_id, status in TaskDependency.objects.filter(
+            from_task_id__in=tasks
+        ).values_list("from_task_id", "to_task_id", "to_task__status"):
+            dependencies[task_id].add(dependency_id)
+            completed[dependency_id] = status == Task.STATUS_COMPLETED
+
+        now = time.monotonic()
+        with self._lock:
+            self._evict(now)
+            for task_id, task in tasks.items():
+                self._tasks[task_id] = (now, task)
+                self._dependencies[task_id] = (now, frozenset(dependencies[task_id]))
+            for dependency_id, is_completed in completed.items():
+                self._completed[dependency_id] = (now, is_completed)
+
+    # Hand out the row of a task, loading it together with the other buffered deliveries on a miss
+    def take(self, task_id, prefetch_ids=()):
+        task_id = _as_uuid(task_id)
+        task = self._pop(task_id)
+        if task is None:
+            self.prefetch({task_id, *prefetch_ids})
+            task = self._pop(task_id)
+        if task is None:
+            raise Task.DoesNotExist(f"Task {task_id} does not exist")
+        return task
+
+    def _pop(self, task_id):
+        with self._lock:
+            entry = self._tasks.pop(task_id, None)
+        if self._is_fresh(entry, time.monotonic()):
+            return entry[1]
+        return None
+
+    # True when every direct dependency of the task had completed when it was loaded
+    # False means unknown or not completed, the caller then checks the database under a lock
+    def dependencies_completed(self, task_id):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._dependencies.get(_as_uuid(task_id))
+            if not self._is_fresh(entry, now):
+                return False
+            for dependency_id in entry[1]:
+                status = self._completed.get(dependency_id)
+                if not self._is_fresh(status, now) or not status[1]:
+                    return False
+            return True
+
+    # Record that a task completed, so cached dependents processed next do not wait for it
+    def mark_completed(self, task_id):
+        task_id = _as_uuid(task_id)
+        with self._lock:
+            if task_id in self._completed:
+                self._completed[task_id] = (time.monotonic(), True)
+
+    def clear(self):
+        with self._lock:
+            self._tasks.clear()
+            self._dependencies.clear()
+            self._completed.clear()
+
+    def _evict(self, now):
+        for entries in (self._tasks, self._dependencies, self._completed):
+            stale = [
+                key for key, entry in entries.items() if not self._is_fresh(entry, now)
+            ]
+            for key in stale:
+                del entries[key]
+
+
+def _as_uuid(value):
+    return value if isinstance(value, uuid.UUID) else uuid.UUID(str(value))
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+# Get the cache of the current process
+def get_cache():
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = TaskCache(ttl=settings.WORKER_TASK_CACHE_TTL)
+        return _cache
@@ -1,3 +1,648 @@
-from django.test import TestCase
+import json
+import math
+import time
+from collections import Counter
+from unittest import mock
+from datetime import timedelta
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import Case
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from rest_framework.test import APIClient
+from concurrent.futures import Future
+from . import (
+    cancellation,
+    closure,
+    counters,
+    delayed,
+    dispatcher,
+    routing,
+    worker,
+    write_behind,
+)
+from .models import Task, TaskCounter, TaskDependencyClosure
 
-# Create your tests here.
+
+# Whether a topic exchange binding `pattern` matches `routing_key`
+def topic_matches(pattern, routing_key):
+    def match(words, keys):
+        if not words:
+            return not keys
+        if words[0] == "#":
+            return any(match(words[1:], keys[i:]) for i in range(len(keys) + 1))
+        if not keys:
+            return False
+        return words[0] in ("*", keys[0]) and match(words[1:], keys[1:])
+
+    return match(pattern.split("."), routing_key.split("."))
+
+
+@override_settings(RABBITMQ_DELAY_LEVELS=6)
+class DelayedRoutingTests(SimpleTestCase):
+    # Follow a message through the declared level exchanges and queues, like the broker would.
+    # Returns the levels whose queue parked the message and the queue it is delivered to.
+    def route(self, routing_key, queue):
+        operations = delayed.topology() + delayed.destination(queue)
+        queues = {
+            kwargs["queue"]: kwargs["arguments"]
+            for method, kwargs in operations
+            if method == "queue_declare"
+        }
+        parked = []
+        exchange = delayed.entry_exchange()
+        while exchange is not None:
+            next_exchange = None
+            for method, kwargs in operations:
+                if method == "queue_bind" and kwargs["exchange"] == exchange:
+                    if not topic_matches(kwargs["routing_key"], routing_key):
+                        continue
+                    if kwargs["queue"] not in queues:
+                        return parked, kwargs["queue"]
+                    parked.append(kwargs["queue"])
+                    next_exchange = queues[kwargs["queue"]]["x-dead-letter-exchange"]
+                    break
+                if method == "exchange_bind" and kwargs["source"] == exchange:
+                    if topic_matches(kwargs["routing_key"], routing_key):
+                        next_exchange = kwargs["destination"]
+                        break
+            self.assertIsNotNone(
+                next_exchange, f"{routing_key} is dropped at {exchange}"
+            )
+            exchange = next_exchange
+        return parked, None
+
+    def parked_delay(self, parked):
+        return sum(
+            kwargs["arguments"]["x-message-ttl"]
+            for method, kwargs in delayed.topology()
+            if method == "queue_declare" and kwargs["queue"] in parked
+        )
+
+    def test_routing_key_sets_the_bit_of_every_level(self):
+        self.assertEqual(delayed.routing_key("q", 5000), "0.0.0.1.0.1.q")
+        self.assertEqual(delayed.routing_key("q", 63000), "1.1.1.1.1.1.q")
+        self.assertEqual(delayed.routing_key("q", 0), "0.0.0.0.0.0.q")
+
+    def test_delay_is_decomposed_into_levels(self):
+        parked, queue = self.route(delayed.routing_key("q", 5000), "q")
+        self.assertEqual(
+            parked, [delayed.LEVEL_NAME.format(2), delayed.LEVEL_NAME.format(0)]
+        )
+        self.assertEqual(queue, "q")
+
+    def test_remainder_is_rounded_up_to_a_whole_second(self):
+        self.assertEqual(delayed.routing_key("q", 1500), delayed.routing_key("q", 2000))
+        self.assertEqual(delayed.routing_key("q", 1), delayed.routing_key("q", 1000))
+
+    def test_total_delay_equals_the_requested_delay(self):
+        for delay in (0, 1000, 1500, 2000, 7000, 31999, 32000, 45000, 63000):
+            parked, queue = self.route(delayed.routing_key("q", delay), "q")
+            self.assertEqual(queue, "q")
+            self.assertEqual(self.parked_delay(parked), math.ceil(delay / 1000) * 1000)
+
+    def test_delay_beyond_the_highest_level_is_rejected(self):
+        self.assertEqual(delayed.max_delay(), 63000)
+        with self.assertRaises(ValueError):
+            delayed.routing_key("q", 63001)
+
+
+class AgingQueueTests(SimpleTestCase):
+    def test_levels_are_served_by_priority_without_aging(self):
+        queue = routing.AgingQueue()
+        for item, level in [("low1", 1), ("high1", 3), ("low2", 1), ("high2", 3)]:
+            queue.push(item, level, ready_at=0.0)
+        self.assertEqual(
+            [queue.pop() for _ in range(4)], ["high1", "high2", "low1", "low2"]
+        )
+        with self.assertRaises(IndexError):
+            queue.pop()
+
+    def test_waiting_task_overtakes_newer_higher_priorities(self):
+        queue = routing.AgingQueue(aging_interval=5)
+        queue.push("low", 1, ready_at=0.0)
+        queue.push("high", 3, ready_at=10.0)
+        # At 10 seconds the low task has aged to 1 + 2, a tie goes to the higher level
+        self.assertEqual(queue.pop(now=10.0), "high")
+        queue.push("high", 3, ready_at=11.0)
+        self.assertEqual(queue.pop(now=11.0), "low")
+
+    def test_stream_of_higher_priorities_does_not_starve_a_task(self):
+        queue = routing.AgingQueue(aging_interval=1)
+        queue.push("low", 1, ready_at=0.0)
+        now = 0.0
+        while True:
+            queue.push("high", 5, ready_at=now)
+            if queue.pop(now=now) == "low":
+                break
+            now += 0.1
+        # Held back by at most (highest level - its level) * aging_interval
+        self.assertLessEqual(now, 4 + 1e-9)
+
+
+class AsyncWorkerTests(SimpleTestCase):
+    def test_prefetch_count_is_a_multiple_of_the_concurrency(self):
+        from .async_worker import AsyncWorker
+
+        for multiplier, prefetch_count in [(3, 30), (0, 10)]:
+            async_worker = AsyncWorker(concurrency=10, prefetch_multiplier=multiplier)
+            self.assertEqual(async_worker.prefetch_count, prefetch_count)
+
+    def test_start_worker_passes_the_prefetch_multiplier_to_the_asyncio_pool(self):
+        with mock.patch("task_manager.async_worker.start_async_worker") as start:
+            worker.start_worker(
+                queues=[("fast", 1)],
+                concurrency=10,
+                pool=worker.POOL_ASYNCIO,
+                prefetch_multiplier=3,
+            )
+        start.assert_called_once_with(
+            queues=[("fast", 1)], concurrency=10, prefetch_multiplier=3
+        )
+
+
+class ControlMessageTests(SimpleTestCase):
+    def test_cancel_message_cancels_its_task(self):
+        with mock.patch("task_manager.cancellation.cancel") as cancel:
+            cancellation._on_control_message(
+                None, None, None, b'{"action": "cancel", "task_id": "t1"}'
+            )
+        cancel.assert_called_once_with("t1")
+
+    def test_malformed_messages_are_logged_and_dropped(self):
+        bodies = [
+            b"{",
+            b"[]",
+            b'{"action": "cancel"}',
+            b'{"action": "cancel", "task_id": ""}',
+        ]
+        for body in bodies:
+            with self.subTest(body=body):
+                with mock.patch("task_manager.cancellation.cancel") as cancel:
+                    with self.assertLogs("task_manager", "ERROR"):
+                        cancellation._on_control_message(None, None, None, body)
+                cancel.assert_not_called()
+
+
+class WeightedQueuesTests(SimpleTestCase):
+    def filled(self, weights, count=100):
+        queues = routing.WeightedQueues(weights)
+        for queue, _ in weights:
+            for i in range(count):
+                queues.push(queue, f"{queue}{i}")
+        return queues
+
+    def test_busy_queues_share_slots_by_weight(self):
+        queues = self.filled([("fast", 5), ("slow", 3), ("reports", 2)])
+        popped = Counter(queues.pop().rstrip("0123456789") for _ in range(100))
+        self.assertEqual(popped, {"fast": 50, "slow": 30, "reports": 20})
+
+    def test_slots_are_interleaved(self):
+        queues = self.filled([("fast", 3), ("slow", 1)])
+        for _ in range(10):
+            window = [queues.pop().rstrip("0123456789") for _ in range(4)]
+            self.assertEqual(window.count("slow"), 1)
+
+    def test_empty_queue_does_not_hold_back_the_others(self):
+        queues = routing.WeightedQueues([("fast", 1), ("slow", 3)])
+        for i in range(4):
+            queues.push("fast", i)
+        self.assertEqual([queues.pop() for _ in range(4)], [0, 1, 2, 3])
+        self.assertEqual(len(queues), 0)
+        with self.assertRaises(IndexError):
+            queues.pop()
+
+
+@override_settings(RABBITMQ_DELAY_LEVELS=6)
+class RetryDelayTests(SimpleTestCase):
+    def test_delay_grows_and_stops_at_the_task_cap(self):
+        task = Task(retry_base_delay=1, retry_multiplier=2, retry_max_delay=10)
+        task.retry_jitter = 0
+        delays = []
+        for retry_count in range(1, 7):
+            task.retry_count = retry_count
+            delays.append(task.get_retry_delay())
+        self.assertEqual(delays, [1, 2, 4, 8, 10, 10])
+
+    def test_delay_never_exceeds_the_longest_delayed_delivery(self):
+        task = Task(retry_base_delay=1000, retry_max_delay=10**9, retry_jitter=0)
+        for retry_count in (1, 5, 2000):
+            task.retry_count = retry_count
+            delay = task.get_retry_delay()
+            self.assertEqual(delay, 63)
+            # publish_task accepts it
+            delayed.routing_key("q", int(delay * 1000))
+
+
+class DependencyClosureTests(TestCase):
+    def setUp(self):
+        self.a, self.b, self.c, self.d = [
+            Task.objects.create(title=title) for title in "abcd"
+        ]
+
+    def closure_rows(self):
+        return set(
+            TaskDependencyClosure.objects.values_list("task_id", "dependency_id")
+        )
+
+    # The table holds the rows a rebuild from the dependency edges would write
+    def assertClosureRebuilt(self):
+        rows = self.closure_rows()
+        closure.rebuild()
+        self.assertEqual(rows, self.closure_rows())
+
+    def test_added_edge_extends_the_closure_of_dependents(self):
+        self.a.dependencies.add(self.b)
+        self.c.dependencies.add(self.d)
+        self.b.dependencies.add(self.c)
+        self.assertEqual(
+            set(self.a.get_all_dependencies()), {self.b, self.c, self.d}
+        )
+        self.assertEqual(set(self.b.get_all_dependencies()), {self.c, self.d})
+        self.assertClosureRebuilt()
+
+    def test_edge_closing_a_cycle_is_rolled_back(self):
+        self.a.dependencies.add(self.b)
+        self.b.dependencies.add(self.c)
+        # The closure update raises inside the insert of the edge, which rolls back with the savepoint
+        with self.assertRaises(ValueError), transaction.atomic():
+            self.c.dependencies.add(self.a)
+        with self.assertRaises(ValueError), transaction.atomic():
+            self.a.dependencies.add(self.a)
+        self.assertFalse(self.c.dependencies.exists())
+        self.assertFalse(self.a.dependencies.filter(id=self.a.id).exists())
+        self.assertClosureRebuilt()
+
+    def test_bulk_edges_closing_a_cycle_are_rejected(self):
+        self.a.dependencies.add(self.b)
+        with self.assertRaises(ValueError), transaction.atomic():
+            closure.add_edges([(self.b.id, self.c.id), (self.c.id, self.a.id)])
+
+    def test_deleting_a_task_refreshes_its_dependents(self):
+        self.a.dependencies.add(self.b)
+        self.b.dependencies.add(self.c, self.d)
+        self.b.delete()
+        self.assertEqual(set(self.a.get_all_dependencies()), set())
+        self.assertClosureRebuilt()
+
+    def test_batch_delete_refreshes_the_remaining_dependents(self):
+        self.a.dependencies.add(self.b)
+        self.b.dependencies.add(self.c)
+        self.c.dependencies.add(self.d)
+        self.a.dependencies.add(self.d)
+        Task.objects.filter(id__in=[self.b.id, self.c.id]).delete()
+        self.assertEqual(set(self.a.get_all_dependencies()), {self.d})
+        self.assertClosureRebuilt()
+
+
+class TaskTransitionTests(TestCase):
+    def test_only_one_delivery_claims_a_task(self):
+        task = Task.objects.create(title="t", status=Task.STATUS_QUEUED)
+        stale = Task.objects.get(id=task.id)
+        self.assertTrue(
+            task.transition(
+                Task.STATUS_IN_PROGRESS, from_status=Task.STATUS_QUEUED, worker="w1"
+            )
+        )
+        self.assertFalse(
+            stale.transition(
+                Task.STATUS_IN_PROGRESS, from_status=Task.STATUS_QUEUED, worker="w2"
+            )
+        )
+        self.assertEqual(stale.worker, "")
+        task.refresh_from_db()
+        self.assertEqual((task.status, task.worker), (Task.STATUS_IN_PROGRESS, "w1"))
+
+    def test_where_lookups_must_still_match(self):
+        task = Task.objects.create(title="t", status=Task.STATUS_QUEUED, worker="w1")
+        self.assertFalse(
+            task.transition(Task.STATUS_IN_PROGRESS, where={"worker": "w2"})
+        )
+        self.assertTrue(
+            task.transition(Task.STATUS_IN_PROGRESS, where={"worker": "w1"})
+        )
+
+    def test_counters_follow_the_status_the_row_left(self):
+        task = Task.objects.create(title="t", status=Task.STATUS_QUEUED)
+        # Another process moved the row, the instance still says queued
+        Task.objects.filter(id=task.id).update(status=Task.STATUS_PENDING)
+        with mock.patch("task_manager.counters.record") as record:
+            self.assertTrue(
+                task.transition(
+                    Task.STATUS_CANCELLED, from_status=Task.CANCELLABLE_STATUSES
+                )
+            )
+        self.assertEqual(
+            record.call_args.args[0],
+            {
+                (Task.STATUS_PENDING, task.priority, task.recurrence_type): -1,
+                (Task.STATUS_CANCELLED, task.priority, task.recurrence_type): 1,
+            },
+        )
+
+    def test_lost_transition_records_nothing(self):
+        task = Task.objects.create(title="t", status=Task.STATUS_COMPLETED)
+        with mock.patch("task_manager.counters.record") as record:
+            self.assertFalse(
+                task.transition(
+                    Task.STATUS_CANCELLED,
+                    from_status=[Task.STATUS_QUEUED, Task.STATUS_PENDING],
+                )
+            )
+        record.assert_not_called()
+        task.refresh_from_db()
+        self.assertEqual(task.status, Task.STATUS_COMPLETED)
+
+
+@override_settings(TASK_COUNTERS_FLUSH_INTERVAL=0)
+class CounterTests(TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(counters, "_pending", [])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.key = (Task.STATUS_PENDING, 2, "none")
+
+    def count(self, key=None):
+        status, priority, recurrence_type = key or self.key
+        counter = TaskCounter.objects.filter(
+            status=status, priority=priority, recurrence_type=recurrence_type
+        ).first()
+        return counter.count if counter else 0
+
+    def test_record_applies_deltas_on_commit(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            counters.record(Counter({self.key: 2}))
+            self.assertEqual(self.count(), 0)
+        self.assertEqual(self.count(), 2)
+
+    def test_rolled_back_deltas_are_dropped(self):
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            with self.assertRaises(RuntimeError), transaction.atomic():
+                counters.record(Counter({self.key: 2}))
+                raise RuntimeError
+        self.assertEqual(callbacks, [])
+        self.assertEqual(self.count(), 0)
+
+    def test_add_sums_the_deltas_of_each_key(self):
+        counters.add(Counter({self.key: 3}))
+        counters.add(counters.moved([self.key], Task.STATUS_QUEUED))
+        queued = (Task.STATUS_QUEUED, *self.key[1:])
+        self.assertEqual((self.count(), self.count(queued)), (2, 1))
+
+    def test_reconcile_corrects_wrong_counts(self):
+        task = Task.objects.create(title="t")
+        self.key = counters.key(task)
+        TaskCounter.objects.all().delete()
+        counters.add(Counter({(Task.STATUS_FAILED, *self.key[1:]): 4}))
+        self.assertEqual(counters.reconcile(), 2)
+        self.assertEqual(counters.totals()["by_status"], {task.status: 1})
+        self.assertEqual(counters.reconcile(), 0)
+
+    def test_flush_drops_deltas_the_recount_includes(self):
+        task = Task.objects.create(title="t")
+        self.key = counters.key(task)
+        counters.reconcile()
+        # Buffered by another process before the recount, and after it
+        counters._pending.append((time.time() - 60, Counter({self.key: 1})))
+        counters._pending.append((time.time(), Counter({self.key: 1})))
+        counters.flush()
+        self.assertEqual(self.count(), 2)
+        self.assertEqual(counters._pending, [])
+
+
+class TaskCursorPaginationTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_user("user"))
+        # Few distinct sort keys, so pages break inside runs of equal priorities and times
+        now = timezone.now()
+        for i in range(13):
+            task = Task.objects.create(title=f"t{i}", priority=i % 3 + 1)
+            Task.objects.filter(id=task.id).update(
+                created_at=now - timedelta(seconds=i % 2)
+            )
+
+    # Ids of all the pages, following the next links
+    def pages(self, ordering):
+        ids = []
+        url = f"/api/tasks/?ordering={ordering}&page_size=4&fields=id"
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertLessEqual(len(response.data["results"]), 4)
+            ids += [task["id"] for task in response.data["results"]]
+            url = response.data["next"]
+        return ids
+
+    # The ordering sorted in Python, with the tiebreakers in the direction of the first field
+    def expected(self, ordering):
+        fields = ordering.split(",")
+        tiebreaker = "-" if fields[0].startswith("-") else ""
+        fields += [f"{tiebreaker}created_at", f"{tiebreaker}id"]
+        tasks = list(Task.objects.all())
+        for field in reversed(fields):
+            name = field.lstrip("-")
+            tasks.sort(key=lambda task: getattr(task, name), reverse=field[0] == "-")
+        return [str(task.id) for task in tasks]
+
+    def test_pages_cover_every_row_once(self):
+        for ordering in ("priority", "-priority", "created_at", "-created_at"):
+            with self.subTest(ordering=ordering):
+                ids = self.pages(ordering)
+                self.assertEqual(len(ids), len(set(ids)))
+                self.assertEqual(ids, self.expected(ordering))
+
+    def test_mixed_directions_cover_every_row_once(self):
+        for ordering in ("priority,-created_at", "-priority,created_at"):
+            with self.subTest(ordering=ordering):
+                ids = self.pages(ordering)
+                self.assertEqual(len(ids), len(set(ids)))
+                self.assertEqual(ids, self.expected(ordering))
+
+    def test_cursor_of_another_ordering_is_rejected(self):
+        response = self.client.get("/api/tasks/?ordering=priority&page_size=4")
+        cursor = response.data["next"].split("cursor=")[1].split("&")[0]
+        response = self.client.get(f"/api/tasks/?ordering=-priority&cursor={cursor}")
+        self.assertEqual(response.status_code, 400)
+
+
+class WriteBehindTests(TestCase):
+    def setUp(self):
+        self.tasks = [
+            Task.objects.create(title=f"t{i}", status=Task.STATUS_IN_PROGRESS)
+            for i in range(3)
+        ]
+
+    def batch(self):
+        return [
+            (task, {"result": f"r{i}"}, Future()) for i, task in enumerate(self.tasks)
+        ]
+
+    def assertStatuses(self, *statuses):
+        for task, status in zip(self.tasks, statuses):
+            task.refresh_from_db()
+            self.assertEqual(task.status, status)
+
+    def test_batch_writes_the_fields_of_each_task(self):
+        won = write_behind._complete_tasks(self.batch())
+        self.assertEqual(won, {task.id for task in self.tasks})
+        self.assertStatuses(*[Task.STATUS_COMPLETED] * 3)
+        self.assertEqual([task.result for task in self.tasks], ["r0", "r1", "r2"])
+
+    def test_task_moved_before_the_batch_is_left_alone(self):
+        Task.objects.filter(id=self.tasks[1].id).update(status=Task.STATUS_CANCELLED)
+        won = write_behind._complete_tasks(self.batch())
+        self.assertEqual(won, {self.tasks[0].id, self.tasks[2].id})
+        self.assertStatuses(
+            Task.STATUS_COMPLETED, Task.STATUS_CANCELLED, Task.STATUS_COMPLETED
+        )
+        self.assertIsNone(self.tasks[1].result)
+
+    def test_transition_racing_the_update_is_not_overwritten(self):
+        # Cancel a task after the rows were read and before the CASE UPDATE, as a database without
+        # row locks would let it happen
+        cancelled = self.tasks[1]
+
+        def cancel_then_case(*args, **kwargs):
+            Task.objects.filter(id=cancelled.id).update(status=Task.STATUS_CANCELLED)
+            return Case(*args, **kwargs)
+
+        with mock.patch("task_manager.write_behind.Case", side_effect=cancel_then_case):
+            won = write_behind._complete_tasks(self.batch())
+        self.assertEqual(won, {self.tasks[0].id, self.tasks[2].id})
+        self.assertStatuses(
+            Task.STATUS_COMPLETED, Task.STATUS_CANCELLED, Task.STATUS_COMPLETED
+        )
+        self.assertIsNone(self.tasks[1].result)
+
+    def test_complete_returns_whether_the_task_was_in_progress(self):
+        buffer = write_behind.WriteBehind(max_size=2, max_delay=0)
+        self.assertTrue(buffer.complete(self.tasks[0], result="r"))
+        self.assertFalse(buffer.complete(self.tasks[0], result="again"))
+        self.tasks[0].refresh_from_db()
+        self.assertEqual(self.tasks[0].result, "r")
+
+
+# Records published tasks instead of talking to the broker
+class StubQueueManager:
+    def __init__(self):
+        self.published = []
+        self.dead_lettered = []
+
+    def publish_tasks(self, tasks):
+        self.published.extend(task.id for task in tasks)
+        return len(tasks)
+
+    def task_message(self, task):
+        return {"id": str(task.id)}
+
+    def dead_letter(self, body, reason, queue=None):
+        self.dead_lettered.append(body["id"])
+        future = Future()
+        future.set_result(None)
+        return future
+
+
+class DependencyReleaseTests(TestCase):
+    def setUp(self):
+        self.queue_manager = StubQueueManager()
+
+    def status(self, task):
+        task.refresh_from_db()
+        return task.status
+
+    def complete(self, task):
+        task.refresh_from_db()
+        task.transition(Task.STATUS_COMPLETED)
+        return dispatcher.release_dependents(task, self.queue_manager)
+
+    def test_submission_parks_tasks_with_open_dependencies(self):
+        dependency = Task.objects.create(title="dependency")
+        task = Task.objects.create(title="task")
+        task.dependencies.add(dependency)
+        claimed = dispatcher.claim_for_submission([task])
+        # The pending dependency is submitted along with the task
+        self.assertEqual([claimed_task.id for claimed_task in claimed], [dependency.id])
+        self.assertEqual(self.status(task), Task.STATUS_WAITING)
+        self.assertEqual(task.pending_dependencies, 1)
+
+    def test_task_is_released_once_its_last_dependency_completes(self):
+        first, second = [Task.objects.create(title=title) for title in "12"]
+        task = Task.objects.create(title="task")
+        task.dependencies.add(first, second)
+        dispatcher.claim_for_submission([task])
+
+        self.assertEqual(self.complete(first), [])
+        self.assertEqual(self.status(task), Task.STATUS_WAITING)
+        self.assertEqual(task.pending_dependencies, 1)
+
+        self.assertEqual([released.id for released in self.complete(second)], [task.id])
+        self.assertEqual(self.status(task), Task.STATUS_QUEUED)
+        self.assertEqual(self.queue_manager.published[-1], task.id)
+        # A second completion event does not publish it again
+        self.assertEqual(self.complete(second), [])
+
+    def test_failed_task_fails_its_waiting_dependents(self):
+        dependency = Task.objects.create(title="dependency")
+        task = Task.objects.create(title="task")
+        task.dependencies.add(dependency)
+        dependent = Task.objects.create(title="dependent")
+        dependent.dependencies.add(task)
+        unrelated = Task.objects.create(title="unrelated")
+        unrelated.dependencies.add(Task.objects.create(title="other"))
+        dispatcher.claim_for_submission([dependent, unrelated])
+        dependency.refresh_from_db()
+        dependency.transition(Task.STATUS_IN_PROGRESS)
+
+        worker.retry_or_dead_letter(
+            self.queue_manager, dependency, "boom", retry=False
+        )
+        self.assertEqual(self.status(dependency), Task.STATUS_FAILED)
+        self.assertEqual(self.status(task), Task.STATUS_FAILED)
+        self.assertEqual(self.status(dependent), Task.STATUS_FAILED)
+        self.assertEqual(self.status(unrelated), Task.STATUS_WAITING)
+
+    def test_cancelled_task_cancels_its_waiting_dependents(self):
+        dependency = Task.objects.create(title="dependency")
+        task = Task.objects.create(title="task")
+        task.dependencies.add(dependency)
+        dispatcher.claim_for_submission([task])
+
+        dependency.refresh_from_db()
+        dependency.transition(
+            Task.STATUS_CANCELLED, from_status=Task.CANCELLABLE_STATUSES
+        )
+        self.assertEqual(dispatcher.settle_dependents(dependency), 1)
+        self.assertEqual(self.status(task), Task.STATUS_CANCELLED)
+
+
+class RecurringCompletionTests(TestCase):
+    def setUp(self):
+        self.queue_manager = StubQueueManager()
+        self.task = Task.objects.create(
+            title="t", status=Task.STATUS_QUEUED, recurrence_type="daily"
+        )
+        patcher = mock.patch("task_manager.handlers.run", return_value="done")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def handle(self):
+        body = json.dumps({"id": str(self.task.id)}).encode()
+        return worker.handle_message(body, self.queue_manager)
+
+    def test_completed_run_schedules_the_next_one(self):
+        self.assertEqual(self.handle(), worker.ACK)
+        self.task.refresh_from_db()
+        self.assertEqual(self.task.status, Task.STATUS_SCHEDULED)
+        self.assertEqual(self.task.result, "done")
+
+    def test_scheduling_error_does_not_retry_the_completed_run(self):
+        with mock.patch.object(
+            Task, "update_next_run_time", side_effect=RuntimeError("database gone")
+        ), mock.patch("task_manager.worker.retry_or_dead_letter") as retry:
+            with self.assertLogs("task_manager", "ERROR") as logs:
+                self.assertEqual(self.handle(), worker.ACK)
+        retry.assert_not_called()
+        self.assertIn("Failed to schedule the next run", logs.output[-1])
+        self.task.refresh_from_db()
+        self.assertEqual(self.task.status, Task.STATUS_COMPLETED)
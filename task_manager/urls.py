@@ -6,6 +6,7 @@ from .views import (
     TaskDependencyDetail,
     TaskExecutionOrder,
     HealthCheckView,
+    WorkerFleetView,
 )
 
 router = DefaultRouter()
@@ -32,5 +33,10 @@ urlpatterns = [
         HealthCheckView.as_view(),
         name="health-check",
     ),
+    path(
+        "workers/",
+        WorkerFleetView.as_view(),
+        name="worker-fleet",
+    ),
     path("", include(router.urls)),
 ]
@@ -1,23 +1,33 @@
 from rest_framework import status, viewsets, filters, generics
-from rest_framework.exceptions import APIException
+from rest_framework.exceptions import ValidationError
 from .models import Task
 from .dag_manager import DAGManager, CyclicDependencyException
 from .serializers import (
     TaskSerializer,
     TaskDependencySerializer,
     TaskDependencyCreateSerializer,
+    WorkerHeartbeatSerializer,
 )
 from .queue_manager import QueueManager
+from .pagination import TaskCursorPagination
+from . import counters, dispatcher, heartbeats
 from rest_framework.response import Response
 from rest_framework.decorators import action
 from django.urls import reverse
+from django.conf import settings
 from django.db import transaction
-from django.db.models import Count, Case, When
+from django.db.models import Prefetch
+from django.http import Http404, StreamingHttpResponse
+from rest_framework.utils.encoders import JSONEncoder
+from rest_framework.utils.urls import replace_query_param
 from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework.permissions import IsAuthenticated
 from django.shortcuts import get_object_or_404
 from .health_checks import check_database_connection, check_rabbitmq_connection
+import base64
+import json
 import logging
+import uuid
 
 logger = logging.getLogger("task_manager")
 
@@ -35,22 +45,61 @@ class TaskViewSet(viewsets.ModelViewSet):
     filterset_fields = ["status", "priority"]
     search_fields = ["title", "description"]
     ordering_fields = ["priority", "created_at", "updated_at"]
+    ordering = ["-created_at"]
+    pagination_class = TaskCursorPagination
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.action not in ("list", "retrieve"):
+            return queryset
+        fields = self.get_output_fields()
+        if fields is None or "dependencies" in fields:
+            # One query for the dependencies of the whole page instead of one per task
+            queryset = queryset.prefetch_related(
+                Prefetch("dependencies", queryset=Task.objects.only("id"))
+            )
+        if fields is not None:
+            deferred = [
+                name for name in TaskSerializer.LIST_DEFERRED_FIELDS if name not in fields
+            ]
+            queryset = queryset.defer(*deferred)
+        return queryset
+
+    def get_serializer(self, *args, **kwargs):
+        if self.action in ("list", "retrieve"):
+            kwargs.setdefault("fields", self.get_output_fields())
+        return super().get_serializer(*args, **kwargs)
+
+    # Fields of the ?fields= sparse fieldset, lists leave out the large columns by default
+    # None means every field
+    def get_output_fields(self):
+        requested = self.request.query_params.get("fields")
+        if requested:
+            fields = {name.strip() for name in requested.split(",") if name.strip()}
+            unknown = fields - set(TaskSerializer.Meta.fields)
+            if unknown:
+                raise ValidationError(
+                    {"fields": f"Unknown fields: {', '.join(sorted(unknown))}"}
+                )
+            return fields
+        if self.action == "list":
+            return set(TaskSerializer.Meta.fields) - set(
+                TaskSerializer.LIST_DEFERRED_FIELDS
+            )
+        return None
 
     @transaction.atomic
     def create(self, request, *args, **kwargs):
         serializer = self.get_serializer(data=request.data)
         serializer.is_valid(raise_exception=True)
 
-        queue_manager = QueueManager()
         try:
             with transaction.atomic():
                 task = serializer.save(status=Task.STATUS_PENDING)
 
                 # Avoid potential race condition where the task is submitted to the queue before the transaction is committed
                 ## and the task is retrieved in queue_manager.submit_task() might be ran in different transaction causing the race condition
-                transaction.on_commit(
-                    lambda: self._submit_task_to_queue(task, queue_manager)
-                )
+                transaction.on_commit(lambda: self._submit_task_to_queue(task))
 
                 headers = self.get_success_headers(serializer.data)
                 if not headers and task.id:
@@ -64,8 +113,26 @@ class TaskViewSet(viewsets.ModelViewSet):
             return Response(
                 {"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
-        finally:
-            queue_manager.close()
+
+    # Create many tasks in one request: one bulk insert and one broker commit for the whole batch
+    @action(detail=False, methods=["post"], url_path="bulk")
+    def bulk_create(self, request):
+        serializer = self.get_serializer(
+            data=request.data,
+            many=True,
+            allow_empty=False,
+            max_length=settings.TASK_BULK_CREATE_MAX_SIZE,
+        )
+        serializer.is_valid(raise_exception=True)
+
+        with transaction.atomic():
+            tasks = serializer.save(status=Task.STATUS_PENDING)
+            transaction.on_commit(lambda: self._submit_tasks_to_queue(tasks))
+
+        return Response(
+            {"count": len(tasks), "ids": [str(task.id) for task in tasks]},
+            status=status.HTTP_201_CREATED,
+        )
 
     def retrieve(self, request, *args, **kwargs):
         instance = self.get_object()
@@ -73,25 +140,57 @@ class TaskViewSet(viewsets.ModelViewSet):
         data = serializer.data
         return Response(data)
 
+    # Counts are read from the counters table instead of aggregating the task table, see counters.py
     @action(detail=False, methods={"get"})
     def stats(self, request):
-        total = Task.objects.count()
-        by_status = Task.objects.values("status").annotate(count=Count("status"))
-        return Response(
-            {
-                "total": total,
-                "by_status": {item["status"]: item["count"] for item in by_status},
-            }
-        )
-
-    def _submit_task_to_queue(self, task, queue_manager):
+        return Response(counters.totals())
+
+    # Cancel a task that has not finished yet. A queued task is dropped when it is delivered, a running
+    # task is interrupted by its worker, which is told through a broadcast to every worker process.
+    @action(detail=True, methods=["post"])
+    def cancel(self, request, pk=None):
+        task = self.get_object()
+        was_delivered = task.status in (Task.STATUS_QUEUED, Task.STATUS_IN_PROGRESS)
+        if not task.transition(
+            Task.STATUS_CANCELLED, from_status=Task.CANCELLABLE_STATUSES
+        ):
+            task.refresh_from_db(fields=["status"])
+            return Response(
+                {"error": f"Task is {task.status} and can no longer be cancelled"},
+                status=status.HTTP_409_CONFLICT,
+            )
+        dispatcher.settle_dependents(task)
+        # A queued task can be claimed by a worker between the read and the update above
+        if was_delivered:
+            self._broadcast_cancel(task)
+        return Response(self.get_serializer(task).data)
+
+    # The queue manager borrows a pooled channel only for the duration of the submit
+    # Submitting moves the task to queued, or to waiting while its dependencies have not completed
+    def _submit_task_to_queue(self, task):
         try:
-            queue_manager.submit_task(task)
-            task.status = Task.STATUS_QUEUED
-            task.save()
+            with QueueManager() as queue_manager:
+                queue_manager.submit_task(task)
         except Exception as e:
             logger.error(f"Failed to submit task to queue: {e}")
 
+    def _broadcast_cancel(self, task):
+        try:
+            with QueueManager() as queue_manager:
+                queue_manager.broadcast(
+                    {"action": "cancel", "task_id": str(task.id)}
+                ).result(timeout=settings.RABBITMQ_CONFIRM_TIMEOUT)
+        except Exception as e:
+            # The task stays cancelled, its worker's completion no longer applies
+            logger.error(f"Failed to broadcast the cancellation of task {task.id}: {e}")
+
+    def _submit_tasks_to_queue(self, tasks):
+        try:
+            with QueueManager() as queue_manager:
+                queue_manager.submit_tasks(tasks)
+        except Exception as e:
+            logger.error(f"Failed to submit {len(tasks)} tasks to queue: {e}")
+
 
 # Get all dependencies for a task
 # Add dependencies to a task
@@ -152,43 +251,108 @@ class TaskDependencyDetail(generics.DestroyAPIView):
 
 
 # Get the execution order of tasks
+# ?root=<task id> limits it to the task and everything it depends on
+# ?page_size=<n> returns cursor paginated pages, ?stream=ndjson streams one task per line
 class TaskExecutionOrder(generics.ListAPIView):
     permission_classes = [IsAuthenticated]
     serializer_class = TaskSerializer
+    # Tasks loaded and serialized per query
+    chunk_size = 500
 
-    def get_queryset(self):
-        tasks = Task.objects.all()
+    def list(self, request, *args, **kwargs):
         try:
-            ordered_tasks = DAGManager.get_execution_order(tasks)
-            ordered_ids = [task.id for task in ordered_tasks]
-
-            # Convert the list of tasks back to queryset
-            preserved = Case(
-                *[When(pk=pk, then=pos) for pos, pk in enumerate(ordered_ids)]
-            )
-            return Task.objects.filter(pk__in=ordered_ids).order_by(preserved)
+            root_id = self.get_root_id()
+            version, order = DAGManager.get_cached_execution_order(root_id)
         except CyclicDependencyException as e:
-            # Instead of raising an exception, we will return an empty queryset, passing the error in the list() method
-            self.cyclic_error = str(e)
-            return Task.objects.none()
+            return Response(
+                {
+                    "error": "Cyclic dependency detected",
+                    "details": str(e),
+                },
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        except (ValidationError, Http404):
+            raise
         except Exception as e:
-            raise APIException(str(e))
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
-    def list(self, request, *args, **kwargs):
+        if request.query_params.get("stream") == "ndjson":
+            return self.stream(order, version)
+        if "page_size" in request.query_params:
+            return self.paginate(order, version)
+
+        data = [task for chunk in self.serialize(order) for task in chunk]
+        return Response(data, status=status.HTTP_200_OK)
+
+    def get_root_id(self):
+        root = self.request.query_params.get("root")
+        if root is None:
+            return None
         try:
-            queryset = self.get_queryset()
-            if hasattr(self, "cyclic_error"):
-                return Response(
-                    {
-                        "error": "Cyclic dependency detected",
-                        "details": self.cyclic_error,
-                    },
-                    status=status.HTTP_400_BAD_REQUEST,
-                )
-            serializer = self.get_serializer(queryset, many=True)
-            return Response(serializer.data, status=status.HTTP_200_OK)
-        except Exception as e:
-            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+            root_id = uuid.UUID(root)
+        except ValueError:
+            raise ValidationError({"root": "Must be a valid task id."})
+        get_object_or_404(Task, id=root_id)
+        return root_id
+
+    # Serialize the tasks chunk by chunk, in execution order
+    def serialize(self, task_ids):
+        for start in range(0, len(task_ids), self.chunk_size):
+            chunk = task_ids[start : start + self.chunk_size]
+            tasks = Task.objects.prefetch_related("dependencies").in_bulk(chunk)
+            # Tasks deleted since the order was computed are skipped
+            yield self.get_serializer(
+                [tasks[task_id] for task_id in chunk if task_id in tasks], many=True
+            ).data
+
+    def stream(self, order, version):
+        encoder = JSONEncoder()
+        lines = (
+            encoder.encode(task) + "\n"
+            for chunk in self.serialize(order)
+            for task in chunk
+        )
+        response = StreamingHttpResponse(lines, content_type="application/x-ndjson")
+        response["X-DAG-Version"] = version
+        return response
+
+    # The cursor is the graph version and the position in the order, a cursor of an
+    # older version is rejected instead of returning pages of two different orders
+    def paginate(self, order, version):
+        params = self.request.query_params
+        try:
+            page_size = int(params["page_size"])
+            offset = 0
+            if params.get("cursor"):
+                cursor = json.loads(base64.urlsafe_b64decode(params["cursor"]))
+                if cursor["version"] != version:
+                    return Response(
+                        {"error": "Execution order changed, restart from the first page"},
+                        status=status.HTTP_409_CONFLICT,
+                    )
+                offset = int(cursor["offset"])
+        except (ValueError, KeyError, TypeError):
+            raise ValidationError({"cursor": "Invalid cursor or page size."})
+        page_size = max(1, min(page_size, settings.TASK_EXECUTION_ORDER_MAX_PAGE_SIZE))
+
+        page = order[offset : offset + page_size]
+        next_url = None
+        if offset + page_size < len(order):
+            cursor = json.dumps({"version": version, "offset": offset + page_size})
+            next_url = replace_query_param(
+                self.request.build_absolute_uri(),
+                "cursor",
+                base64.urlsafe_b64encode(cursor.encode()).decode(),
+            )
+        return Response(
+            {
+                "version": version,
+                "count": len(order),
+                "next": next_url,
+                "results": [task for chunk in self.serialize(page) for task in chunk],
+            },
+            status=status.HTTP_200_OK,
+        )
 
 
 class HealthCheckView(generics.ListAPIView):
@@ -213,3 +377,19 @@ class HealthCheckView(generics.ListAPIView):
             )
         except Exception as e:
             return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+
+# Fleet view built from the worker heartbeats: every worker with its configuration, running tasks and
+# throughput, the totals of the live workers, and the tasks dead workers left in progress
+class WorkerFleetView(generics.ListAPIView):
+    permission_classes = [IsAuthenticated]
+    serializer_class = WorkerHeartbeatSerializer
+
+    def list(self, request, *args, **kwargs):
+        workers = heartbeats.fleet()
+        return Response(
+            {
+                "totals": heartbeats.totals(workers),
+                "workers": self.get_serializer(workers, many=True).data,
+            }
+        )
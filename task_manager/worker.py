@@ -1,64 +1,129 @@
-import json
 import time
+import functools
+import multiprocessing
 import pika
 import logging
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from .models import Task
+from django import db
 from django.conf import settings
 from .queue_manager import QueueManager
+from .connection_pool import get_connection_parameters
+from . import (
+    cancellation,
+    dispatcher,
+    handlers,
+    heartbeats,
+    message_codecs,
+    routing,
+    task_cache,
+    write_behind,
+)
 from django.utils import timezone
 import logging
 
 logger = logging.getLogger("task_manager")
 
 
+# Handler of tasks without a registered task type
+@handlers.handler(handlers.DEFAULT_TASK_TYPE)
 def process_task(task):
     # Simulate processing a task, such as processing data or running a computation
     print(f"Processing task: {task.title}")
-    time.sleep(5)
+    time.sleep(settings.WORKER_SIMULATED_TASK_SECONDS)
     return "Task completed successfully"
 
 
-def callback(ch, method, properties, body):
-    # Callback function to handle incoming messages from the queue when a new task is received
-    task_data = json.loads(body)
-    logger.info(f"Received task: {task_data['id']}")
+# Acknowledgement decisions returned by execute_message and applied on the connection thread
+ACK = "ack"
+REQUEUE = "requeue"
 
-    # Fetch the task from the database
+POOL_SOLO = "solo"
+POOL_THREAD = "thread"
+POOL_PROCESS = "process"
+POOL_ASYNCIO = "asyncio"
+POOL_CHOICES = (POOL_SOLO, POOL_THREAD, POOL_PROCESS, POOL_ASYNCIO)
+
+
+def acknowledge(ch, delivery_tag, outcome):
+    if not ch.is_open:
+        # The broker redelivers unacknowledged messages once the channel is gone
+        logger.warning(f"Channel closed before delivery {delivery_tag} was acknowledged")
+        return
+    if outcome == ACK:
+        ch.basic_ack(delivery_tag=delivery_tag)
+    else:
+        # Reject the message and requeue it
+        ch.basic_nack(delivery_tag=delivery_tag, requeue=True)
+
+
+# Run the task carried by a message and decide how the delivery is acknowledged
+# It never touches the consuming channel, so it can run in a thread or process pool
+# `prefetch_ids` are the tasks of the other deliveries buffered with this one, they are loaded together
+def execute_message(body, content_type=None, headers=None, prefetch_ids=()):
+    # Long-running pool threads and processes must not hold on to broken database connections
+    db.close_old_connections()
+    # Follow-up publishes borrow a pooled channel instead of opening a connection per message
+    with QueueManager() as queue_manager:
+        return handle_message(body, queue_manager, content_type, headers, prefetch_ids)
+
+
+def handle_message(
+    body, queue_manager, content_type=None, headers=None, prefetch_ids=()
+):
+    try:
+        # The content type of the message selects the codec it is decoded with
+        task_data = message_codecs.decode(body, content_type, headers)
+        logger.info(f"Received task: {task_data['id']}")
+    except (ValueError, KeyError, TypeError) as e:
+        # Redelivering a message that cannot be parsed would only fail again
+        logger.error(f"Dead-lettering malformed message: {e}")
+        queue_manager.dead_letter(body, f"Malformed message: {e}").result(
+            timeout=settings.RABBITMQ_CONFIRM_TIMEOUT
+        )
+        return ACK
+
+    # Fetch the task from the database, together with the tasks of the other buffered deliveries
+    cache = task_cache.get_cache()
     try:
-        task = Task.objects.get(id=task_data["id"])
+        task = cache.take(task_data["id"], prefetch_ids)
     except Task.DoesNotExist:
         logger.error(f"Task with id {task_data['id']} not found in the database")
-        ch.basic_ack(delivery_tag=method.delivery_tag)
-        return
+        return ACK
 
-    task.status = Task.STATUS_IN_PROGRESS
-    task.save()
+    # Only one delivery of a task can claim it, a redelivered message of a task that is already
+    # running or finished is dropped
+    if not task.transition(
+        Task.STATUS_IN_PROGRESS,
+        from_status=Task.STATUS_QUEUED,
+        worker=heartbeats.worker_id(),
+    ):
+        logger.warning(f"Task {task.id} is {task.status}, skipping duplicate delivery")
+        return ACK
 
-    queue_manager = QueueManager()
     # Check if the task is ready to run
     if not task.is_ready_to_run():
         logger.info(f"Task {task.id} is not ready to run")
-        # Re-submit task to delay queue
-        queue_manager.publish_to_delay_queue(ch, task)
-        # Acknowledge original message to remove it from the queue
-        ch.basic_ack(delivery_tag=method.delivery_tag)
-        return
+        # Park the task, the scheduler publishes it once it is due
+        dispatcher.schedule(task)
+        return ACK
 
     # Check if all dependencies are completed
-    dependencies = task.get_all_dependencies()
-    if any(dependency.status != Task.STATUS_COMPLETED for dependency in dependencies):
+    # A waiting task is published again when its last dependency completes, see dispatcher.release_dependents
+    # Completed dependencies stay completed, only an unknown or incomplete status is checked under a lock
+    if not cache.dependencies_completed(task.id) and dispatcher.hold_for_dependencies(
+        task
+    ):
         logger.info(f"Task {task.id} is waiting for dependencies to complete")
-        # Requeue the task to later execution
-        queue_manager.publish_to_delay_queue(ch, task)
-        ch.basic_ack(delivery_tag=method.delivery_tag)
-        return
+        return ACK
 
     try:
-        result = process_task(task)
-        task.status = Task.STATUS_COMPLETED
-        task.result = result
-        task.last_run_at = timezone.now()
-        task.save()
+        result = handlers.run(task)
+        if not complete(task, result=result, last_run_at=timezone.now()):
+            logger.warning(f"Task {task.id} changed state while it was running")
+            return ACK
+        cache.mark_completed(task.id)
 
         logger.info(
             "Task processed",
@@ -68,64 +133,409 @@ def callback(ch, method, properties, body):
                 "result": task.result,
             },
         )
-        ch.basic_ack(delivery_tag=method.delivery_tag)
 
-        # Handle recurring tasks
-        if task.is_recurring and task.recurrence_type != "none":
-            task.update_next_run_time()
+        release_dependents(queue_manager, task)
+        schedule_next_run(task)
+        return ACK
+    except handlers.UnknownTaskType as e:
+        # Retrying cannot help until a worker with the handler is deployed
+        logger.error(f"Task {task.id} failed: {str(e)}")
+        return retry_or_dead_letter(queue_manager, task, e, retry=False)
+    except cancellation.TaskCancelled:
+        # The cancel request already moved the task to cancelled
+        logger.info(f"Task {task.id} was cancelled while it was running")
+        return ACK
+    except handlers.HandlerBusy as e:
+        return defer(queue_manager, task, e)
+    except handlers.WorkerExhausted as e:
+        # The task never started, it goes back to the queue for another worker
+        logger.error(f"Task {task.id} was refused: {e}")
+        task.transition(Task.STATUS_QUEUED, from_status=Task.STATUS_IN_PROGRESS)
+        return REQUEUE
+    except Exception as e:
+        logger.error(f"Task {task.id} failed: {str(e)}")
+        return retry_or_dead_letter(queue_manager, task, e)
+
 
-            if not task.is_ready_to_run():
-                logger.info(f"Task {task.id} is not ready to run")
-                # Re-submit task to delay queue
-                queue_manager.publish_to_delay_queue(ch, task)
-            else:
-                queue_manager.publish_message(task)
+# Mark a running task completed, through the write-behind buffer when the worker enabled it
+# Either way it returns once the update has committed, follow-ups and the ack only happen afterwards
+def complete(task, **fields):
+    buffer = write_behind.get_buffer()
+    if buffer is None:
+        return task.transition(
+            Task.STATUS_COMPLETED, from_status=Task.STATUS_IN_PROGRESS, **fields
+        )
+    return buffer.complete(task, **fields)
 
-        queue_manager.close()
+
+# Put back a task that could not start because its handler has no free concurrency slot
+# It is published again after TASK_CONCURRENCY_DEFER_DELAY seconds and the attempt is not counted
+def defer(queue_manager, task, reason):
+    if not task.transition(Task.STATUS_QUEUED, from_status=Task.STATUS_IN_PROGRESS):
+        logger.warning(f"Task {task.id} changed state while it was running")
+        return ACK
+    delay = settings.TASK_CONCURRENCY_DEFER_DELAY
+    logger.info(f"Deferring task {task.id} by {delay}s: {reason}")
+    try:
+        queue_manager.publish_task(task, delay=int(delay * 1000)).result(
+            timeout=settings.RABBITMQ_CONFIRM_TIMEOUT
+        )
     except Exception as e:
-        logger.error(f"Task {task.id} failed: {str(e)}")
-        # Retry the task if the maximum number of retries has not been reached
-        task.retry_count += 1
-        if task.retry_count < task.max_retries:
-            task.status = Task.STATUS_QUEUED
-            logger.info(
-                f"Retrying task {task.id} ({task.retry_count}/{task.max_retries})"
+        logger.error(f"Failed to publish the deferred task {task.id}: {e}")
+        return REQUEUE
+    return ACK
+
+
+# Retry a failed task after the backoff delay of its retry policy, or dead-letter it once its retries
+# are exhausted, or right away with `retry=False`. The retry goes through delayed delivery instead of
+# the head of the queue.
+def retry_or_dead_letter(queue_manager, task, error, retry=True):
+    retry_count = task.retry_count + 1
+    if retry and retry_count < task.max_retries:
+        if not task.transition(Task.STATUS_QUEUED, retry_count=retry_count):
+            logger.warning(f"Task {task.id} changed state while it was running")
+            return ACK
+        delay = task.get_retry_delay()
+        logger.info(
+            f"Retrying task {task.id} in {delay:.1f}s ({task.retry_count}/{task.max_retries})"
+        )
+        try:
+            queue_manager.publish_task(task, delay=int(delay * 1000)).result(
+                timeout=settings.RABBITMQ_CONFIRM_TIMEOUT
+            )
+        except Exception as e:
+            # Fall back to an immediate redelivery rather than losing the retry
+            logger.error(f"Failed to publish the retry of task {task.id}: {e}")
+            return REQUEUE
+        return ACK
+
+    if not task.transition(Task.STATUS_FAILED, retry_count=retry_count):
+        logger.warning(f"Task {task.id} changed state while it was running")
+        return ACK
+    logger.warning(f"Task {task.id} failed after {task.retry_count} retries")
+    dispatcher.settle_dependents(task)
+    try:
+        queue_manager.dead_letter(
+            queue_manager.task_message(task),
+            f"Failed after {task.retry_count} retries: {error}",
+            queue=routing.queue_for(task),
+        ).result(timeout=settings.RABBITMQ_CONFIRM_TIMEOUT)
+    except Exception as e:
+        logger.error(f"Failed to dead-letter task {task.id}: {e}")
+    return ACK
+
+
+# Publish the dependents that were only waiting for this task
+# A failure is logged rather than raised: the task itself has completed and release_waiting_tasks retries
+def release_dependents(queue_manager, task):
+    try:
+        dispatcher.release_dependents(task, queue_manager)
+    except Exception as e:
+        logger.error(f"Failed to release dependents of task {task.id}: {e}")
+
+
+# Schedule the next run of a completed recurring task, the scheduler publishes it once it is due
+# A failure is logged rather than raised: the run itself has completed, retrying it would run it twice
+def schedule_next_run(task):
+    if not task.is_recurring:
+        return
+    try:
+        task.update_next_run_time()
+    except Exception as e:
+        logger.error(f"Failed to schedule the next run of task {task.id}: {e}")
+
+
+class Worker:
+    # Consumes tasks on one connection and runs up to `concurrency` of them at once.
+    # The solo pool runs tasks inline on the connection thread. The thread and process pools run them
+    # off the connection thread, which keeps heartbeats flowing, and hand the acknowledgement back
+    # to it with add_callback_threadsafe since pika connections are not thread-safe.
+    # With a prefetch multiplier above 1 more deliveries are buffered than there are execution slots.
+    # The first buffered delivery to run loads the tasks of all of them with one query.
+    # `queues` are the (name, weight) pairs of the consumed queues. The prefetch count bounds the
+    # deliveries buffered across all of them, and free execution slots take the buffered deliveries by
+    # weighted round robin between queues and by aging priority within a queue, so neither a backlog on
+    # one queue nor a stream of high priority tasks can starve the others.
+    def __init__(
+        self,
+        queues=None,
+        concurrency=1,
+        pool=POOL_THREAD,
+        prefetch_multiplier=1,
+        write_behind=False,
+    ):
+        if pool not in (POOL_SOLO, POOL_THREAD, POOL_PROCESS):
+            raise ValueError(f"Unknown worker pool: {pool}")
+        if pool == POOL_SOLO:
+            concurrency = 1
+        self.queues = list(queues or [(settings.TASK_DEFAULT_QUEUE, 1)])
+        self.concurrency = concurrency
+        self.prefetch_count = concurrency * max(prefetch_multiplier, 1)
+        self.pool = pool
+        # Completions can only be coalesced between threads sharing a process
+        self.write_behind = write_behind and pool == POOL_THREAD
+        if write_behind and not self.write_behind:
+            logger.warning(f"Write-behind is only used by the thread pool, not {pool}")
+        self.connection = None
+        self.channel = None
+        self.executor = None
+        self.heartbeat = None
+        self._pending = routing.WeightedQueues(
+            self.queues, settings.TASK_PRIORITY_AGING_INTERVAL
+        )
+        self._running = 0
+        self._dispatch_scheduled = False
+        self._stopping = False
+
+    def start(self):
+        # The consuming connection is long-lived and dedicated to this worker, so it is not pooled
+        self.connection = pika.BlockingConnection(get_connection_parameters())
+        self.channel = self.connection.channel()
+        for queue, _ in self.queues:
+            for method, kwargs in routing.consumer_topology(queue):
+                getattr(self.channel, method)(**kwargs)
+
+        # Fair dispatch - a bounded number of unacknowledged messages per execution slot. Every queue is
+        # consumed once per priority level, the limit applies to the channel rather than per consumer.
+        self.channel.basic_qos(prefetch_count=self.prefetch_count, global_qos=True)
+
+        # Handlers and the worker id are set up once, the process pool forks them into its children
+        handlers.load()
+        self.heartbeat = heartbeats.Heartbeat(self.queues, self.pool, self.concurrency)
+        self.executor = self._create_executor()
+        if self.pool != POOL_PROCESS:
+            # Pool processes run these themselves, see init_pool_process
+            handlers.warm_up()
+            cancellation.start_listener()
+        if self.write_behind:
+            # At most `concurrency` tasks can complete at once, a full batch is flushed right away
+            write_behind.enable(
+                max_size=self.concurrency,
+                max_delay=settings.WORKER_WRITE_BEHIND_MAX_DELAY,
+            )
+        self.heartbeat.start()
+        for queue, _ in self.queues:
+            for name in routing.priority_queues(queue) + [queue]:
+                self.channel.basic_consume(
+                    queue=name,
+                    on_message_callback=functools.partial(self.on_message, queue),
+                )
+
+        queues = ", ".join(f"{queue}:{weight}" for queue, weight in self.queues)
+        print(
+            f"Worker is waiting for tasks on {queues} ({self.pool} pool, "
+            f"concurrency {self.concurrency}). To exit press CTRL+C"
+        )
+
+        try:
+            self.channel.start_consuming()
+        except KeyboardInterrupt:
+            self.channel.stop_consuming()
+        finally:
+            self.stop()
+
+    def stop(self):
+        # From here on buffered deliveries stay unstarted, the broker redelivers them once the
+        # connection closes
+        self._stopping = True
+        try:
+            if self.executor is not None:
+                # Let running tasks finish, their acknowledgements are flushed below
+                self.executor.shutdown(wait=True)
+                self.executor = None
+            if self.heartbeat is not None:
+                self.heartbeat.stop()
+            if self.connection is not None and self.connection.is_open:
+                self.connection.process_data_events(time_limit=1)
+        finally:
+            if self.connection is not None and self.connection.is_open:
+                self.connection.close()
+
+    def on_message(self, queue, ch, method, properties, body):
+        level, ready_at = routing.message_priority(
+            properties.priority, properties.headers
+        )
+        self._pending.push(
+            queue,
+            (ch, method, properties, body, peek_task_id(body, properties)),
+            level,
+            ready_at,
+        )
+        # Dispatched once the deliveries already read from the socket have been buffered
+        if not self._dispatch_scheduled:
+            self._dispatch_scheduled = True
+            self.connection.call_later(0, self._dispatch)
+
+    # Hand buffered deliveries to the free execution slots, runs on the connection thread
+    def _dispatch(self):
+        self._dispatch_scheduled = False
+        if self._stopping or not self._pending or self._running >= self.concurrency:
+            return
+        if self.pool == POOL_SOLO:
+            self._run_inline(*self._pending.pop())
+            # Deliveries read meanwhile are buffered before the next one is picked
+            self._dispatch_scheduled = True
+            self.connection.call_later(0, self._dispatch)
+            return
+        task_ids = [entry[4] for entry in self._pending.items() if entry[4] is not None]
+        while self._pending and self._running < self.concurrency:
+            ch, method, properties, body, task_id = self._pending.pop()
+            self._running += 1
+            self.heartbeat.started(method.delivery_tag, task_id)
+            executor, future = self._submit(
+                body, properties.content_type, properties.headers, task_ids
+            )
+            future.add_done_callback(
+                functools.partial(
+                    self._on_finished, ch, method.delivery_tag, task_id, executor
+                )
+            )
+
+    def _run_inline(self, ch, method, properties, body, task_id):
+        self.heartbeat.started(method.delivery_tag, task_id)
+        outcome = execute_message(body, properties.content_type, properties.headers)
+        self.heartbeat.finished(method.delivery_tag, outcome != ACK)
+        acknowledge(ch, method.delivery_tag, outcome)
+
+    def _submit(self, *args):
+        try:
+            return self.executor, self.executor.submit(execute_message, *args)
+        except BrokenProcessPool:
+            # The pool broke before the failures of its deliveries were handled
+            self._replace_executor(self.executor)
+            return self.executor, self.executor.submit(execute_message, *args)
+
+    def _on_finished(self, ch, delivery_tag, task_id, executor, future):
+        self.connection.add_callback_threadsafe(
+            functools.partial(
+                self._on_done, ch, delivery_tag, task_id, executor, future
             )
-            task.save()
-            # Reject the message and requeue it
-            ch.basic_nack(delivery_tag=method.delivery_tag, requeue=True)
-        else:
-            task.status = Task.STATUS_FAILED
-            logger.warning(f"Task {task.id} failed after {task.retry_count} retries")
-            task.save()
-            ch.basic_ack(delivery_tag=method.delivery_tag)
-
-
-def start_worker():
-    # Start the worker to listen for incoming tasks from the queue
-    credentials = pika.PlainCredentials(
-        settings.RABBITMQ_USERNAME, settings.RABBITMQ_PASSWORD
-    )
-    parameters = pika.ConnectionParameters(
-        host=settings.RABBITMQ_HOST,
-        port=settings.RABBITMQ_PORT,
-        virtual_host=settings.RABBITMQ_VIRTUAL_HOST,
-        credentials=credentials,
-    )
-    connection = pika.BlockingConnection(parameters)
-    channel = connection.channel()
-    channel.queue_declare(
-        queue="task_queue", durable=True, arguments={"x-max-priority": 3}
-    )
-
-    # Fair dispatch - one message per worker at a time
-    channel.basic_qos(prefetch_count=1)
-
-    channel.basic_consume(queue="task_queue", on_message_callback=callback)
-
-    print("Worker is waiting for tasks. To exit press CTRL+C")
-
-    channel.start_consuming()
+        )
+
+    def _on_done(self, ch, delivery_tag, task_id, executor, future):
+        try:
+            outcome = future.result()
+        except BrokenProcessPool as e:
+            logger.error(f"Delivery {delivery_tag} lost its pool process: {e}")
+            self._replace_executor(executor)
+            outcome = self._recover(task_id, e)
+        except Exception as e:
+            logger.error(f"Delivery {delivery_tag} crashed the worker pool: {e}")
+            outcome = REQUEUE
+        self._running -= 1
+        self.heartbeat.finished(delivery_tag, outcome != ACK)
+        acknowledge(ch, delivery_tag, outcome)
+        self._dispatch()
+
+    # A pool process that dies, killed after its time limit or by the OS, breaks the whole process pool
+    # and takes the tasks of the other pool processes with it. The pool is replaced once.
+    def _replace_executor(self, broken):
+        if broken is not self.executor or self._stopping:
+            return
+        logger.warning("Replacing the broken process pool")
+        broken.shutdown(wait=False)
+        self.executor = self._create_executor()
+
+    # Settle the delivery of a task whose pool process died
+    # A task left in progress counts as a failed attempt, so a task that keeps killing its pool process
+    # ends up dead-lettered instead of being redelivered forever
+    def _recover(self, task_id, error):
+        if task_id is None:
+            return REQUEUE
+        try:
+            task = Task.objects.filter(id=task_id).first()
+            if task is None or task.status not in (
+                Task.STATUS_QUEUED,
+                Task.STATUS_IN_PROGRESS,
+            ):
+                return ACK
+            if task.status == Task.STATUS_QUEUED:
+                # The pool broke before the task started
+                return REQUEUE
+            with QueueManager() as queue_manager:
+                return retry_or_dead_letter(
+                    queue_manager, task, f"Pool process died: {error}"
+                )
+        except Exception as e:
+            logger.error(f"Failed to recover task {task_id}: {e}")
+            return REQUEUE
+        finally:
+            # The next pool forks from this process
+            db.connections.close_all()
+
+    def _create_executor(self):
+        if self.pool == POOL_THREAD:
+            return ThreadPoolExecutor(
+                max_workers=self.concurrency, thread_name_prefix="task-worker"
+            )
+        if self.pool == POOL_PROCESS:
+            # Children are forked and must not share the parent's database connections
+            db.connections.close_all()
+            executor = ProcessPoolExecutor(
+                max_workers=self.concurrency,
+                mp_context=multiprocessing.get_context("fork"),
+                initializer=init_pool_process,
+            )
+            # A fork pool starts all its processes on the first submit. Submit right away, while this
+            # thread holds no connection, rather than from the first delivery after the heartbeat
+            # and the recovery of broken pools have opened one.
+            executor.submit(int).result()
+            return executor
+        return None
+
+
+# Connections a pool process inherited from its parent. Closing one would end the parent's session, so
+# they are dropped but stay referenced, they must not be closed when they are garbage collected either.
+_inherited_connections = []
+
+
+# Runs once in every pool process before it takes tasks
+def init_pool_process():
+    for connection in db.connections.all(initialized_only=True):
+        if connection.connection is not None:
+            _inherited_connections.append(connection.connection)
+            connection.connection = None
+    handlers.warm_up()
+    cancellation.start_listener()
+
+
+# Task id of a message, None when it cannot be decoded
+# Only a label for batching and heartbeats, it runs on the consuming thread and must never raise:
+# decoding errors are handled by handle_message
+def peek_task_id(body, properties):
+    try:
+        return message_codecs.decode(
+            body, properties.content_type, properties.headers
+        )["id"]
+    except Exception:
+        return None
+
+
+def start_worker(
+    queues=None,
+    concurrency=1,
+    pool=POOL_THREAD,
+    prefetch_multiplier=1,
+    write_behind=False,
+):
+    # Start the worker to listen for incoming tasks from its queues
+    if pool == POOL_ASYNCIO:
+        # Imported lazily, the asyncio engine needs the optional aio-pika client
+        from .async_worker import start_async_worker
+
+        start_async_worker(
+            queues=queues,
+            concurrency=concurrency,
+            prefetch_multiplier=prefetch_multiplier,
+        )
+        return
+    Worker(
+        queues=queues,
+        concurrency=concurrency,
+        pool=pool,
+        prefetch_multiplier=prefetch_multiplier,
+        write_behind=write_behind,
+    ).start()
 
 
 if __name__ == "__main__":
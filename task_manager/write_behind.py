@@ -0,0 +1,127 @@
+import threading
+import time
+from concurrent.futures import Future
+from django.db import transaction
+from django.db.models import Case, Value, When
+from django.utils import timezone
+from .models import Task
+from . import counters
+
+# Write-behind buffer for task completions of a worker process.
+# Completions of tasks finishing close together are coalesced into one conditional UPDATE. The first
+# thread to add a completion leads the batch: it waits until `max_size` completions are buffered or
+# `max_delay` seconds have passed and writes them, the other threads wait for that write. Callers only
+# return, and their deliveries are only acknowledged, once the batch holding their completion has
+# committed, so a crash before the flush loses the write and the broker redelivers the message.
+
+
+class WriteBehind:
+    def __init__(self, max_size=1, max_delay=0.02):
+        self.max_size = max(max_size, 1)
+        self.max_delay = max_delay
+        self._condition = threading.Condition()
+        # (task, fields, future) of the completions waiting for the next flush
+        self._pending = []
+
+    # Buffer the completion of a task running in_progress and wait until it is written
+    # Returns whether the task was still in progress, like Task.transition
+    def complete(self, task, **fields):
+        entry = (task, fields, Future())
+        with self._condition:
+            self._pending.append(entry)
+            leader = len(self._pending) == 1
+            if len(self._pending) >= self.max_size:
+                self._condition.notify_all()
+            if leader:
+                deadline = time.monotonic() + self.max_delay
+                while len(self._pending) < self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                batch, self._pending = self._pending, []
+        if leader:
+            self._write(batch)
+        return entry[2].result()
+
+    def _write(self, batch):
+        try:
+            won = _complete_tasks(batch)
+        except Exception as e:
+            for _, _, future in batch:
+                future.set_exception(e)
+            return
+        for task, fields, future in batch:
+            future.set_result(task.id in won)
+
+
+# Move the in_progress tasks of a batch to completed with a single UPDATE and return the ids that moved
+# Rows are locked first, so the returned ids are exactly the rows the UPDATE changed. The UPDATE still
+# requires in_progress, so on a database without row locks a concurrent transition is never overwritten.
+def _complete_tasks(batch):
+    now = timezone.now()
+    by_id = {task.id: (task, fields) for task, fields, _ in batch}
+    with transaction.atomic():
+        won = set(
+            Task.objects.select_for_update()
+            .filter(id__in=by_id, status=Task.STATUS_IN_PROGRESS)
+            .values_list("id", flat=True)
+        )
+        if not won:
+            return won
+        columns = {name for task_id in won for name in by_id[task_id][1]}
+        values = {
+            name: Case(
+                *[
+                    When(
+                        id=task_id,
+                        then=Value(
+                            by_id[task_id][1].get(name),
+                            output_field=Task._meta.get_field(name),
+                        ),
+                    )
+                    for task_id in won
+                ],
+                output_field=Task._meta.get_field(name),
+            )
+            for name in columns
+        }
+        updated = Task.objects.filter(
+            id__in=won, status=Task.STATUS_IN_PROGRESS
+        ).update(status=Task.STATUS_COMPLETED, updated_at=now, **values)
+        if updated != len(won):
+            won = set(
+                Task.objects.filter(
+                    id__in=won, status=Task.STATUS_COMPLETED, updated_at=now
+                ).values_list("id", flat=True)
+            )
+        counters.record(
+            counters.moved(
+                [
+                    counters.key(by_id[task_id][0], Task.STATUS_IN_PROGRESS)
+                    for task_id in won
+                ],
+                Task.STATUS_COMPLETED,
+            )
+        )
+    for task_id in won:
+        task, fields = by_id[task_id]
+        for name, value in dict(
+            fields, status=Task.STATUS_COMPLETED, updated_at=now
+        ).items():
+            setattr(task, name, value)
+    return won
+
+
+_buffer = None
+
+
+# Buffer of the current process, None unless the worker enabled write-behind
+def get_buffer():
+    return _buffer
+
+
+def enable(max_size, max_delay):
+    global _buffer
+    _buffer = WriteBehind(max_size=max_size, max_delay=max_delay)
+    return _buffer